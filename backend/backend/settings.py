@@ -39,6 +39,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions', # Outdated, and can be deleted with no consequences
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres', # trigram search lookups
     'rest_framework',
     'corsheaders',
     'rest_framework_simplejwt',
@@ -52,6 +53,8 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # inert unless PROFILING_ENABLED, after authentication so it can tell staff sessions apart
+    'rooms.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -91,6 +94,13 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'idempotency-key',
+]
+
+# lets the client tell a replayed response from a fresh one, and when to retry a throttled one
+CORS_EXPOSE_HEADERS = [
+    'idempotent-replayed',
+    'retry-after',
 ]
 
 # CSRF Trusted Origins 
@@ -148,7 +158,104 @@ REST_FRAMEWORK = {
         ],
         'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
         'PAGE_SIZE': 10,
+        # proxies in front of the app that append to X-Forwarded-For, the throttles' per-IP buckets
+        # key on the address the nearest one saw ( 0: REMOTE_ADDR, the header is client controlled )
+        'NUM_PROXIES': 0,
+}
+
+# Waitlist
+# how long a user has to accept a freed slot before it goes to the next person
+WAITLIST_HOLD_MINUTES = 15
+# match freed slots in the outbox workers ( manage.py run_outbox ), False runs inline on commit, handy in tests
+WAITLIST_MATCH_ASYNC = True
+
+# Booking quotas
+# used when no BookingQuota row applies to a user, None means unlimited
+RESERVATION_QUOTA_DEFAULTS = {
+    'max_hours_per_day': None,
+    'max_hours_per_week': None,
+    'max_active_reservations': None,
+}
+
+# Idempotency keys
+# how long a stored response is replayed for a retried reservation write
+IDEMPOTENCY_KEY_TTL_HOURS = 24
+
+# Library calendar
+# weeks of opening hours materialized ahead, later hours are expanded from the schedules when asked for
+CALENDAR_HORIZON_WEEKS = 8
+# how far ahead rooms can be booked, in weeks ( None for no limit )
+BOOKING_HORIZON_WEEKS = None
+
+# Availability heatmap ( rooms/heatmap.py )
+# longest date range per request, and how long an answer is cached ( changes invalidate it sooner )
+HEATMAP_MAX_DAYS = 31
+HEATMAP_CACHE_SECONDS = 60
+
+# Calendar feeds ( rooms/feeds.py )
+# reservations that started up to this many days ago stay in the iCal feeds
+CALENDAR_FEED_PAST_DAYS = 30
+
+# Throttling ( rooms/throttling.py )
+# token buckets per scope and kind: ( tokens refilled per second, burst size ), a missing kind is unlimited
+THROTTLE_BUCKETS = {
+    'availability': { 'user': ( 5, 30 ), 'ip': ( 20, 200 ), 'endpoint': ( 500, 1000 ) },
+    'booking': { 'user': ( 1, 20 ), 'ip': ( 10, 100 ), 'endpoint': ( 100, 200 ) },
+    # typeahead, one request per keystroke
+    'search': { 'user': ( 10, 50 ), 'ip': ( 20, 200 ), 'endpoint': ( 1000, 2000 ) },
 }
+# 'local' keeps buckets in each worker's memory, 'cache' shares them through CACHES['default']
+THROTTLE_STORE = os.getenv('THROTTLE_STORE', 'local')
+# booking writes running at once per worker process, writes allowed to wait for a slot, and for how long
+BOOKING_MAX_CONCURRENT_WRITES = 8
+BOOKING_MAX_QUEUED = 64
+BOOKING_QUEUE_TIMEOUT = 5.0
+
+# Batch endpoint ( rooms/batch.py )
+# sub-requests per batch, and threads per worker process running them
+BATCH_MAX_REQUESTS = 20
+BATCH_WORKERS = 4
+
+# Cache invalidation bus ( rooms/versions.py )
+# LISTEN for version bumps of the other worker processes, on in production ( settings_production.py )
+CACHE_INVALIDATION_BUS = os.getenv('CACHE_INVALIDATION_BUS', '') == '1'
+# seconds the first request of a process waits for the listener to connect
+CACHE_INVALIDATION_STARTUP_TIMEOUT = 2.0
+
+# Async read path
+# connections per event loop in the psycopg pool used by rooms/async_views.py ( 0 uses the async ORM )
+ASYNC_DB_POOL_SIZE = int(os.getenv('ASYNC_DB_POOL_SIZE', 10))
+
+# Request profiling ( rooms/profiling.py, listed at rooms/metrics/profiles/ )
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', '') == '1'
+# fraction of requests profiled at random, staff can ask for a profile of a request with the header
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', 0.01))
+PROFILING_HEADER = 'X-Profile'
+# header requested profiles per worker process: ( per second, burst ), as in THROTTLE_BUCKETS
+PROFILING_HEADER_BUCKET = (0.5, 5)
+# seconds between stack samples, profiles kept per worker process, SQL statements kept per profile
+PROFILING_INTERVAL = 0.001
+PROFILING_BUFFER_SIZE = 50
+PROFILING_MAX_QUERIES = 200
+
+# Outbox ( rooms/outbox.py, processed by manage.py run_outbox )
+# events claimed per worker transaction, attempts before an event is marked failed
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_MAX_ATTEMPTS = 8
+# seconds a worker has to run a claimed event's handlers before another worker may claim it again
+OUTBOX_LEASE_SECONDS = 300
+# retry delay doubles from the base up to the max ( seconds, with jitter )
+OUTBOX_RETRY_BASE_SECONDS = 5
+OUTBOX_RETRY_MAX_SECONDS = 3600
+# processed events are kept this long for inspection
+OUTBOX_RETENTION_DAYS = 7
+RESERVATION_REMINDER_MINUTES = 60
+
+# Email ( sent by the outbox workers, printed to the console unless a backend is configured )
+EMAIL_BACKEND = os.getenv('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+EMAIL_HOST = os.getenv('EMAIL_HOST', 'localhost')
+EMAIL_PORT = int(os.getenv('EMAIL_PORT', 25))
+DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'LibMaster <noreply@localhost>')
 
 
 # Password validation
@@ -0,0 +1,76 @@
+"""
+Production settings, on top of settings.py.
+Run with DJANGO_SETTINGS_MODULE=backend.settings_production ( several worker processes, on one or
+more nodes, sharing one PostgreSQL database ). Every worker keeps its caches in its own memory, or in
+Redis when REDIS_URL is set, and the cache invalidation bus ( rooms/versions.py ) makes them all drop
+stale entries within milliseconds of a change committing anywhere.
+See https://docs.djangoproject.com/en/5.0/howto/deployment/checklist/
+"""
+
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .settings import *  # noqa: F401,F403
+
+if not SECRET_KEY:
+    raise ImproperlyConfigured( "SECRET_KEY must be set in production." )
+
+DEBUG = False
+
+# comma separated, e.g. ALLOWED_HOSTS=dconn.dev,www.dconn.dev
+ALLOWED_HOSTS = [ host for host in os.getenv( 'ALLOWED_HOSTS', ','.join( ALLOWED_HOSTS ) ).split( ',' ) if host ]
+
+# keep connections between requests ( checked before reuse, a restarted database is not an error )
+CONN_MAX_AGE = int( os.getenv( 'CONN_MAX_AGE', 60 ) )
+CONN_HEALTH_CHECKS = True
+DATABASES[ 'default' ][ 'CONN_MAX_AGE' ] = CONN_MAX_AGE
+DATABASES[ 'default' ][ 'CONN_HEALTH_CHECKS' ] = CONN_HEALTH_CHECKS
+
+# Caches
+# per worker memory by default, cached entries are keyed by versions the bus keeps in step, so no
+# worker serves a stale one. With REDIS_URL the workers share one cache ( needs the redis package ),
+# and the throttle buckets along with it
+if os.getenv( 'REDIS_URL' ):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv( 'REDIS_URL' ),
+        }
+    }
+    THROTTLE_STORE = os.getenv( 'THROTTLE_STORE', 'cache' )
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'libmaster',
+        }
+    }
+
+# Cache invalidation bus ( rooms/versions.py )
+# every worker LISTENs for the version bumps of the others, off only with CACHE_INVALIDATION_BUS=0
+CACHE_INVALIDATION_BUS = os.getenv( 'CACHE_INVALIDATION_BUS', '1' ) == '1'
+
+# proxies in front of the workers that append the client address to X-Forwarded-For, one by default
+# ( the TLS terminating proxy below ), the per-IP throttle buckets key on the address it saw
+REST_FRAMEWORK = { **REST_FRAMEWORK, 'NUM_PROXIES': int( os.getenv( 'NUM_PROXIES', 1 ) ) }
+
+# behind a TLS terminating proxy that sets X-Forwarded-Proto
+SECURE_PROXY_SSL_HEADER = ( 'HTTP_X_FORWARDED_PROTO', 'https' )
+SESSION_COOKIE_SECURE = True
+CSRF_COOKIE_SECURE = True
+SECURE_CONTENT_TYPE_NOSNIFF = True
+
+# Logging
+# to stderr, collected by the process manager, version listener reconnects and outbox failures included
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': { 'class': 'logging.StreamHandler' },
+    },
+    'root': {
+        'handlers': [ 'console' ],
+        'level': os.getenv( 'LOG_LEVEL', 'WARNING' ),
+    },
+}
@@ -3,7 +3,8 @@
 # Modified: 2/28/2025 @ 9:21:19 PM EST
 
 from django.contrib import admin
-from .models import Library, Floor, Room, Reservation, Material
+from .models import Library, Floor, Room, Reservation, Material, WaitlistEntry, BookingQuota, WeeklySchedule, ScheduleOverride, OutboxEvent, RoomUsage, RoomClosure, CalendarFeedToken
+from . import calendar, room_status, search
 
 """
 Django's admin interface provides a built-in way to manage our application data
@@ -11,25 +12,51 @@ It automatically creates UI for viewing, adding, editing, and deleting records
 The configuration below customizes how each model appears in the admin interface
 """
 
+# the admin search box uses the same matching as the typeahead endpoint ( rooms/search.py ),
+# trigram index backed where pg_trgm is installed
+class IndexedSearchMixin:
+    def get_search_results( self, request, queryset, search_term ):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        return queryset.filter( search.matches( queryset.model, self.search_fields, term ) ), False
+
+# inlines edit related rows on the library's own page
+class WeeklyScheduleInline( admin.TabularInline ):
+    model = WeeklySchedule
+    extra = 0
+
+class ScheduleOverrideInline( admin.TabularInline ):
+    model = ScheduleOverride
+    extra = 0
+
 @admin.register( Library ) # this decorator registers the model with the admin site
-class LibraryAdmin( admin.ModelAdmin ):
+class LibraryAdmin( IndexedSearchMixin, admin.ModelAdmin ):
     # controls which fields appear as columns in the list view
-    list_display = ( 'name', 'location', 'opening_time', 'closing_time' )
+    list_display = ( 'name', 'location', 'opening_time', 'closing_time', 'time_zone', 'calendar_until' )
 
     # enables the search box to find libraries by these fields
-    search_fields = ( 'name', 'location' )
+    search_fields = ( 'name', 'location', 'description' )
 
     # with this config, admins can easily see library hours and search by name
 
+    # weekly hours and holiday / exam week overrides are edited with the library
+    inlines = ( WeeklyScheduleInline, ScheduleOverrideInline )
+
+    def save_related( self, request, form, formsets, change ):
+        super().save_related( request, form, formsets, change )
+        # the schedules are saved now, expand them into open intervals
+        calendar.materialize( form.instance )
+
 @admin.register( Floor )
-class FloorAdmin( admin.ModelAdmin ):
+class FloorAdmin( IndexedSearchMixin, admin.ModelAdmin ):
     # these fields will show as columns in the floors list
     list_display = ( 'library', 'number', 'description' )
     list_filter = ( 'library', )
     search_fields = ( 'library__name', 'number', 'description' )
 
 @admin.register( Room )
-class RoomAdmin( admin.ModelAdmin ):
+class RoomAdmin( IndexedSearchMixin, admin.ModelAdmin ):
     # shows these fields in the rooms list
     list_display = ( 'room_id', 'floor', 'capacity', 'status' )
 
@@ -59,6 +86,20 @@ class RoomAdmin( admin.ModelAdmin ):
         }),
     )
 
+    def save_model( self, request, obj, form, change ):
+        # a status edit goes through room_status.transition, overlapping reservations are flagged for staff
+        new_status = obj.status
+        status_changed = change and 'status' in form.changed_data
+        if status_changed:
+            obj.status = form.initial[ 'status' ]
+        super().save_model( request, obj, form, change )
+        if not change:
+            # a room added out of service stays closed until it is reopened
+            room_status.close_new_rooms( [ obj ], reason="Created in the admin", user=request.user )
+        if status_changed:
+            room_status.transition( obj, new_status, resolution='flag', reason="Changed in the admin", user=request.user )
+            obj.status = new_status
+
 @admin.register( Reservation )
 class ReservationAdmin( admin.ModelAdmin ):
     # essential reservation info shown in the list view
@@ -103,3 +144,53 @@ class MaterialAdmin(admin.ModelAdmin):
     search_fields = ("id", "name", "library__name")  
     ordering = ("library", "name")  
 
+@admin.register( WaitlistEntry )
+class WaitlistEntryAdmin( admin.ModelAdmin ):
+    # who is waiting for what, and whether a hold has been offered
+    list_display = ( 'user', 'room', 'floor', 'start_time', 'end_time', 'status', 'hold_expires_at' )
+    list_filter = ( 'status', 'floor__library' )
+    search_fields = ( 'user__username', 'room__room_id' )
+    readonly_fields = ( 'hold', 'hold_expires_at', 'created_at' )
+
+@admin.register( BookingQuota )
+class BookingQuotaAdmin( admin.ModelAdmin ):
+    # a row with neither user nor group is the default quota for everyone
+    list_display = ( '__str__', 'max_hours_per_day', 'max_hours_per_week', 'max_active_reservations' )
+    list_filter = ( 'group', )
+    search_fields = ( 'user__username', 'group__name' )
+    raw_id_fields = ( 'user', )
+
+@admin.register( OutboxEvent )
+class OutboxEventAdmin( admin.ModelAdmin ):
+    # failed events show the last error, set the status back to pending to retry one
+    list_display = ( 'id', 'topic', 'status', 'attempts', 'available_at', 'processed_at' )
+    list_filter = ( 'status', 'topic' )
+    readonly_fields = ( 'topic', 'payload', 'attempts', 'last_error', 'created_at', 'processed_at' )
+
+@admin.register( RoomUsage )
+class RoomUsageAdmin( admin.ModelAdmin ):
+    list_display = ( 'room', 'date', 'bookings', 'cancellations', 'booked_minutes' )
+    list_filter = ( 'room__floor__library', )
+    date_hierarchy = 'date'
+
+@admin.register( RoomClosure )
+class RoomClosureAdmin( admin.ModelAdmin ):
+    # created and ended only through room_status.transition ( the room status API or editing a room's status ),
+    # which resolves the reservations a window covers, here the reason can be corrected
+    list_display = ( 'room', 'status', 'start_time', 'end_time', 'resolution', 'reason', 'created_by' )
+    list_filter = ( 'status', 'resolution', 'room__floor__library' )
+    search_fields = ( 'room__room_id', 'reason' )
+    readonly_fields = ( 'room', 'status', 'start_time', 'end_time', 'resolution', 'created_by', 'created_at' )
+
+    def has_add_permission( self, request ):
+        return False
+
+    def has_delete_permission( self, request, obj=None ):
+        return False
+
+@admin.register( CalendarFeedToken )
+class CalendarFeedTokenAdmin( admin.ModelAdmin ):
+    # deleting a token revokes the user's feed URLs, they get a new one from rooms/feeds/token/
+    list_display = ( 'user', 'created_at' )
+    search_fields = ( 'user__username', )
+    readonly_fields = ( 'user', 'token', 'created_at' )
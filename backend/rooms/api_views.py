@@ -1,12 +1,23 @@
-from rest_framework import viewsets, permissions, status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework import viewsets, mixins, permissions, status
+from rest_framework.decorators import action, api_view, permission_classes, throttle_classes
 from rest_framework.response import Response
+from django.conf import settings
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django.utils import timezone
-from datetime import datetime
-from .models import Library, Floor, Room, Reservation, Material
-from .serializers import LibrarySerializer, FloorSerializer, RoomSerializer, ReservationSerializer, RoomAvailabilitySerializer, MaterialSerializer
-from django.http import JsonResponse
+from datetime import datetime, timedelta
+import io
+from .models import Library, Floor, Room, Reservation, Material, WaitlistEntry, CalendarFeedToken, new_feed_token
+from .serializers import LibrarySerializer, FloorSerializer, RoomSerializer, ReservationSerializer, RoomAvailabilitySerializer, RoomSuggestionSerializer, TimeWindowSerializer, MapPointSerializer, MaterialSerializer, WaitlistEntrySerializer, RoomClosureSerializer, RoomStatusChangeSerializer, SearchQuerySerializer, BatchSerializer, HeatmapQuerySerializer
+from . import batch, bulk, calendar, floormaps, heatmap, outbox, profiling, room_status, search, suggestions, throttling, waitlist
+from .booking import ReservationConflict, save_reservation, cancel_reservation, delete_reservation
+from .idempotency import idempotent
+from .quotas import QuotaExceeded
+from .throttling import admission_controlled, throttles_for
+from .calendar import LibraryClosed
+from .room_status import RoomUnavailable
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
 
 # ViewSets for browsing (no authentication required)
 class LibraryViewSet(viewsets.ReadOnlyModelViewSet):
@@ -18,6 +29,25 @@ class LibraryViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = LibrarySerializer
     permission_classes = [permissions.AllowAny]
 
+    @action(detail=True)
+    def hours(self, request, pk=None):
+        """
+        Opening hours between start and end ( default: the next 7 days ), as UTC intervals.
+        """
+        library = self.get_object()
+        if 'start' in request.query_params or 'end' in request.query_params:
+            query = TimeWindowSerializer(data=request.query_params)
+            query.is_valid(raise_exception=True)
+            start, end = query.validated_data['start'], query.validated_data['end']
+        else:
+            start = timezone.now()
+            end = start + timedelta(days=7)
+        return Response({
+            "library": library.pk,
+            "time_zone": library.time_zone,
+            "open": open_hours(library, start, end),
+        })
+
 class FloorViewSet(viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for listing floors.
@@ -34,6 +64,57 @@ class FloorViewSet(viewsets.ReadOnlyModelViewSet):
             queryset = queryset.filter(library_id=library_id)
         return queryset
 
+    @action(detail=True)
+    def map(self, request, pk=None):
+        """
+        The floor layout compiled to SVG, rooms are <rect id="room-<room_id>">.
+        Cached per layout version, clients revalidate with If-None-Match.
+        """
+        floor = self.get_object()
+        etag = f'"floor-{floor.pk}-v{floor.layout_version}"'
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+        response = HttpResponse(floormaps.floor_svg(floor), content_type='image/svg+xml')
+        response['ETag'] = etag
+        patch_cache_control(response, public=True, no_cache=True)
+        return response
+
+    @action(detail=True, throttle_classes=throttles_for('availability'))
+    def availability(self, request, pk=None):
+        """
+        Bitmap of rooms bookable for the whole start-end window, one bit per room in map order.
+        """
+        floor = self.get_object()
+        query = TimeWindowSerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        bitmap, room_count = floormaps.availability_bitmap(
+            floor, query.validated_data['start'], query.validated_data['end']
+        )
+        return Response({
+            "floor": floor.pk,
+            "layout_version": floor.layout_version,
+            "room_count": room_count,
+            "bitmap": bitmap,
+        })
+
+    @action(detail=True)
+    def hit(self, request, pk=None):
+        """
+        Rooms at map point (x, y), or within 'radius' of it ordered by distance.
+        """
+        floor = self.get_object()
+        query = MapPointSerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        x, y, radius = (query.validated_data[name] for name in ('x', 'y', 'radius'))
+        index = floormaps.spatial_index(floor)
+        if radius:
+            rooms = [{"room_id": room_id, "distance": round(distance, 2)}
+                     for distance, room_id in index.within(x, y, radius)]
+        else:
+            rooms = [{"room_id": room_id, "distance": 0} for room_id in index.at_point(x, y)]
+        return Response({"floor": floor.pk, "rooms": rooms})
+
 class RoomViewSet(viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for listing rooms.
@@ -55,12 +136,13 @@ class RoomViewSet(viewsets.ReadOnlyModelViewSet):
 
 @api_view(['GET'])
 @permission_classes([permissions.AllowAny])
+@throttle_classes(throttles_for('availability'))
 def check_room_availability(request, room_id):
     """
     Check room availability for a specific date.
     No authentication required to check availability.
     """
-    room = get_object_or_404(Room, room_id=room_id)
+    room = get_object_or_404(Room.objects.select_related('floor__library'), room_id=room_id)
     date_param = request.query_params.get('date', None)
     
     if date_param:
@@ -72,16 +154,17 @@ def check_room_availability(request, room_id):
                 status=status.HTTP_400_BAD_REQUEST
             )
     else:
-        date = timezone.now().date()
+        date = calendar.local_date(room.floor.library, timezone.now())
     
-    # Get the start and end of the day
-    start_datetime = timezone.make_aware(datetime.combine(date, datetime.min.time()))
-    end_datetime = timezone.make_aware(datetime.combine(date, datetime.max.time()))
+    # Get the start and end of the day in the library's time zone
+    library = room.floor.library
+    start_datetime, end_datetime = calendar.local_day_bounds(library, date)
     
-    # Get reservations for this room on this date
+    # Get reservations for this room starting on this date
     reservations = Reservation.objects.filter(
         room=room,
-        start_time__date=date,
+        start_time__gte=start_datetime,
+        start_time__lt=end_datetime,
         status__in=['pending', 'confirmed']
     ).order_by('start_time')
     
@@ -94,9 +177,153 @@ def check_room_availability(request, room_id):
         "room": room.room_id,
         "date": date,
         "is_available": is_available,
+        "open_hours": open_hours(library, start_datetime, end_datetime),
         "reservations": serializer.data
     })
 
+@api_view(['GET'])
+@permission_classes([permissions.AllowAny])
+@throttle_classes(throttles_for('availability'))
+def room_suggestions(request, room_id):
+    """
+    Suggest the earliest free windows of the requested length in this room,
+    and nearby rooms of equal or greater capacity and the same amenities that are free.
+    No authentication required.
+    """
+    room = get_object_or_404(Room.objects.select_related('floor__library'), room_id=room_id)
+    query = RoomSuggestionSerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    params = query.validated_data
+    return Response(suggestions.suggest(
+        room, params['start'], params['end'],
+        days=params['days'], limit=params['limit'], scope=params['scope']
+    ))
+
+@api_view(['GET', 'POST'])
+@permission_classes([permissions.IsAdminUser])
+def room_status_view(request, room_id):
+    """
+    GET: the room's current and upcoming closures.
+    POST: change the room's status for a time window ( staff only ), see room_status.transition.
+    Overlapping reservations are cancelled or flagged in the same transaction.
+    """
+    room = get_object_or_404(Room, room_id=room_id)
+    if 'GET' == request.method:
+        closures = room_status.closures(room, timezone.now(), None).order_by('start_time')
+        return Response({
+            "room": room.room_id,
+            "status": room.status,
+            "closures": RoomClosureSerializer(closures, many=True).data,
+        })
+
+    change = RoomStatusChangeSerializer(data=request.data)
+    change.is_valid(raise_exception=True)
+    closure, affected = room_status.transition(room, user=request.user, **change.validated_data)
+    room.refresh_from_db()
+    return Response({
+        "room": room.room_id,
+        "status": room.status,
+        "closure": RoomClosureSerializer(closure).data if closure else None,
+        # cancelled or flagged for a closure, unflagged for a reopening
+        "reservations_affected": affected,
+    }, status=status.HTTP_201_CREATED if closure else status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([permissions.AllowAny])
+@throttle_classes(throttles_for('availability'))
+def availability_heatmap(request):
+    """
+    Free capacity of a room ( ?room=<room_id> ), floor ( ?floor= ) or library ( ?library= ) per day, or per hour
+    with ?resolution=hour, from ?start= to ?end= ( local dates, at most a month ), as one array per measure.
+    No authentication required.
+    """
+    query = HeatmapQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    params = query.validated_data
+    scope = params['scope']
+    if 'room' == scope:
+        room = get_object_or_404(Room.objects.select_related('floor__library'), room_id=params['room'])
+        library, scope_id = room.floor.library, room.pk
+    elif 'floor' == scope:
+        floor = get_object_or_404(Floor.objects.select_related('library'), pk=params['floor'])
+        library, scope_id = floor.library, floor.pk
+    else:
+        library = get_object_or_404(Library, pk=params['library'])
+        scope_id = library.pk
+
+    start = params.get('start') or calendar.local_date(library, timezone.now())
+    end = params.get('end') or start + timedelta(days=6)
+    if end < start or (end - start).days >= settings.HEATMAP_MAX_DAYS:
+        return Response(
+            {"error": f"end must be within {settings.HEATMAP_MAX_DAYS} days after start."},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    return Response(heatmap.heatmap(library, scope, scope_id, start, end, params['resolution']))
+
+@api_view(['GET'])
+@permission_classes([permissions.AllowAny])
+@throttle_classes(throttles_for('search'))
+def typeahead_search(request):
+    """
+    Libraries, floors and rooms matching ?q= ( at least 2 characters, typos tolerated where pg_trgm is installed ),
+    best first. ?kinds=library,floor,room narrows the result, ?limit= caps each kind ( default 5, at most 20 ).
+    """
+    query = SearchQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    params = query.validated_data
+    return Response(search.typeahead(params['q'], kinds=params['kinds'], limit=params['limit']))
+
+@api_view(['POST'])
+@permission_classes([permissions.AllowAny])
+def batch_view(request):
+    """
+    Several GETs of rooms/ API routes in one round trip, run concurrently with this request's authentication.
+    Body: {"requests": [{"id": "...", "path": "/rooms/...", "params": {...}}, ...]}, answered with
+    {"responses": [{"id", "status", "headers", "body"}, ...]} in the same order, see batch.py.
+    """
+    serializer = BatchSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    return Response({"responses": batch.run(request, serializer.validated_data['requests'])})
+
+def conflict_response(conflict):
+    """ 409 response for a ReservationConflict, with suggestions the client can offer instead. """
+    return Response({
+        "error": str(conflict),
+        "suggestions": suggestions.suggest(conflict.room, conflict.start_time, conflict.end_time),
+    }, status=status.HTTP_409_CONFLICT)
+
+def open_hours(library, start, end):
+    """ The library's open intervals within [start, end), for responses. """
+    return [
+        {"start_time": window_start, "end_time": window_end}
+        for window_start, window_end in calendar.open_windows(library, start, end)
+    ]
+
+def closed_response(closed):
+    """ 400 response for a booking outside library hours, with the hours of that day. """
+    day_start, day_end = calendar.local_day_bounds(
+        closed.library, calendar.local_date(closed.library, closed.start_time))
+    return Response({
+        "error": str(closed),
+        "open_hours": open_hours(closed.library, day_start, day_end),
+    }, status=status.HTTP_400_BAD_REQUEST)
+
+def unavailable_response(unavailable):
+    """ 409 response for a booking while the room is closed, with when it reopens and suggestions. """
+    return Response({
+        "error": str(unavailable),
+        "room_status": unavailable.closure.status,
+        "available_from": unavailable.closure.end_time,
+        "suggestions": suggestions.suggest(unavailable.room, unavailable.start_time, unavailable.end_time),
+    }, status=status.HTTP_409_CONFLICT)
+
+def quota_response(exceeded):
+    """ 403 response for a booking that would exceed the user's quota. """
+    return Response({
+        "error": str(exceeded),
+        "limit": exceeded.limit,
+    }, status=status.HTTP_403_FORBIDDEN)
+
 # Reservation management (requires authentication)
 class ReservationViewSet(viewsets.ModelViewSet):
     """
@@ -106,7 +333,14 @@ class ReservationViewSet(viewsets.ModelViewSet):
     queryset = Reservation.objects.all()
     serializer_class = ReservationSerializer
     permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = throttles_for('booking')
     
+    def get_throttles(self):
+        # only writes draw from the booking buckets
+        if self.request.method in permissions.SAFE_METHODS:
+            return []
+        return super().get_throttles()
+
     def get_queryset(self):
         # Regular users see only their own reservations
         if not self.request.user.is_staff:
@@ -114,9 +348,111 @@ class ReservationViewSet(viewsets.ModelViewSet):
         # Staff can see all reservations
         return Reservation.objects.all()
     
+    # create, update ( and partial_update, which calls update ) and cancel honour Idempotency-Key
+    # every write waits for a booking slot first, see throttling.py
+    @admission_controlled
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        try:
+            return super().create(request, *args, **kwargs)
+        except ReservationConflict as conflict:
+            return conflict_response(conflict)
+        except QuotaExceeded as exceeded:
+            return quota_response(exceeded)
+        except LibraryClosed as closed:
+            return closed_response(closed)
+        except RoomUnavailable as unavailable:
+            return unavailable_response(unavailable)
+
+    @admission_controlled
+    @idempotent
+    def update(self, request, *args, **kwargs):
+        try:
+            return super().update(request, *args, **kwargs)
+        except ReservationConflict as conflict:
+            return conflict_response(conflict)
+        except QuotaExceeded as exceeded:
+            return quota_response(exceeded)
+        except LibraryClosed as closed:
+            return closed_response(closed)
+        except RoomUnavailable as unavailable:
+            return unavailable_response(unavailable)
+
+    def perform_create(self, serializer):
+        save_reservation(serializer, user=self.request.user)
+
+    def perform_update(self, serializer):
+        save_reservation(serializer)
+
+    @admission_controlled
+    def destroy(self, request, *args, **kwargs):
+        return super().destroy(request, *args, **kwargs)
+
+    def perform_destroy(self, instance):
+        delete_reservation(instance)
+
+    @action(detail=True, methods=['post'])
+    @admission_controlled
+    @idempotent
+    def cancel(self, request, pk=None):
+        """ Cancel the reservation, the freed slot is offered to the waitlist. """
+        reservation = cancel_reservation(self.get_object())
+        return Response(self.get_serializer(reservation).data)
+
+
+class WaitlistEntryViewSet(mixins.CreateModelMixin,
+                           mixins.ListModelMixin,
+                           mixins.RetrieveModelMixin,
+                           mixins.DestroyModelMixin,
+                           viewsets.GenericViewSet):
+    """
+    API endpoint for joining and leaving the waitlist of a room or floor.
+    When a matching slot frees up the user gets a pending hold to accept before hold_expires_at.
+    """
+    queryset = WaitlistEntry.objects.all()
+    serializer_class = WaitlistEntrySerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return WaitlistEntry.objects.filter(user=self.request.user).select_related('room')
+
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    def perform_destroy(self, instance):
+        waitlist.withdraw(instance)
+
+    @action(detail=True, methods=['post'], throttle_classes=throttles_for('booking'))
+    @admission_controlled
+    def accept(self, request, pk=None):
+        """ Confirm the hold offered to this entry. """
+        entry = self.get_object()
+        if not waitlist.accept_hold(entry):
+            return Response(
+                {"error": "There is no open hold for this waitlist entry."},
+                status=status.HTTP_409_CONFLICT
+            )
+        entry.refresh_from_db()
+        return Response(self.get_serializer(entry).data)
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([permissions.IsAuthenticated])
+def calendar_feed_token(request):
+    """
+    GET: the URL of the user's iCal feed ( created on first use ), plus the room feed URL pattern for staff.
+    POST: replace the token, URLs handed out before stop working.
+    """
+    if 'POST' == request.method:
+        feed, _ = CalendarFeedToken.objects.update_or_create(user=request.user, defaults={'token': new_feed_token()})
+    else:
+        feed, _ = CalendarFeedToken.objects.get_or_create(user=request.user)
+    data = {"url": request.build_absolute_uri(reverse('user-calendar-feed', args=[feed.token]))}
+    if request.user.is_staff:
+        data["room_url"] = request.build_absolute_uri(
+            reverse('room-calendar-feed', args=[feed.token, 'ROOM_ID'])).replace('ROOM_ID', '{room_id}')
+    return Response(data)
+
 
 class MaterialViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = MaterialSerializer
@@ -127,6 +463,106 @@ class MaterialViewSet(viewsets.ReadOnlyModelViewSet):
 
 
 
+# Bulk import/export (staff only)
+# the file type is passed as 'file_format', DRF reserves 'format' for content negotiation
+BULK_CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def bulk_export(request, kind):
+    """
+    Stream every record of one kind as CSV or JSON lines.
+    Rows are read through a server-side cursor, so memory use does not grow with the table.
+    """
+    fmt = request.query_params.get('file_format', 'csv')
+    if kind not in bulk.KINDS or fmt not in bulk.FORMATS:
+        return Response(
+            {"error": f"Use one of {', '.join(bulk.KINDS)} as csv or jsonl."},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    response = StreamingHttpResponse(bulk.stream_records(kind, fmt), content_type=BULK_CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = f'attachment; filename="{kind}.{fmt}"'
+    return response
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAdminUser])
+def bulk_import(request, kind):
+    """
+    Load an uploaded CSV or JSON lines file ('file') of one kind.
+    Rooms are upserted by room_id, upcoming reservations get the same checks as Reservation.clean().
+    """
+    upload = request.FILES.get('file')
+    fmt = request.data.get('file_format') or (upload and bulk.format_from_name(upload.name))
+    if kind not in bulk.KINDS or fmt not in bulk.FORMATS or upload is None:
+        return Response(
+            {"error": f"Upload a 'file' of {', '.join(bulk.KINDS)} as csv or jsonl."},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    stream = io.TextIOWrapper(upload.file, encoding='utf-8', newline='')
+    result = bulk.import_records(kind, bulk.read_records(stream, fmt))
+    return Response(result.as_dict())
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def throttling_metrics(request):
+    """
+    Requests rejected by each rate limit, and booking writes admitted, queued, timed out or shed,
+    counted by this worker process since it started.
+    """
+    return Response(throttling.metrics_snapshot())
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def outbox_metrics(request):
+    """
+    Outbox backlog ( due, scheduled for later, failed ), lag of the oldest due event and
+    events processed per second over the last minute, across every worker.
+    """
+    return Response(outbox.stats())
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def profile_list(request):
+    """
+    The slowest of the requests this worker process profiled recently ( ?limit=, default 20 ), slowest first.
+    Profiling is off unless PROFILING_ENABLED, see profiling.py.
+    """
+    try:
+        limit = max(1, int(request.query_params.get('limit', 20)))
+    except ValueError:
+        return Response({"error": "limit must be a number."}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({
+        "enabled": settings.PROFILING_ENABLED,
+        "sample_rate": settings.PROFILING_SAMPLE_RATE,
+        "profiles": [profile.summary() for profile in profiling.recent.slowest(limit)],
+    })
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def profile_detail(request, profile_id):
+    """
+    One profile with its SQL, or ?download=speedscope ( JSON for speedscope.app ) or
+    ?download=collapsed ( collapsed stacks for flamegraph tools ).
+    """
+    profile = profiling.recent.get(profile_id)
+    if profile is None:
+        return Response({"error": "No such profile, it may have been dropped from the buffer."},
+                        status=status.HTTP_404_NOT_FOUND)
+    download = request.query_params.get('download')
+    if 'speedscope' == download:
+        response = JsonResponse(profile.speedscope())
+        response['Content-Disposition'] = f'attachment; filename="profile-{profile.id}.speedscope.json"'
+        return response
+    if 'collapsed' == download:
+        response = HttpResponse(profile.collapsed(), content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="profile-{profile.id}.folded"'
+        return response
+    return Response(profile.detail())
+
 
 def demo_view(request):
     # get counts of each model
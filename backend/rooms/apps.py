@@ -7,3 +7,7 @@ from django.apps import AppConfig
 class RoomsConfig( AppConfig ):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'rooms'
+
+    def ready( self ):
+        # registers the outbox handlers
+        from . import events, waitlist  # noqa: F401
@@ -0,0 +1,137 @@
+# Purpose: Run ORM-built read queries on an async PostgreSQL connection pool
+
+import asyncio
+import contextlib
+import contextvars
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+try:
+    from psycopg import AsyncClientCursor
+    from psycopg.conninfo import make_conninfo
+    from psycopg_pool import AsyncConnectionPool
+except ImportError:  # psycopg 3 not installed, fall back to Django's async ORM
+    AsyncConnectionPool = None
+
+"""
+Django 5.0's async ORM ( aget(), async for ... ) still runs every query through sync_to_async
+on a thread, so an async view that touches the database is no more concurrent than a sync one
+
+The read-only endpoints in async_views.py instead let the ORM build the SQL and execute it on
+a psycopg 3 AsyncConnectionPool, so hundreds of in-flight requests share one worker's event loop
+and ASYNC_DB_POOL_SIZE connections
+Without psycopg 3 ( or with ASYNC_DB_POOL_SIZE = 0 ) the same calls go through the async ORM
+
+A pool belongs to an event loop and lives as long as it does, one per worker process when the app is
+served by an ASGI server ( backend.asgi ). Behind WSGI Django runs every async view on a new event loop
+( async_to_sync ) that ends with the request, a pool opened there would leak its connections, so such
+requests go through the async ORM ( Django's own, persistent connection ) instead, see without_pool()
+
+Pool connections get the adapters and time zone Django sets up on its own connections ( timestamptz
+in USE_TZ's time zone, jsonb and inet as text ), so rows read either way look the same
+"""
+
+_pools = {}
+
+# off while serving a request whose event loop ends with it
+_pool_allowed = contextvars.ContextVar( 'async_db_pool_allowed', default=True )
+
+
+def _conninfo( alias=DEFAULT_DB_ALIAS ):
+    params = connections[ alias ].get_connection_params()
+    # Django specific options psycopg does not understand
+    for option in ( 'cursor_factory', 'context', 'prepare_threshold', 'server_side_binding' ):
+        params.pop( option, None )
+    return make_conninfo( **{ key: value for key, value in params.items() if value not in ( None, '' ) } )
+
+
+async def _configure( pool_connection ):
+    # what DatabaseWrapper.ensure_timezone() does for Django's connections
+    timezone_name = connections[ DEFAULT_DB_ALIAS ].timezone_name
+    if timezone_name and pool_connection.info.parameter_status( 'TimeZone' ) != timezone_name:
+        await pool_connection.execute( "SELECT set_config( 'TimeZone', %s, false )", [ timezone_name ] )
+
+
+async def _pool():
+    # a pool belongs to the event loop that opened it
+    loop = asyncio.get_running_loop()
+    pool = _pools.get( loop )
+    if pool is None:
+        kwargs = { 'autocommit': True, 'cursor_factory': AsyncClientCursor }
+        # Django's adapters ( psycopg 3 only, which the pool needs anyway )
+        context = connections[ DEFAULT_DB_ALIAS ].get_connection_params().get( 'context' )
+        if context is not None:
+            kwargs[ 'context' ] = context
+        pool = AsyncConnectionPool(
+            _conninfo(),
+            min_size=1,
+            max_size=settings.ASYNC_DB_POOL_SIZE,
+            kwargs=kwargs,
+            configure=_configure,
+            open=False,
+        )
+        _pools[ loop ] = pool
+        await pool.open()
+    return pool
+
+
+@contextlib.contextmanager
+def without_pool():
+    """ Run the reads inside on the async ORM, for code on an event loop that ends with the request. """
+    token = _pool_allowed.set( False )
+    try:
+        yield
+    finally:
+        _pool_allowed.reset( token )
+
+
+def _enabled():
+    return (
+        AsyncConnectionPool is not None
+        and getattr( settings, 'ASYNC_DB_POOL_SIZE', 0 ) > 0
+        and _pool_allowed.get()
+    )
+
+
+def _column_names( queryset ):
+    query = queryset.query
+    return list( query.values_select ) + list( query.annotation_select )
+
+
+async def fetch( queryset ):
+    """ Rows of a values() queryset as a list of dicts. """
+    if not _enabled():
+        return [ row async for row in queryset ]
+    names = _column_names( queryset )
+    sql, params = queryset.query.get_compiler( using=queryset.db ).as_sql()
+    pool = await _pool()
+    async with pool.connection() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute( sql, params )
+            rows = await cursor.fetchall()
+    return [ dict( zip( names, row ) ) for row in rows ]
+
+
+async def fetch_first( queryset ):
+    rows = await fetch( queryset[ :1 ] )
+    return rows[ 0 ] if rows else None
+
+
+async def count( queryset ):
+    if not _enabled():
+        return await queryset.acount()
+    sql, params = queryset.order_by().values( 'pk' ).query.get_compiler( using=queryset.db ).as_sql()
+    pool = await _pool()
+    async with pool.connection() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute( f"SELECT COUNT(*) FROM ({sql}) AS counted", params )
+            row = await cursor.fetchone()
+    return row[ 0 ]
+
+
+async def close_pool():
+    """ Close the running event loop's pool, for loops that end before the process does. """
+    pool = _pools.pop( asyncio.get_running_loop(), None )
+    if pool is not None:
+        await pool.close()
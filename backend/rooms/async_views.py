@@ -0,0 +1,209 @@
+# Purpose: ASGI-native read endpoints for the catalog, room search and availability
+
+import functools
+from datetime import datetime
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.exceptions import Throttled
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from . import async_db, calendar, throttling
+from .models import Library, Floor, Room, Reservation, OpenInterval
+
+"""
+Async ( ASGI-native ) versions of the read-only catalog, search and availability endpoints
+They return the same JSON as the DRF views in api_views.py, but never block a thread
+on the database, see async_db.py
+DRF 3.14 has no async views, so these are plain Django views
+They only share the connection pool of their worker when served by an ASGI server, behind WSGI
+every request runs on an event loop of its own ( see async_db.py )
+"""
+
+_datetime = serializers.DateTimeField()
+_time = serializers.TimeField()
+
+LIBRARY_FIELDS = ( 'id', 'name', 'location', 'description', 'opening_time', 'closing_time', 'time_zone' )
+FLOOR_FIELDS = ( 'id', 'library', 'number', 'description', 'floor_map', 'layout_version' )
+ROOM_FIELDS = (
+    'room_id', 'floor', 'floor__library__name', 'floor__number', 'capacity',
+    'has_whiteboard', 'has_monitor', 'has_window', 'status',
+    'position_x', 'position_y', 'width', 'height'
+)
+RESERVATION_FIELDS = (
+    'reservation_id', 'room', 'room__room_id', 'user', 'user__username',
+    'start_time', 'end_time', 'status', 'purpose', 'num_attendees', 'notes', 'closure', 'created_at', 'modified_at'
+)
+
+AMENITY_PARAMS = ( 'has_whiteboard', 'has_monitor', 'has_window' )
+
+
+def _library( row ):
+    row[ 'opening_time' ] = _time.to_representation( row[ 'opening_time' ] )
+    row[ 'closing_time' ] = _time.to_representation( row[ 'closing_time' ] )
+    return row
+
+
+def _room( row ):
+    row[ 'library_name' ] = row.pop( 'floor__library__name' )
+    row[ 'floor_number' ] = row.pop( 'floor__number' )
+    return row
+
+
+def _reservation( row ):
+    row[ 'reservation_id' ] = str( row[ 'reservation_id' ] )
+    row[ 'room_id' ] = row.pop( 'room__room_id' )
+    row[ 'username' ] = row.pop( 'user__username' )
+    for name in ( 'start_time', 'end_time', 'created_at', 'modified_at' ):
+        row[ name ] = _datetime.to_representation( row[ name ] )
+    return row
+
+
+def _read_view( view ):
+    """ Keep requests served over WSGI off the connection pool, their event loop ends with them. """
+    @functools.wraps( view )
+    async def wrapper( request, *args, **kwargs ):
+        if isinstance( request, ASGIRequest ):
+            return await view( request, *args, **kwargs )
+        with async_db.without_pool():
+            return await view( request, *args, **kwargs )
+    return wrapper
+
+
+def _bad_request( message ):
+    return JsonResponse( { "error": message }, status=400 )
+
+
+async def _page( request, queryset, fields, represent ):
+    """ Page through a queryset with the same response shape as DRF's PageNumberPagination. """
+    page_size = settings.REST_FRAMEWORK[ 'PAGE_SIZE' ]
+    try:
+        page = int( request.GET.get( 'page', 1 ) )
+    except ValueError:
+        page = 0
+    total = await async_db.count( queryset )
+    last_page = max( ( total + page_size - 1 ) // page_size, 1 )
+    if page < 1 or page > last_page:
+        return JsonResponse( { "detail": "Invalid page." }, status=404 )
+
+    offset = ( page - 1 ) * page_size
+    rows = await async_db.fetch( queryset.values( *fields )[ offset:offset + page_size ] )
+    url = request.build_absolute_uri()
+    previous_url = None
+    if page > 1:
+        previous_url = remove_query_param( url, 'page' ) if 2 == page else replace_query_param( url, 'page', page - 1 )
+    return JsonResponse( {
+        "count": total,
+        "next": replace_query_param( url, 'page', page + 1 ) if page < last_page else None,
+        "previous": previous_url,
+        "results": [ represent( row ) for row in rows ],
+    } )
+
+
+@_read_view
+async def library_list( request ):
+    """ Async equivalent of GET libraries/. """
+    return await _page( request, Library.objects.all(), LIBRARY_FIELDS, _library )
+
+
+@_read_view
+async def floor_list( request ):
+    """ Async equivalent of GET floors/ ( ?library= ). """
+    queryset = Floor.objects.all()
+    library_id = request.GET.get( 'library' )
+    if library_id is not None:
+        if not library_id.isdigit():
+            return _bad_request( "library must be an id." )
+        queryset = queryset.filter( library_id=library_id )
+    return await _page( request, queryset, FLOOR_FIELDS, dict )
+
+
+@_read_view
+async def room_search( request ):
+    """
+    Async equivalent of GET rooms/ ( ?floor=, ?status= ) with extra search filters:
+    ?library=, ?min_capacity= and ?has_whiteboard= / ?has_monitor= / ?has_window= ( true / false ).
+    """
+    queryset = Room.objects.all()
+    filters = {}
+    for param, lookup in ( ( 'floor', 'floor_id' ), ( 'library', 'floor__library_id' ),
+                           ( 'min_capacity', 'capacity__gte' ) ):
+        value = request.GET.get( param )
+        if value is not None:
+            if not value.isdigit():
+                return _bad_request( f"{param} must be a whole number." )
+            filters[ lookup ] = int( value )
+    for param in AMENITY_PARAMS:
+        value = request.GET.get( param )
+        if value is not None:
+            filters[ param ] = value.lower() in ( 'true', '1', 'yes' )
+    if request.GET.get( 'status' ) is not None:
+        filters[ 'status' ] = request.GET[ 'status' ]
+    return await _page( request, queryset.filter( **filters ), ROOM_FIELDS, _room )
+
+
+async def _open_hours( library, start, end ):
+    if library.calendar_until is None or library.calendar_until < end:
+        # past the materialized calendar, expanded from the library's schedules
+        windows = await sync_to_async( calendar.open_windows )( await Library.objects.aget( pk=library.pk ), start, end )
+    else:
+        windows = [
+            ( max( row[ 'start_time' ], start ), min( row[ 'end_time' ], end ) )
+            for row in await async_db.fetch( OpenInterval.objects.filter(
+                library_id=library.pk, end_time__gt=start, start_time__lt=end
+            ).order_by( 'start_time' ).values( 'start_time', 'end_time' ) )
+        ]
+    return [
+        {
+            "start_time": _datetime.to_representation( window_start ),
+            "end_time": _datetime.to_representation( window_end ),
+        }
+        for window_start, window_end in windows
+    ]
+
+
+@_read_view
+async def room_availability( request, room_id ):
+    """ Async equivalent of GET rooms/<room_id>/availability/ ( ?date=YYYY-MM-DD ). """
+    # same buckets as the sync view
+    wait = await throttling.aanonymous_wait( 'availability', request )
+    if wait:
+        throttled = Throttled( wait=wait )
+        return JsonResponse( { "detail": throttled.detail }, status=429, headers={ 'Retry-After': str( throttled.wait ) } )
+    room = await async_db.fetch_first( Room.objects.filter( room_id=room_id ).values(
+        'pk', 'room_id', 'status', 'floor__library_id', 'floor__library__time_zone', 'floor__library__calendar_until'
+    ) )
+    if room is None:
+        return JsonResponse( { "detail": "Not found." }, status=404 )
+    # only what the calendar helpers read
+    library = Library( pk=room[ 'floor__library_id' ], time_zone=room[ 'floor__library__time_zone' ],
+                       calendar_until=room[ 'floor__library__calendar_until' ] )
+
+    date_param = request.GET.get( 'date' )
+    if date_param:
+        try:
+            date = datetime.strptime( date_param, '%Y-%m-%d' ).date()
+        except ValueError:
+            return _bad_request( "Invalid date format. Use YYYY-MM-DD." )
+    else:
+        date = calendar.local_date( library, timezone.now() )
+    day_start, day_end = calendar.local_day_bounds( library, date )
+
+    reservations = await async_db.fetch( Reservation.objects.filter(
+        room_id=room[ 'pk' ],
+        start_time__gte=day_start,
+        start_time__lt=day_end,
+        status__in=Reservation.ACTIVE_STATUSES,
+    ).order_by( 'start_time' ).values( *RESERVATION_FIELDS ) )
+
+    return JsonResponse( {
+        "room": room[ 'room_id' ],
+        "date": date,
+        "is_available": 'available' == room[ 'status' ],
+        "open_hours": await _open_hours( library, day_start, day_end ),
+        "reservations": [ _reservation( row ) for row in reservations ],
+    } )
@@ -0,0 +1,187 @@
+# Purpose: Run several API reads from one HTTP request ( POST rooms/batch/ )
+
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied, SuspiciousOperation
+from django.db import close_old_connections, connection
+from django.http import Http404, HttpRequest, QueryDict
+from django.urls import Resolver404, resolve
+from rest_framework.views import APIView
+
+"""
+A screen of the client often needs a handful of independent reads ( libraries, floors, rooms,
+several availability checks ). On a campus network each one costs a round trip, so
+    POST rooms/batch/   { "requests": [ { "id": "rooms", "path": "/rooms/rooms/", "params": { "floor": 3 } }, ... ] }
+runs them in this process and answers
+    { "responses": [ { "id": "rooms", "status": 200, "headers": { ... }, "body": ... }, ... ] }
+in request order, one status per sub-request ( a failing sub-request never fails the batch )
+
+Sub-requests
+    are GETs of the DRF views under BATCH_PATH_PREFIX ( rooms/urls.py ), other methods get 405
+    and other routes ( the async/ views, feeds, the batch endpoint itself, the bulk/ routes ) 400,
+    as do views that answer with a streaming or file response, their body is never buffered here
+    share the batch's authentication, the user is authenticated once and forced into every
+    sub-request, permissions and throttles still apply per sub-request as if sent one by one
+    run at once on a pool of BATCH_WORKERS threads ( each with its own database connection ),
+    reads do not depend on each other, so their order does not matter
+At most BATCH_MAX_REQUESTS sub-requests per batch
+"""
+
+logger = logging.getLogger( __name__ )
+
+BATCH_PATH_PREFIX = '/rooms/'
+
+# request headers that describe the batch's body or carry its credentials, not the sub-request's,
+# and conditional headers, which were meant for the batch ( a sub-request would answer 304 or 412 to them )
+DROPPED_META = (
+    'CONTENT_LENGTH', 'CONTENT_TYPE', 'HTTP_AUTHORIZATION', 'HTTP_COOKIE', 'wsgi.input',
+    'HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_MATCH', 'HTTP_IF_UNMODIFIED_SINCE',
+)
+
+# sub-response headers passed back to the client
+RESPONSE_HEADERS = ( 'ETag', 'Last-Modified', 'Retry-After', 'Allow' )
+
+# DRF views that are not batchable reads, by url name ( bulk exports stream whole tables )
+UNBATCHED_ROUTES = ( 'batch', 'bulk-export', 'bulk-import' )
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class BatchError( Exception ):
+    """ A sub-request that cannot be run, answered with `status` and `detail` instead. """
+
+    def __init__( self, status, detail ):
+        super().__init__( detail )
+        self.status = status
+        self.detail = detail
+
+
+class SubRequest( HttpRequest ):
+    """ A GET of `path` carrying the batch request's host, client address and user. """
+
+    def __init__( self, parent, path, query ):
+        super().__init__()
+        self.parent = parent
+        self.method = 'GET'
+        self.path = self.path_info = path
+        self.GET = query
+        self.META = { key: value for key, value in parent.META.items() if key not in DROPPED_META }
+        self.META.update( {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path,
+            'QUERY_STRING': query.urlencode(),
+            'HTTP_ACCEPT': 'application/json',
+        } )
+
+    def _get_scheme( self ):
+        return self.parent._get_scheme()
+
+
+def _executor_pool():
+    global _executor
+    # the first batches of a process can arrive at once, only one of them may start the pool
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor( max_workers=settings.BATCH_WORKERS, thread_name_prefix='batch' )
+        return _executor
+
+
+def _view( path ):
+    """ The resolved DRF view for `path`, BatchError for anything that is not a batchable read. """
+    if not path.startswith( BATCH_PATH_PREFIX ):
+        raise BatchError( 400, f"Only {BATCH_PATH_PREFIX} routes can be batched." )
+    try:
+        match = resolve( path )
+    except Resolver404:
+        raise BatchError( 404, "Not found." )
+    view_class = getattr( match.func, 'cls', None )
+    # async views and plain Django views ( feeds ) keep their own request handling
+    if view_class is None or not issubclass( view_class, APIView ) or match.url_name in UNBATCHED_ROUTES:
+        raise BatchError( 400, f"{path} cannot be batched." )
+    return match
+
+
+def _query( url, params ):
+    query = QueryDict( urlsplit( url ).query, mutable=True )
+    for name, value in ( params or {} ).items():
+        values = value if isinstance( value, list ) else [ value ]
+        query.setlist( name, [ str( item ).lower() if isinstance( item, bool ) else str( item ) for item in values ] )
+    return query
+
+
+def _body( response ):
+    if hasattr( response, 'data' ):
+        # a DRF Response, its data is rendered once, as part of the batch
+        return response.data
+    content = response.content
+    if not content:
+        return None
+    if response.get( 'Content-Type', '' ).startswith( 'application/json' ):
+        return json.loads( content )
+    return content.decode( response.charset )
+
+
+def _run( request, spec ):
+    """ Run one sub-request, returns ( status, headers, body ). """
+    if 'GET' != spec[ 'method' ]:
+        raise BatchError( 405, "Only GET requests can be batched." )
+    path = urlsplit( spec[ 'path' ] ).path
+    match = _view( path )
+
+    sub = SubRequest( request._request, path, _query( spec[ 'path' ], spec.get( 'params' ) ) )
+    sub.resolver_match = match
+    sub.user = request.user
+    # DRF authenticates the sub-request as the batch's user without repeating the JWT / session lookup
+    sub._force_auth_user = request.user if request.user.is_authenticated else None
+    sub._force_auth_token = request.auth
+
+    try:
+        response = match.func( sub, *match.args, **match.kwargs )
+    except Http404:
+        raise BatchError( 404, "Not found." )
+    except PermissionDenied:
+        raise BatchError( 403, "You do not have permission to perform this action." )
+    except SuspiciousOperation:
+        raise BatchError( 400, "Bad request." )
+    if response.streaming:
+        # StreamingHttpResponse / FileResponse, the batch answer would hold all of it in memory
+        response.close()
+        raise BatchError( 400, f"{path} streams its response and cannot be batched." )
+    headers = { name: response[ name ] for name in RESPONSE_HEADERS if response.has_header( name ) }
+    return response.status_code, headers, _body( response )
+
+
+def _answer( request, spec ):
+    try:
+        status, headers, body = _run( request, spec )
+    except BatchError as error:
+        status, headers, body = error.status, {}, { 'detail': error.detail }
+    except Exception:
+        logger.exception( "Batched request %s failed", spec[ 'path' ] )
+        status, headers, body = 500, {}, { 'detail': "Server error." }
+    return { 'id': spec[ 'id' ], 'status': status, 'headers': headers, 'body': body }
+
+
+def _answer_in_worker( request, spec ):
+    # pool threads own their connection, treated like one request each ( CONN_MAX_AGE applies )
+    close_old_connections()
+    try:
+        return _answer( request, spec )
+    finally:
+        close_old_connections()
+
+
+def run( request, specs ):
+    """ Answers to the validated sub-requests `specs` of a DRF request, in order. """
+    if len( specs ) < 2 or settings.BATCH_WORKERS < 2:
+        return [ _answer( request, spec ) for spec in specs ]
+    # inside a transaction the pool's connections would not see its writes, keep everything on this one
+    if connection.in_atomic_block:
+        return [ _answer( request, spec ) for spec in specs ]
+    return list( _executor_pool().map( lambda spec: _answer_in_worker( request, spec ), specs ) )
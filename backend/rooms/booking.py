@@ -0,0 +1,115 @@
+# Purpose: Create and update reservations without double booking a room
+
+from django.db import transaction
+
+from .models import Room, Reservation
+from . import calendar, events, quotas, room_status, waitlist
+
+"""
+Every write that can make a reservation hold a room goes through save_reservation()
+The room row is locked with SELECT ... FOR UPDATE before the overlap check, so two
+requests for the same room are serialized and the second one sees the first one's insert
+Every change also records its outbox events ( events.py ) in the same transaction
+"""
+
+CONFLICT_MESSAGE = "This room is already reserved during the selected time period."
+
+
+class ReservationConflict( Exception ):
+    """ Raised when a reservation would overlap an active reservation of the same room. """
+
+    def __init__( self, room, start_time, end_time ):
+        super().__init__( CONFLICT_MESSAGE )
+        self.room = room
+        self.start_time = start_time
+        self.end_time = end_time
+
+
+def conflicting_reservations( room, start_time, end_time, exclude=None ):
+    """ Active reservations of `room` overlapping [start_time, end_time). """
+    conflicts = Reservation.objects.filter(
+        room=room,
+        status__in=Reservation.ACTIVE_STATUSES,
+        start_time__lt=end_time,
+        end_time__gt=start_time,
+    )
+    if exclude is not None:
+        conflicts = conflicts.exclude( pk=exclude.pk )
+    return conflicts
+
+
+def save_reservation( serializer, **kwargs ):
+    """
+    Save a ReservationSerializer ( create or update ) after checking for overlaps under a room lock.
+    Raises room_status.RoomUnavailable when the room is closed or under maintenance for part of it,
+    calendar.LibraryClosed when the library is closed for part of the booking,
+    ReservationConflict instead of saving when the room is already taken, and
+    quotas.QuotaExceeded when the booking would take the user past their limits.
+    """
+    instance = serializer.instance
+    data = serializer.validated_data
+
+    def current( name, default=None ):
+        return data.get( name, getattr( instance, name ) if instance is not None else default )
+
+    room = current( 'room' )
+    start_time = current( 'start_time' )
+    end_time = current( 'end_time' )
+    status = current( 'status', 'pending' )
+
+    # the interval this reservation held before the update, if any
+    freed = None
+    if instance is not None and instance.status in Reservation.ACTIVE_STATUSES:
+        freed = ( instance.room_id, instance.start_time, instance.end_time )
+
+    held = ( room.pk, start_time, end_time ) if status in Reservation.ACTIVE_STATUSES else None
+    previous = events.snapshot( instance ) if instance is not None else None
+
+    with transaction.atomic():
+        if held:
+            # lock order is always room, then library ( only while its calendar is rebuilt ), then user
+            Room.objects.select_for_update().filter( pk=room.pk ).first()
+            if held != freed:
+                room_status.check_room_open( room, start_time, end_time )
+                calendar.check_open( room.floor.library, start_time, end_time )
+            if conflicting_reservations( room, start_time, end_time, exclude=instance ).exists():
+                raise ReservationConflict( room, start_time, end_time )
+            if held != freed:
+                user = kwargs.get( 'user' ) or instance.user
+                quotas.check_quota( user, start_time, end_time, room.floor.library, exclude=instance )
+        reservation = serializer.save( **kwargs )
+        if previous is None:
+            events.reservation_created( reservation )
+        else:
+            events.reservation_changed( reservation, previous )
+        if freed and freed != _held_interval( reservation ):
+            waitlist.schedule_match( *freed )
+    return reservation
+
+
+def _held_interval( reservation ):
+    if reservation.status not in Reservation.ACTIVE_STATUSES:
+        return None
+    return ( reservation.room_id, reservation.start_time, reservation.end_time )
+
+
+def cancel_reservation( reservation ):
+    """ Cancel a reservation and offer the freed slot to the waitlist. """
+    with transaction.atomic():
+        previous = events.snapshot( reservation )
+        was_active = reservation.status in Reservation.ACTIVE_STATUSES
+        reservation.status = 'cancelled'
+        reservation.save( update_fields=[ 'status', 'modified_at' ] )
+        events.reservation_changed( reservation, previous )
+        if was_active:
+            waitlist.schedule_match( reservation.room_id, reservation.start_time, reservation.end_time )
+    return reservation
+
+
+def delete_reservation( reservation ):
+    """ Delete a reservation and offer the freed slot to the waitlist. """
+    with transaction.atomic():
+        if reservation.status in Reservation.ACTIVE_STATUSES:
+            waitlist.schedule_match( reservation.room_id, reservation.start_time, reservation.end_time )
+        events.reservation_deleted( reservation )
+        reservation.delete()
@@ -0,0 +1,520 @@
+# Purpose: Streaming bulk import/export of libraries, floors, rooms and reservations
+
+import bisect
+import csv
+import json
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, time
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_time
+
+from . import calendar, room_status, versions
+from .models import Library, Floor, Room, Reservation, OpenInterval, RoomClosure
+
+"""
+Records move in and out as CSV or JSON lines, one object per row
+Foreign keys are written as natural keys (library name, floor number, room_id, username)
+so a file exported from one deployment can be loaded into another
+
+Imports work in batches: every lookup a batch needs is fetched with one query,
+rows are validated in memory and the survivors are written with bulk_create
+Exports iterate a server-side cursor so memory stays flat no matter how many rows there are
+
+Reservations that are still to come ( pending or confirmed, not ended yet ) get the checks of
+Reservation.clean(): no overlap, room not closed, library open. History is loaded as it was
+"""
+
+FORMATS = ( 'csv', 'jsonl' )
+# file extensions and the format they are read as
+EXTENSIONS = { '.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.json': 'jsonl' }
+DEFAULT_BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 2000
+
+# column layout for each kind of record ( also the export order )
+FIELDS = {
+    'libraries': [ 'name', 'location', 'description', 'opening_time', 'closing_time' ],
+    'floors': [ 'library', 'number', 'description', 'floor_map' ],
+    'rooms': [
+        'room_id', 'library', 'floor', 'capacity', 'has_whiteboard', 'has_monitor', 'has_window',
+        'status', 'position_x', 'position_y', 'width', 'height'
+    ],
+    'reservations': [
+        'reservation_id', 'username', 'room_id', 'start_time', 'end_time', 'status',
+        'purpose', 'num_attendees', 'notes'
+    ],
+}
+
+KINDS = tuple( FIELDS )
+
+# only confirmed reservations block a room, mirroring Reservation.clean()
+BLOCKING_STATUSES = ( 'confirmed', )
+
+
+@dataclass
+class ImportResult:
+    """ Running totals for one import, errors hold ( line number, message ) pairs. """
+    created: int = 0
+    updated: int = 0
+    skipped: int = 0
+    errors: list = field( default_factory=list )
+
+    def error( self, line, message ):
+        self.errors.append( ( line, message ) )
+
+    def as_dict( self, max_errors=100 ):
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'skipped': self.skipped,
+            'error_count': len( self.errors ),
+            'errors': [ { 'line': line, 'error': message } for line, message in sorted( self.errors )[ :max_errors ] ],
+        }
+
+
+# ---------------------------------------------------------------------------
+# reading and writing records
+# ---------------------------------------------------------------------------
+
+def format_from_name( name ):
+    """ The format of a file named `name`, from its extension, None when it cannot be told. """
+    for extension, fmt in EXTENSIONS.items():
+        if name.lower().endswith( extension ):
+            return fmt
+    return None
+
+
+def read_records( stream, fmt ):
+    """ Yield ( line number, dict ) pairs from a text stream of CSV or JSON lines. """
+    if 'csv' == fmt:
+        reader = csv.DictReader( stream )
+        for row in reader:
+            yield reader.line_num, row
+    elif 'jsonl' == fmt:
+        for line_no, line in enumerate( stream, start=1 ):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads( line )
+            except ValueError as exc:
+                yield line_no, exc
+                continue
+            yield line_no, record
+    else:
+        raise ValueError( f"Unsupported format '{fmt}', use one of {', '.join( FORMATS )}." )
+
+
+class _Echo:
+    """ File-like object whose write() returns the value, lets csv.writer feed a generator. """
+    def write( self, value ):
+        return value
+
+
+def _to_text( value ):
+    if value is None:
+        return ''
+    if isinstance( value, ( datetime, time ) ):
+        return value.isoformat()
+    if isinstance( value, ( dict, list ) ):
+        return json.dumps( value )
+    return str( value )
+
+
+def _to_json( value ):
+    if isinstance( value, ( datetime, time ) ):
+        return value.isoformat()
+    if isinstance( value, uuid.UUID ):
+        return str( value )
+    return value
+
+
+def stream_records( kind, fmt, chunk_size=EXPORT_CHUNK_SIZE ):
+    """ Yield the export of `kind` as text chunks, one chunk per row. """
+    columns = FIELDS[ kind ]
+    rows = export_rows( kind, chunk_size=chunk_size )
+    if 'csv' == fmt:
+        writer = csv.writer( _Echo() )
+        yield writer.writerow( columns )
+        for row in rows:
+            yield writer.writerow( [ _to_text( value ) for value in row ] )
+    elif 'jsonl' == fmt:
+        for row in rows:
+            yield json.dumps( { name: _to_json( value ) for name, value in zip( columns, row ) } ) + '\n'
+    else:
+        raise ValueError( f"Unsupported format '{fmt}', use one of {', '.join( FORMATS )}." )
+
+
+def export_rows( kind, chunk_size=EXPORT_CHUNK_SIZE ):
+    """ Iterate the rows of `kind` as tuples in FIELDS order using a server-side cursor. """
+    if 'libraries' == kind:
+        queryset = Library.objects.values_list( *FIELDS[ kind ] )
+    elif 'floors' == kind:
+        queryset = Floor.objects.values_list( 'library__name', 'number', 'description', 'floor_map' )
+    elif 'rooms' == kind:
+        queryset = Room.objects.values_list(
+            'room_id', 'floor__library__name', 'floor__number', 'capacity',
+            'has_whiteboard', 'has_monitor', 'has_window', 'status',
+            'position_x', 'position_y', 'width', 'height'
+        )
+    elif 'reservations' == kind:
+        queryset = Reservation.objects.values_list(
+            'reservation_id', 'user__username', 'room__room_id', 'start_time', 'end_time',
+            'status', 'purpose', 'num_attendees', 'notes'
+        ).order_by( 'start_time' )
+    else:
+        raise ValueError( f"Unknown record kind '{kind}'." )
+
+    # primary key order keeps the cursor on an index, reservations export by start time
+    # so a history file re-imports in compact time windows
+    if 'reservations' != kind:
+        queryset = queryset.order_by( 'pk' )
+
+    # iterator() uses a server-side cursor on PostgreSQL, only chunk_size rows are held at once
+    return queryset.iterator( chunk_size=chunk_size )
+
+
+# ---------------------------------------------------------------------------
+# importing records
+# ---------------------------------------------------------------------------
+
+def import_records( kind, records, batch_size=DEFAULT_BATCH_SIZE ):
+    """
+    Load ( line number, dict ) records of `kind` in batches of `batch_size`.
+    Bad rows are reported in the result and skipped, every batch commits on its own.
+    """
+    if kind not in IMPORTERS:
+        raise ValueError( f"Unknown record kind '{kind}'." )
+    importer = IMPORTERS[ kind ]
+    result = ImportResult()
+    records = iter( records )
+    while True:
+        batch = list( islice( records, batch_size ) )
+        if not batch:
+            break
+
+        rows = []
+        for line_no, record in batch:
+            if isinstance( record, Exception ):
+                result.error( line_no, f"Malformed record: {record}" )
+            elif not isinstance( record, dict ):
+                result.error( line_no, "Each record must be an object." )
+            else:
+                rows.append( ( line_no, record ) )
+
+        with transaction.atomic():
+            importer( rows, result )
+    return result
+
+
+def _value( record, name ):
+    """ Fetch a column, treating CSV empty strings as missing. """
+    value = record.get( name )
+    if isinstance( value, str ):
+        value = value.strip()
+        if '' == value:
+            return None
+    return value
+
+
+def _coerce( model, record, names ):
+    """ Convert raw column values into python values for the given model fields. """
+    values = {}
+    for name in names:
+        model_field = model._meta.get_field( name )
+        raw = _value( record, name )
+        if raw is None:
+            if model_field.has_default():
+                values[ name ] = model_field.get_default()
+            elif model_field.null:
+                values[ name ] = None
+            elif model_field.blank:
+                values[ name ] = ''
+            else:
+                raise ValidationError( f"'{name}' is required." )
+            continue
+
+        if 'DateTimeField' == model_field.get_internal_type():
+            parsed = raw if isinstance( raw, datetime ) else parse_datetime( str( raw ) )
+            if parsed is None:
+                raise ValidationError( f"'{name}' is not a valid ISO 8601 datetime." )
+            if timezone.is_naive( parsed ):
+                parsed = timezone.make_aware( parsed )
+            values[ name ] = parsed
+        elif 'TimeField' == model_field.get_internal_type():
+            parsed = raw if isinstance( raw, time ) else parse_time( str( raw ) )
+            if parsed is None:
+                raise ValidationError( f"'{name}' is not a valid time." )
+            values[ name ] = parsed
+        elif 'BooleanField' == model_field.get_internal_type() and isinstance( raw, str ):
+            values[ name ] = raw.lower() in ( 'true', 't', '1', 'yes', 'y' )
+        elif 'JSONField' == model_field.get_internal_type() and isinstance( raw, str ):
+            try:
+                values[ name ] = json.loads( raw )
+            except ValueError:
+                raise ValidationError( f"'{name}' is not valid JSON." )
+        else:
+            values[ name ] = model_field.to_python( raw )
+    return values
+
+
+def _message( exc ):
+    if isinstance( exc, ValidationError ):
+        if hasattr( exc, 'error_dict' ):
+            return '; '.join( f"{key}: {' '.join( msgs )}" for key, msgs in exc.message_dict.items() )
+        return ' '.join( exc.messages )
+    return str( exc )
+
+
+def _import_libraries( rows, result ):
+    # Library has no unique key of its own, rows are matched to existing libraries by name
+    names = { _value( record, 'name' ) for _, record in rows }
+    existing = {}
+    for library in Library.objects.filter( name__in=names ):
+        existing.setdefault( library.name, library )
+
+    columns = FIELDS[ 'libraries' ]
+    to_create, to_update = {}, {}
+    for line_no, record in rows:
+        try:
+            values = _coerce( Library, record, columns )
+            library = existing.get( values[ 'name' ] ) or to_create.get( values[ 'name' ] ) or Library()
+            for name, value in values.items():
+                setattr( library, name, value )
+            library.clean_fields()
+        except ( ValidationError, ValueError, TypeError ) as exc:
+            result.error( line_no, _message( exc ) )
+            continue
+        if library.pk:
+            to_update[ library.pk ] = library
+        else:
+            to_create[ library.name ] = library
+
+    Library.objects.bulk_create( to_create.values() )
+    Library.objects.bulk_update( to_update.values(), [ name for name in columns if 'name' != name ] )
+    # bulk_create and bulk_update skip save()
+    versions.bump_catalog()
+    result.created += len( to_create )
+    result.updated += len( to_update )
+
+
+def _import_floors( rows, result ):
+    libraries = { _value( record, 'library' ) for _, record in rows }
+    library_ids = dict( Library.objects.filter( name__in=libraries ).values_list( 'name', 'pk' ) )
+    existing = set( Floor.objects.filter( library_id__in=library_ids.values() )
+                    .values_list( 'library_id', 'number' ) )
+
+    floors = {}
+    for line_no, record in rows:
+        try:
+            library_name = _value( record, 'library' )
+            if library_name not in library_ids:
+                raise ValidationError( f"Unknown library '{library_name}'." )
+            values = _coerce( Floor, record, [ 'number', 'description', 'floor_map' ] )
+            floor = Floor( library_id=library_ids[ library_name ], **values )
+            floor.clean_fields( exclude=[ 'library' ] )
+        except ( ValidationError, ValueError, TypeError ) as exc:
+            result.error( line_no, _message( exc ) )
+            continue
+        # a later row for the same floor wins, Postgres refuses to upsert one key twice per statement
+        floors[ ( floor.library_id, floor.number ) ] = floor
+
+    Floor.objects.bulk_create(
+        floors.values(), update_conflicts=True,
+        unique_fields=[ 'library', 'number' ], update_fields=[ 'description', 'floor_map' ]
+    )
+    # bulk_create skips save(), invalidate the compiled maps of the touched floors by hand
+    Floor.bump_layout_version( *Floor.objects.filter(
+        library_id__in=library_ids.values(), number__in={ number for _, number in floors }
+    ).values_list( 'pk', flat=True ) )
+    updated = len( existing & floors.keys() )
+    result.updated += updated
+    result.created += len( floors ) - updated
+
+
+def _import_rooms( rows, result ):
+    libraries = { _value( record, 'library' ) for _, record in rows }
+    floor_ids = {
+        ( library_name, number ): pk for pk, library_name, number in
+        Floor.objects.filter( library__name__in=libraries ).values_list( 'pk', 'library__name', 'number' )
+    }
+    room_ids = { _value( record, 'room_id' ) for _, record in rows }
+    # room_id -> current floor and status, a room moved to another floor changes both maps
+    existing = {
+        room_id: ( floor_id, status ) for room_id, floor_id, status in
+        Room.objects.filter( room_id__in=room_ids ).values_list( 'room_id', 'floor_id', 'status' )
+    }
+
+    columns = [ name for name in FIELDS[ 'rooms' ] if name not in ( 'library', 'floor' ) ]
+    rooms = {}
+    for line_no, record in rows:
+        try:
+            key = ( _value( record, 'library' ), Floor._meta.get_field( 'number' ).to_python( _value( record, 'floor' ) ) )
+            if key not in floor_ids:
+                raise ValidationError( f"Unknown floor {key[ 1 ]} in library '{key[ 0 ]}'." )
+            room = Room( floor_id=floor_ids[ key ], **_coerce( Room, record, columns ) )
+            room.clean_fields( exclude=[ 'floor' ] )
+        except ( ValidationError, ValueError, TypeError ) as exc:
+            result.error( line_no, _message( exc ) )
+            continue
+        rooms[ room.room_id ] = room
+
+    # upsert on the unique room_id, the status of an existing room is changed through a transition below
+    Room.objects.bulk_create(
+        rooms.values(), update_conflicts=True, unique_fields=[ 'room_id' ],
+        update_fields=[ name for name in columns if name not in ( 'room_id', 'status' ) ] + [ 'floor' ]
+    )
+    Floor.bump_layout_version( *{ room.floor_id for room in rooms.values() },
+                               *{ existing[ room_id ][ 0 ] for room_id in existing.keys() & rooms.keys() } )
+    # closures keep rooms imported out of service from being booked, as room_status.transition() would
+    room_status.close_new_rooms(
+        [ room for room_id, room in rooms.items() if room_id not in existing ], reason="Bulk import" )
+    for room_id in existing.keys() & rooms.keys():
+        if rooms[ room_id ].status != existing[ room_id ][ 1 ]:
+            room = Room.objects.get( room_id=room_id )
+            room_status.transition( room, rooms[ room_id ].status, resolution='flag', reason="Bulk import" )
+    updated = len( existing.keys() & rooms.keys() )
+    result.updated += updated
+    result.created += len( rooms ) - updated
+
+
+def _import_reservations( rows, result ):
+    usernames = { _value( record, 'username' ) for _, record in rows }
+    user_ids = dict( User.objects.filter( username__in=usernames ).values_list( 'username', 'pk' ) )
+    room_keys = { _value( record, 'room_id' ) for _, record in rows }
+    # lock the rooms so live bookings cannot slip in between the overlap check and the insert
+    rooms = {
+        room.room_id: room for room in
+        Room.objects.select_for_update( of=( 'self', ) ).select_related( 'floor__library' )
+        .filter( room_id__in=room_keys ).order_by( 'pk' )
+    }
+
+    columns = [ 'start_time', 'end_time', 'status', 'purpose', 'num_attendees', 'notes' ]
+    candidates = []
+    for line_no, record in rows:
+        try:
+            username, room_key = _value( record, 'username' ), _value( record, 'room_id' )
+            if username not in user_ids:
+                raise ValidationError( f"Unknown user '{username}'." )
+            if room_key not in rooms:
+                raise ValidationError( f"Unknown room '{room_key}'." )
+            values = _coerce( Reservation, record, columns )
+            reservation = Reservation( user_id=user_ids[ username ], room=rooms[ room_key ], **values )
+            if _value( record, 'reservation_id' ):
+                reservation.reservation_id = Reservation._meta.get_field( 'reservation_id' ).to_python(
+                    _value( record, 'reservation_id' ) )
+            reservation.clean_fields( exclude=[ 'user', 'room' ] )
+            if reservation.end_time <= reservation.start_time:
+                raise ValidationError( "Reservation end time must be after start time." )
+            if reservation.num_attendees > reservation.room.capacity:
+                raise ValidationError(
+                    f"Number of attendees exceeds maximum room capacity ({reservation.room.capacity})." )
+        except ( ValidationError, ValueError, TypeError ) as exc:
+            result.error( line_no, _message( exc ) )
+            continue
+        candidates.append( ( line_no, reservation ) )
+
+    if not candidates:
+        return
+
+    # re-importing a file must not duplicate rows that already made it in
+    existing_ids = set( Reservation.objects.filter(
+        pk__in=[ reservation.pk for _, reservation in candidates ] ).values_list( 'pk', flat=True ) )
+
+    # set-based checks: one query each fetches every confirmed interval, closure and opening interval
+    # the batch could touch, then each room's ( library's ) intervals are kept sorted and probed with bisect
+    window_start = min( reservation.start_time for _, reservation in candidates )
+    window_end = max( reservation.end_time for _, reservation in candidates )
+    room_pks = [ room.pk for room in rooms.values() ]
+    booked = {}
+    for room_pk, start, end in Reservation.objects.filter(
+        room_id__in=room_pks,
+        status__in=BLOCKING_STATUSES,
+        start_time__lt=window_end,
+        end_time__gt=window_start,
+    ).exclude( pk__in=existing_ids ).order_by( 'start_time' ).values_list( 'room_id', 'start_time', 'end_time' ):
+        booked.setdefault( room_pk, [] ).append( ( start, end ) )
+    # rows already in the table may overlap each other, probing needs disjoint intervals
+    booked = { room_pk: calendar.merge_intervals( intervals ) for room_pk, intervals in booked.items() }
+
+    closed = {}
+    for room_pk, start, end in RoomClosure.objects.filter(
+        Q( end_time__isnull=True ) | Q( end_time__gt=window_start ),
+        room_id__in=room_pks, start_time__lt=window_end,
+    ).values_list( 'room_id', 'start_time', 'end_time' ):
+        closed.setdefault( room_pk, [] ).append( ( start, end ) )
+
+    # how far each library's calendar was materialized when its intervals were fetched
+    open_hours = { room.floor.library_id: ( room.floor.library.calendar_until, [] ) for room in rooms.values() }
+    for library_pk, start, end in OpenInterval.objects.filter(
+        library_id__in=open_hours.keys(),
+        start_time__lt=window_end,
+        end_time__gt=window_start,
+    ).order_by( 'start_time' ).values_list( 'library_id', 'start_time', 'end_time' ):
+        open_hours[ library_pk ][ 1 ].append( ( start, end ) )
+
+    now = timezone.now()
+    to_create = []
+    for line_no, reservation in candidates:
+        if reservation.pk in existing_ids:
+            result.skipped += 1
+            continue
+        if reservation.status in Reservation.ACTIVE_STATUSES and reservation.end_time > now:
+            try:
+                _check_open( reservation, closed, open_hours )
+            except ValidationError as exc:
+                result.error( line_no, _message( exc ) )
+                continue
+        intervals = booked.setdefault( reservation.room_id, [] )
+        if 'cancelled' != reservation.status and _overlaps( intervals, reservation.start_time, reservation.end_time ):
+            result.error( line_no, "This room is already reserved during the selected time period." )
+            continue
+        if reservation.status in BLOCKING_STATUSES:
+            bisect.insort( intervals, ( reservation.start_time, reservation.end_time ) )
+        to_create.append( reservation )
+
+    Reservation.objects.bulk_create( to_create )
+    # bulk_create skips save(), invalidate the cached availability of the touched libraries by hand
+    versions.bump_availability( room_ids={ reservation.room_id for reservation in to_create } )
+    result.created += len( to_create )
+
+
+def _check_open( reservation, closed, open_hours ):
+    """ Reservation.clean()'s room status and opening hours checks, against the prefetched intervals. """
+    for start, end in closed.get( reservation.room_id, () ):
+        if ( end is None or end > reservation.start_time ) and start < reservation.end_time:
+            raise ValidationError( room_status.UNAVAILABLE_MESSAGE )
+
+    library = reservation.room.floor.library
+    calendar_until, intervals = open_hours[ library.pk ]
+    if calendar_until is None or reservation.end_time > calendar_until:
+        # past the calendar that was fetched, left to the calendar itself
+        try:
+            calendar.check_open( library, reservation.start_time, reservation.end_time )
+        except calendar.LibraryClosed as closed_library:
+            raise ValidationError( str( closed_library ) )
+        return
+    # opening intervals are merged, one has to cover the whole reservation
+    index = bisect.bisect_right( intervals, reservation.start_time, key=lambda interval: interval[ 0 ] )
+    if 0 == index or intervals[ index - 1 ][ 1 ] < reservation.end_time:
+        raise ValidationError( calendar.CLOSED_MESSAGE )
+
+
+def _overlaps( intervals, start, end ):
+    """ True if [start, end) overlaps any interval in a sorted list of non-overlapping intervals. """
+    # the only candidate is the last interval that starts before `end`
+    index = bisect.bisect_left( intervals, ( end, ) )
+    return index > 0 and intervals[ index - 1 ][ 1 ] > start
+
+
+IMPORTERS = {
+    'libraries': _import_libraries,
+    'floors': _import_floors,
+    'rooms': _import_rooms,
+    'reservations': _import_reservations,
+}
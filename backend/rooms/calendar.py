@@ -0,0 +1,204 @@
+# Purpose: Materialize library opening hours into precomputed open intervals
+
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import versions
+from .models import Library, OpenInterval, ScheduleOverride, WeeklySchedule
+
+"""
+Opening hours are written as rules in the library's local time:
+    WeeklySchedule      periods per day of the week ( a library without any uses opening_time / closing_time daily )
+    ScheduleOverride    replaces the weekly periods of one date, or closes the library for it
+materialize() expands the rules for the next CALENDAR_HORIZON_WEEKS into UTC OpenInterval rows, merging
+periods that touch ( e.g. a 24 hour exam week ), so every question the booking code asks
+( is [start, end) open? which parts of this range are open? ) is one range lookup on an index
+
+Run it after changing a schedule ( the admin does ) and nightly to roll the horizon forward
+( manage.py materialize_calendar ), nothing else writes the calendar. check_open() and open_windows()
+only read it, beyond the horizon ( or for a library never materialized ) they expand the rules on the fly
+
+Bookings are not limited by the horizon, BOOKING_HORIZON_WEEKS sets how far ahead rooms can be booked
+( no limit by default )
+"""
+
+CLOSED_MESSAGE = "The library is closed during part of the selected time period."
+
+
+class LibraryClosed( Exception ):
+    """ Raised when a reservation falls outside its library's opening hours. """
+
+    def __init__( self, library, start_time, end_time, message=CLOSED_MESSAGE ):
+        super().__init__( message )
+        self.library = library
+        self.start_time = start_time
+        self.end_time = end_time
+
+
+def merge_intervals( intervals ):
+    """ Merge a list of ( start, end ) pairs sorted by start into non-overlapping intervals. """
+    merged = []
+    for start, end in intervals:
+        if merged and start <= merged[ -1 ][ 1 ]:
+            if end > merged[ -1 ][ 1 ]:
+                merged[ -1 ] = ( merged[ -1 ][ 0 ], end )
+        else:
+            merged.append( ( start, end ) )
+    return merged
+
+
+def _weeks( weeks=None ):
+    return weeks or settings.CALENDAR_HORIZON_WEEKS
+
+
+def _local_midnight( day, zone ):
+    return datetime.combine( day, time.min, tzinfo=zone ).astimezone( dt_timezone.utc )
+
+
+def _period( day, opens_at, closes_at, zone ):
+    """ One opening period of a local day as a UTC interval, a period closing at or before it opens runs overnight. """
+    close_day = day if closes_at > opens_at else day + timedelta( days=1 )
+    return (
+        datetime.combine( day, opens_at, tzinfo=zone ).astimezone( dt_timezone.utc ),
+        datetime.combine( close_day, closes_at, tzinfo=zone ).astimezone( dt_timezone.utc ),
+    )
+
+
+def _rule_intervals( library, first_day, last_day, zone ):
+    """ UTC intervals from the rules of every local day in [first_day, last_day), sorted and merged. """
+    weekly = {}
+    for row in WeeklySchedule.objects.filter( library=library ).values( 'weekday', 'opens_at', 'closes_at' ):
+        weekly.setdefault( row[ 'weekday' ], [] ).append( ( row[ 'opens_at' ], row[ 'closes_at' ] ) )
+    if not weekly:
+        weekly = { weekday: [ ( library.opening_time, library.closing_time ) ] for weekday in range( 7 ) }
+
+    overrides = {}
+    for row in ScheduleOverride.objects.filter(
+        library=library, date__gte=first_day, date__lt=last_day
+    ).values( 'date', 'is_closed', 'opens_at', 'closes_at' ):
+        periods = overrides.setdefault( row[ 'date' ], [] )
+        if row[ 'is_closed' ]:
+            periods.append( None )
+        else:
+            periods.append( ( row[ 'opens_at' ], row[ 'closes_at' ] ) )
+
+    intervals = []
+    day = first_day
+    while day < last_day:
+        periods = overrides.get( day, weekly.get( day.weekday(), [] ) )
+        if None not in periods:
+            intervals.extend( _period( day, opens_at, closes_at, zone ) for opens_at, closes_at in periods )
+        day += timedelta( days=1 )
+    return merge_intervals( sorted( intervals ) )
+
+
+def materialize( library, weeks=None ):
+    """
+    Rebuild the library's OpenInterval rows from the start of its local today to `weeks` ahead.
+    Intervals in the past are kept, so old reservations can still be checked against them.
+    Returns the number of intervals written.
+    """
+    zone = ZoneInfo( library.time_zone )
+    today = timezone.localtime( timezone.now(), zone ).date()
+    last_day = today + timedelta( weeks=_weeks( weeks ) )
+    rebuild_start = _local_midnight( today, zone )
+    rebuild_end = _local_midnight( last_day, zone )
+
+    with transaction.atomic():
+        # one rebuild of a library at a time
+        locked = Library.objects.select_for_update().get( pk=library.pk )
+
+        # start a day early so an overnight period from yesterday continues into today
+        intervals = [
+            ( max( start, rebuild_start ), min( end, rebuild_end ) )
+            for start, end in _rule_intervals( locked, today - timedelta( days=1 ), last_day, zone )
+            if end > rebuild_start and start < rebuild_end
+        ]
+
+        OpenInterval.objects.filter( library=locked, start_time__gte=rebuild_start ).delete()
+        # at most one interval runs from before today up to ( or into ) it, cut it at midnight or let it continue
+        running = OpenInterval.objects.filter(
+            library=locked, start_time__lt=rebuild_start, end_time__gte=rebuild_start
+        ).first()
+        if running is not None:
+            running.end_time = intervals.pop( 0 )[ 1 ] if intervals and intervals[ 0 ][ 0 ] == rebuild_start \
+                else rebuild_start
+            running.save( update_fields=[ 'end_time' ] )
+
+        OpenInterval.objects.bulk_create( [
+            OpenInterval( library=locked, start_time=start, end_time=end ) for start, end in intervals
+        ] )
+        Library.objects.filter( pk=library.pk ).update( calendar_until=rebuild_end )
+        library.calendar_until = rebuild_end
+        versions.bump_availability( library_ids=[ library.pk ] )
+    return len( intervals )
+
+
+def open_intervals( library, start, end ):
+    """
+    The library's merged open intervals overlapping [start, end), unclipped: materialized rows up to
+    calendar_until, expanded from the rules beyond it.
+    """
+    calendar_until = library.calendar_until
+    intervals = []
+    if calendar_until is not None and start < calendar_until:
+        intervals = list( OpenInterval.objects.filter(
+            library=library, end_time__gt=start, start_time__lt=end
+        ).order_by( 'start_time' ).values_list( 'start_time', 'end_time' ) )
+    if calendar_until is None or end > calendar_until:
+        zone = ZoneInfo( library.time_zone )
+        rules_start = start if calendar_until is None else max( start, calendar_until )
+        # a day early for an overnight period running into the first day
+        first_day = timezone.localtime( rules_start, zone ).date() - timedelta( days=1 )
+        last_day = timezone.localtime( end, zone ).date() + timedelta( days=1 )
+        intervals.extend(
+            ( max( interval_start, rules_start ), interval_end )
+            for interval_start, interval_end in _rule_intervals( library, first_day, last_day, zone )
+            if interval_end > rules_start and interval_start < end
+        )
+        # the last materialized interval and the first expanded one meet at calendar_until
+        intervals = merge_intervals( intervals )
+    return intervals
+
+
+def check_open( library, start_time, end_time ):
+    """ Raise LibraryClosed unless the library is open for the whole of [start_time, end_time). """
+    weeks = settings.BOOKING_HORIZON_WEEKS
+    if weeks and end_time > timezone.now() + timedelta( weeks=weeks ):
+        raise LibraryClosed( library, start_time, end_time,
+                             f"Reservations can be made at most {weeks} weeks ahead." )
+    if library.calendar_until is not None and end_time <= library.calendar_until:
+        is_open = OpenInterval.objects.filter(
+            library=library, end_time__gte=end_time, start_time__lte=start_time
+        ).exists()
+    else:
+        # intervals are merged, one has to cover the whole range
+        is_open = any(
+            interval_start <= start_time and interval_end >= end_time
+            for interval_start, interval_end in open_intervals( library, start_time, end_time )
+        )
+    if not is_open:
+        raise LibraryClosed( library, start_time, end_time )
+
+
+def open_windows( library, start, end ):
+    """ The parts of [start, end) during which the library is open, as sorted ( start, end ) pairs. """
+    return [
+        ( max( interval_start, start ), min( interval_end, end ) )
+        for interval_start, interval_end in open_intervals( library, start, end )
+    ]
+
+
+def local_day_bounds( library, day ):
+    """ [start, end) of a calendar date in the library's time zone, in UTC. """
+    zone = ZoneInfo( library.time_zone )
+    return _local_midnight( day, zone ), _local_midnight( day + timedelta( days=1 ), zone )
+
+
+def local_date( library, moment ):
+    """ The calendar date of `moment` in the library's time zone. """
+    return timezone.localtime( moment, ZoneInfo( library.time_zone ) ).date()
@@ -0,0 +1,239 @@
+# Purpose: Reservation events written to the outbox, and the handlers that send emails and keep usage analytics
+
+from datetime import timedelta
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.mail import send_mail
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import calendar, outbox
+from .models import Reservation, Room, RoomUsage
+
+"""
+The write paths ( booking.py, waitlist.py ) call the functions at the top of this module
+inside their transaction, each records one or more outbox events:
+    reservation.created     confirmation email and booking count ( not for waitlist holds ), usage minutes
+    reservation.updated     usage counters when the interval or status changed
+    reservation.cancelled   cancellation email and cancellation count ( not for waitlist holds released
+                            unaccepted ), usage minutes
+    reservation.deleted     usage counters
+    reservation.flagged     email that the room closes during the reservation ( staff will follow up )
+    reservation.reminder    reminder email, scheduled RESERVATION_REMINDER_MINUTES before the start
+    waitlist.offered        offer email with the hold's expiry
+    waitlist.accepted       confirmation email, booking count
+    room.status_changed     no handlers yet, a record of every closure and reopening
+waitlist.py records waitlist.match events ( a freed interval to offer ) and handles them itself
+Payloads carry what the handlers need as of the change, handlers re-read the reservation
+only where a stale email would be wrong ( reminders )
+"""
+
+_encoder = DjangoJSONEncoder()
+
+
+def _interval( reservation ):
+    return {
+        'room': reservation.room_id,
+        'start_time': reservation.start_time,
+        'end_time': reservation.end_time,
+        'status': reservation.status,
+    }
+
+
+def _payload( reservation, **extra ):
+    payload = { 'reservation_id': str( reservation.reservation_id ), 'user': reservation.user_id }
+    payload.update( _interval( reservation ) )
+    payload.update( extra )
+    return payload
+
+
+def _schedule_reminder( reservation ):
+    remind_at = reservation.start_time - timedelta( minutes=settings.RESERVATION_REMINDER_MINUTES )
+    # a booking made shortly before it starts needs no reminder
+    if reservation.status in Reservation.ACTIVE_STATUSES and remind_at > timezone.now():
+        outbox.emit( 'reservation.reminder', _payload( reservation ), available_at=remind_at )
+
+
+def reservation_created( reservation, source='api' ):
+    outbox.emit( 'reservation.created', _payload( reservation, source=source ) )
+    if 'waitlist' != source:
+        _schedule_reminder( reservation )
+
+
+def reservation_changed( reservation, previous, source='api' ):
+    """ `previous` is the reservation's interval before the change, as returned by snapshot(). """
+    current = _interval( reservation )
+    if current == previous:
+        return
+    if 'cancelled' == reservation.status and previous[ 'status' ] in Reservation.ACTIVE_STATUSES:
+        outbox.emit( 'reservation.cancelled', _payload( reservation, previous=previous, source=source ) )
+        return
+    outbox.emit( 'reservation.updated', _payload( reservation, previous=previous ) )
+    if ( current[ 'start_time' ], current[ 'room' ] ) != ( previous[ 'start_time' ], previous[ 'room' ] ):
+        _schedule_reminder( reservation )
+
+
+def reservation_deleted( reservation ):
+    outbox.emit( 'reservation.deleted', _payload( reservation ) )
+
+
+def hold_offered( entry ):
+    outbox.emit( 'waitlist.offered', _payload( entry.hold, entry=entry.pk, hold_expires_at=entry.hold_expires_at ) )
+
+
+def hold_accepted( entry ):
+    outbox.emit( 'waitlist.accepted', _payload( entry.hold, entry=entry.pk ) )
+    _schedule_reminder( entry.hold )
+
+
+def reservations_closed( reservations, closure ):
+    """ One event per reservation a room closure cancelled or flagged, `reservations` as they were before. """
+    if 'cancel' == closure.resolution:
+        outbox.emit_many( 'reservation.cancelled', [
+            _payload( reservation, status='cancelled', previous=_interval( reservation ), reason=closure.reason )
+            for reservation in reservations
+        ] )
+    else:
+        outbox.emit_many( 'reservation.flagged', [
+            _payload( reservation, closure=closure.pk, room_status=closure.status, reason=closure.reason )
+            for reservation in reservations
+        ] )
+
+
+def room_status_changed( room, status, start_time, end_time, affected ):
+    outbox.emit( 'room.status_changed', {
+        'room': room.pk,
+        'status': status,
+        'start_time': start_time,
+        'end_time': end_time,
+        'reservations': affected,
+    } )
+
+
+def snapshot( reservation ):
+    return _interval( reservation )
+
+
+# ---- handlers, run by the outbox workers ----
+
+def _times( payload ):
+    return parse_datetime( payload[ 'start_time' ] ), parse_datetime( payload[ 'end_time' ] )
+
+
+def _mail( payload, subject, body ):
+    user = User.objects.filter( pk=payload[ 'user' ] ).first()
+    if user is None or not user.email:
+        return
+    send_mail( subject, body, settings.DEFAULT_FROM_EMAIL, [ user.email ] )
+
+
+def _describe( payload ):
+    room = Room.objects.select_related( 'floor__library' ).filter( pk=payload[ 'room' ] ).first()
+    start_time, end_time = _times( payload )
+    if room is None:
+        return f"{start_time:%Y-%m-%d %H:%M} - {end_time:%H:%M} UTC"
+    library = room.floor.library
+    zone = ZoneInfo( library.time_zone )
+    start_time = timezone.localtime( start_time, zone )
+    end_time = timezone.localtime( end_time, zone )
+    return f"room {room.room_id} at {library.name}, {start_time:%A %Y-%m-%d %H:%M} - {end_time:%H:%M}"
+
+
+@outbox.handler( 'reservation.created' )
+def send_confirmation( payload ):
+    if 'waitlist' == payload.get( 'source' ):
+        return
+    _mail( payload, "Your room reservation", f"You have reserved {_describe( payload )}." )
+
+
+@outbox.handler( 'waitlist.accepted' )
+def send_hold_confirmation( payload ):
+    _mail( payload, "Your room reservation", f"You have reserved {_describe( payload )}." )
+
+
+@outbox.handler( 'reservation.cancelled' )
+def send_cancellation( payload ):
+    # an expired or withdrawn hold was never the user's booking
+    if 'waitlist' == payload.get( 'source' ):
+        return
+    reason = f" ( {payload[ 'reason' ]} )" if payload.get( 'reason' ) else ""
+    _mail( payload, "Reservation cancelled", f"Your reservation of {_describe( payload )} was cancelled{reason}." )
+
+
+@outbox.handler( 'reservation.flagged' )
+def send_flagged( payload ):
+    reason = f" ( {payload[ 'reason' ]} )" if payload.get( 'reason' ) else ""
+    _mail( payload, "Your reserved room is unavailable",
+           f"The room of your reservation {_describe( payload )} is {payload[ 'room_status' ]} at that time{reason}. "
+           "Library staff will contact you about moving it." )
+
+
+@outbox.handler( 'waitlist.offered' )
+def send_offer( payload ):
+    expires = parse_datetime( payload[ 'hold_expires_at' ] )
+    _mail( payload, "A room you were waiting for is free",
+           f"{_describe( payload )} is being held for you until {expires:%H:%M} UTC, accept it before then to keep it." )
+
+
+@outbox.handler( 'reservation.reminder' )
+def send_reminder( payload ):
+    reservation = Reservation.objects.filter( pk=payload[ 'reservation_id' ] ).first()
+    # skip reminders for reservations cancelled or moved since the reminder was scheduled
+    if reservation is None or reservation.status not in Reservation.ACTIVE_STATUSES \
+            or _encoder.default( reservation.start_time ) != payload[ 'start_time' ] \
+            or reservation.room_id != payload[ 'room' ]:
+        return
+    _mail( payload, "Reservation reminder", f"Reminder: you have reserved {_describe( payload )}." )
+
+
+def _count_usage( interval, sign, **counters ):
+    """ Add `sign` times the interval's minutes, and the given counters, to its room's usage on its start date. """
+    room = Room.objects.select_related( 'floor__library' ).filter( pk=interval[ 'room' ] ).first()
+    if room is None:
+        return
+    start_time, end_time = _times( interval )
+    day = calendar.local_date( room.floor.library, start_time )
+    minutes = int( ( end_time - start_time ).total_seconds() // 60 )
+    usage, _ = RoomUsage.objects.get_or_create( room=room, date=day )
+    changes = { name: F( name ) + value for name, value in counters.items() }
+    if interval[ 'status' ] in Reservation.ACTIVE_STATUSES:
+        changes[ 'booked_minutes' ] = F( 'booked_minutes' ) + sign * minutes
+    if changes:
+        RoomUsage.objects.filter( pk=usage.pk ).update( **changes )
+
+
+@outbox.handler( 'reservation.created' )
+def count_created( payload ):
+    # a waitlist hold counts as a booking once it is accepted
+    if 'waitlist' == payload.get( 'source' ):
+        _count_usage( payload, 1 )
+    else:
+        _count_usage( payload, 1, bookings=1 )
+
+
+@outbox.handler( 'waitlist.accepted' )
+def count_accepted( payload ):
+    _count_usage( payload, 0, bookings=1 )
+
+
+@outbox.handler( 'reservation.updated' )
+def count_updated( payload ):
+    _count_usage( payload[ 'previous' ], -1 )
+    _count_usage( payload, 1 )
+
+
+@outbox.handler( 'reservation.cancelled' )
+def count_cancelled( payload ):
+    if 'waitlist' == payload.get( 'source' ):
+        _count_usage( payload[ 'previous' ], -1 )
+    else:
+        _count_usage( payload[ 'previous' ], -1, cancellations=1 )
+
+
+@outbox.handler( 'reservation.deleted' )
+def count_deleted( payload ):
+    _count_usage( payload, -1 )
@@ -0,0 +1,155 @@
+# Purpose: iCalendar feeds of a user's reservations and ( for staff ) of a room's reservations
+
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.http import Http404, HttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+from .models import CalendarFeedToken, Reservation, Room
+
+"""
+Calendar apps subscribe to a URL and poll it every few minutes without logging in, so the
+URL carries a secret token ( CalendarFeedToken, rotated through rooms/feeds/token/ )
+    feeds/<token>/reservations.ics      the token owner's upcoming reservations
+    feeds/<token>/rooms/<room_id>.ics   every upcoming reservation of a room, staff tokens only
+
+Both feeds cover reservations starting at most CALENDAR_FEED_PAST_DAYS ago ( an index range scan
+on user / start_time or room / start_time ). Before rendering, one aggregate over the same range
+( latest modified_at, row count ) gives the ETag and Last-Modified, so a poll that finds nothing
+new is answered 304 without reading a single reservation. Every change to a reservation
+( cancelling included ) moves modified_at, a deletion changes the count
+"""
+
+PRODID = "-//LibMaster//Room reservations//EN"
+
+ICAL_STATUS = {
+    'pending': 'TENTATIVE',
+    'confirmed': 'CONFIRMED',
+}
+
+FEED_FIELDS = (
+    'reservation_id', 'start_time', 'end_time', 'status', 'purpose', 'modified_at',
+    'user__username', 'room__room_id', 'room__floor__number', 'room__floor__library__name',
+)
+
+
+def _escape( text ):
+    """ TEXT value escaping ( RFC 5545 3.3.11 ). """
+    return text.replace( '\\', '\\\\' ).replace( ';', '\\;' ).replace( ',', '\\,' ) \
+        .replace( '\r\n', '\\n' ).replace( '\n', '\\n' )
+
+
+def _fold( line ):
+    """ Split lines longer than 75 octets, continuation lines start with a space ( RFC 5545 3.1 ). """
+    data = line.encode( 'utf-8' )
+    parts = []
+    limit = 75
+    while len( data ) > limit:
+        cut = limit
+        # never split a multi-byte character
+        while 0x80 == data[ cut ] & 0xC0:
+            cut -= 1
+        parts.append( data[ :cut ] )
+        data = data[ cut: ]
+        limit = 74
+    parts.append( data )
+    return b'\r\n '.join( parts ).decode( 'utf-8' )
+
+
+def _utc( moment ):
+    return moment.astimezone( dt_timezone.utc ).strftime( '%Y%m%dT%H%M%SZ' )
+
+
+def _event( row, show_user ):
+    summary = f"Study room {row[ 'room__room_id' ]}"
+    location = f"{row[ 'room__floor__library__name' ]}, floor {row[ 'room__floor__number' ]}"
+    if show_user:
+        summary += f" ( {row[ 'user__username' ]} )"
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{row[ 'reservation_id' ]}@libmaster",
+        f"DTSTAMP:{_utc( row[ 'modified_at' ] )}",
+        f"LAST-MODIFIED:{_utc( row[ 'modified_at' ] )}",
+        f"DTSTART:{_utc( row[ 'start_time' ] )}",
+        f"DTEND:{_utc( row[ 'end_time' ] )}",
+        f"SUMMARY:{_escape( summary )}",
+        f"LOCATION:{_escape( location )}",
+        f"STATUS:{ICAL_STATUS.get( row[ 'status' ], 'CONFIRMED' )}",
+    ]
+    if row[ 'purpose' ]:
+        lines.append( f"DESCRIPTION:{_escape( row[ 'purpose' ] )}" )
+    lines.append( "END:VEVENT" )
+    return lines
+
+
+def render( name, rows, show_user=False ):
+    """ A VCALENDAR document with one VEVENT per reservation row ( values of FEED_FIELDS ). """
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        f"PRODID:{PRODID}",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{_escape( name )}",
+    ]
+    for row in rows:
+        lines.extend( _event( row, show_user ) )
+    lines.append( "END:VCALENDAR" )
+    return "".join( _fold( line ) + "\r\n" for line in lines )
+
+
+def window_start():
+    return timezone.now() - timedelta( days=settings.CALENDAR_FEED_PAST_DAYS )
+
+
+def _feed_user( token ):
+    feed = CalendarFeedToken.objects.select_related( 'user' ).filter( token=token, user__is_active=True ).first()
+    if feed is None:
+        raise Http404( "Unknown calendar feed." )
+    return feed.user
+
+
+def _serve( request, reservations, name, show_user=False ):
+    """ 304 when the client's copy is current, else the rendered feed, with ETag and Last-Modified. """
+    version = reservations.aggregate( latest=Max( 'modified_at' ), count=Count( 'pk' ) )
+    latest = version[ 'latest' ]
+    etag = f'"{version[ "count" ]}-{int( latest.timestamp() * 1000000 ) if latest else 0}"'
+    last_modified = int( latest.timestamp() ) if latest else None
+
+    response = get_conditional_response( request, etag=etag, last_modified=last_modified )
+    if response is None:
+        rows = reservations.filter( status__in=Reservation.ACTIVE_STATUSES ).order_by( 'start_time' ).values( *FEED_FIELDS )
+        response = HttpResponse( render( name, rows, show_user ), content_type='text/calendar; charset=utf-8' )
+    response[ 'ETag' ] = etag
+    if last_modified is not None:
+        response[ 'Last-Modified' ] = http_date( last_modified )
+    # the URL is a credential, shared caches must not keep it
+    patch_cache_control( response, private=True, no_cache=True )
+    return response
+
+
+@require_safe
+def user_feed( request, token ):
+    """ GET feeds/<token>/reservations.ics """
+    user = _feed_user( token )
+    # cancelled and completed rows count for the version, only active ones are rendered
+    reservations = Reservation.objects.filter( user=user, start_time__gte=window_start() )
+    return _serve( request, reservations, f"Study rooms ( {user.username} )" )
+
+
+@require_safe
+def room_feed( request, token, room_id ):
+    """ GET feeds/<token>/rooms/<room_id>.ics, for staff tokens """
+    user = _feed_user( token )
+    if not user.is_staff:
+        raise Http404( "Unknown calendar feed." )
+    room = Room.objects.filter( room_id=room_id ).first()
+    if room is None:
+        raise Http404( "No such room." )
+    reservations = Reservation.objects.filter( room=room, start_time__gte=window_start() )
+    return _serve( request, reservations, f"Room {room.room_id}", show_user=True )
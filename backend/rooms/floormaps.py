@@ -0,0 +1,183 @@
+# Purpose: Compile floor layouts into SVG, availability bitmaps and spatial indexes
+
+import base64
+import threading
+from collections import OrderedDict
+from xml.sax.saxutils import escape, quoteattr
+
+from django.core.cache import cache
+from django.db.models import Q
+
+from . import calendar
+from .models import Room, Reservation, RoomClosure, is_number, is_outline
+from .spatial import RTree
+
+"""
+Everything here is derived from a floor's rooms and floor_map and is keyed by Floor.layout_version,
+so cached copies never need explicit invalidation: saving the floor, or changing the layout of any
+of its rooms ( Room.LAYOUT_FIELDS ), bumps the version and the next request compiles a fresh copy under the new key
+
+floor_map keys understood by the renderer ( all optional ):
+    width, height   size of the drawing, defaults to the bounding box of the rooms
+    outline         list of [x, y] points drawn as the floor outline
+Floor.clean() rejects other values, ones stored before that ( or bypassing it ) are ignored
+"""
+
+MAP_MARGIN = 1.0
+
+# floors whose compiled layout a process keeps in memory, least recently used dropped first
+LAYOUT_CACHE_SIZE = 256
+
+
+def _mapped_rooms( floor ):
+    """ Rooms of the floor that have a rectangle on the map, in map ( and bitmap ) order. """
+    return list(
+        Room.objects.filter(
+            floor=floor,
+            position_x__isnull=False, position_y__isnull=False, width__isnull=False, height__isnull=False,
+        ).order_by( 'room_id' ).values( 'pk', 'room_id', 'position_x', 'position_y', 'width', 'height' )
+    )
+
+
+def _number( value ):
+    # compact, locale independent numbers keep the document small
+    return f"{value:g}"
+
+
+def _size( layout, key, default ):
+    value = layout.get( key )
+    return value if is_number( value ) and value > 0 else default
+
+
+def render_svg( floor, rooms ):
+    """ SVG document for the floor, each room is a <rect> whose id is 'room-<room_id>'. """
+    layout = floor.floor_map if isinstance( floor.floor_map, dict ) else {}
+    if rooms:
+        max_x = max( room[ 'position_x' ] + room[ 'width' ] for room in rooms )
+        max_y = max( room[ 'position_y' ] + room[ 'height' ] for room in rooms )
+    else:
+        max_x = max_y = 0
+    width = _size( layout, 'width', max_x + MAP_MARGIN )
+    height = _size( layout, 'height', max_y + MAP_MARGIN )
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {_number( width )} {_number( height )}" '
+        f'data-floor={quoteattr( str( floor.pk ) )} data-version={quoteattr( str( floor.layout_version ) )}>'
+    ]
+    outline = layout.get( 'outline' )
+    if outline and is_outline( outline ):
+        points = ' '.join( f"{_number( x )},{_number( y )}" for x, y in outline )
+        parts.append( f'<polygon class="outline" points="{points}"/>' )
+    else:
+        parts.append( f'<rect class="outline" width="{_number( width )}" height="{_number( height )}"/>' )
+
+    for index, room in enumerate( rooms ):
+        parts.append(
+            f'<rect id={quoteattr( "room-" + room[ "room_id" ] )} class="room" data-index="{index}" '
+            f'x="{_number( room[ "position_x" ] )}" '
+            f'y="{_number( room[ "position_y" ] )}" width="{_number( room[ "width" ] )}" '
+            f'height="{_number( room[ "height" ] )}"><title>{escape( room[ "room_id" ] )}</title></rect>'
+        )
+    parts.append( '</svg>' )
+    return ''.join( parts )
+
+
+def floor_svg( floor ):
+    """ Compiled SVG for the floor's current layout version, from the cache when possible. """
+    key = f"floor-svg:{floor.pk}:{floor.layout_version}"
+    svg = cache.get( key )
+    if svg is None:
+        svg = render_svg( floor, _mapped_rooms( floor ) )
+        # the version is part of the key, so the entry never goes stale
+        cache.set( key, svg, timeout=None )
+    return svg
+
+
+def _compile_layout( floor_pk ):
+    """ ( room order, spatial index ) of the floor's current rooms. """
+    rooms = _mapped_rooms( floor_pk )
+    order = tuple( ( room[ 'pk' ], room[ 'room_id' ] ) for room in rooms )
+    index = RTree( [
+        (
+            ( room[ 'position_x' ], room[ 'position_y' ],
+              room[ 'position_x' ] + room[ 'width' ], room[ 'position_y' ] + room[ 'height' ] ),
+            room[ 'room_id' ],
+        )
+        for room in rooms
+    ] )
+    return order, index
+
+
+class _Layouts:
+    """ The latest compiled layout of up to LAYOUT_CACHE_SIZE floors, kept in process memory. """
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        # floor pk -> ( layout version, layout ), a newer version replaces the floor's entry
+        self._layouts = OrderedDict()
+
+    def get( self, floor_pk, layout_version ):
+        with self._lock:
+            entry = self._layouts.get( floor_pk )
+            if entry is not None and entry[ 0 ] == layout_version:
+                self._layouts.move_to_end( floor_pk )
+                return entry[ 1 ]
+        layout = _compile_layout( floor_pk )
+        with self._lock:
+            entry = self._layouts.get( floor_pk )
+            # a request holding an older copy of the floor does not push out a newer layout
+            if entry is None or entry[ 0 ] < layout_version:
+                self._layouts[ floor_pk ] = ( layout_version, layout )
+            self._layouts.move_to_end( floor_pk )
+            while len( self._layouts ) > LAYOUT_CACHE_SIZE:
+                self._layouts.popitem( last=False )
+        return layout
+
+    def clear( self ):
+        with self._lock:
+            self._layouts.clear()
+
+
+layouts = _Layouts()
+
+
+def _floor_layout( floor_pk, layout_version ):
+    return layouts.get( floor_pk, layout_version )
+
+
+def spatial_index( floor ):
+    return _floor_layout( floor.pk, floor.layout_version )[ 1 ]
+
+
+def availability_bitmap( floor, start_time, end_time ):
+    """
+    One bit per mapped room in SVG order ( data-index ), set when the room is bookable for the whole window:
+    no active reservation or closure window ( room_status.py ) overlaps it and the library is open throughout,
+    the checks save_reservation makes. Returned base64 encoded, most significant bit first.
+    """
+    order, _ = _floor_layout( floor.pk, floor.layout_version )
+    room_pks = [ pk for pk, _ in order ]
+    bits = bytearray( ( len( room_pks ) + 7 ) // 8 )
+    try:
+        calendar.check_open( floor.library, start_time, end_time )
+    except calendar.LibraryClosed:
+        # no room of the floor is bookable
+        return base64.b64encode( bytes( bits ) ).decode( 'ascii' ), len( room_pks )
+
+    busy = set( Reservation.objects.filter(
+        room_id__in=room_pks,
+        status__in=Reservation.ACTIVE_STATUSES,
+        start_time__lt=end_time,
+        end_time__gt=start_time,
+    ).values_list( 'room_id', flat=True ).distinct() )
+    busy.update( RoomClosure.objects.filter(
+        Q( end_time__isnull=True ) | Q( end_time__gt=start_time ),
+        room_id__in=room_pks,
+        start_time__lt=end_time,
+    ).values_list( 'room_id', flat=True ).distinct() )
+    busy.update( Room.objects.filter( pk__in=room_pks ).exclude( status='available' ).values_list( 'pk', flat=True ) )
+
+    for index, pk in enumerate( room_pks ):
+        if pk not in busy:
+            bits[ index // 8 ] |= 0x80 >> ( index % 8 )
+    return base64.b64encode( bytes( bits ) ).decode( 'ascii' ), len( room_pks )
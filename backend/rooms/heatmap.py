@@ -0,0 +1,174 @@
+# Purpose: Free capacity of a room, floor or library per day or hour over a date range ( week and month views )
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from . import calendar, versions
+from .models import Reservation, Room, RoomClosure
+
+"""
+For every bucket ( a day, or an hour of a day, in the library's time zone ) of the range, in room-minutes:
+    open            minutes the library is open, times the rooms in scope
+    booked          minutes held by active reservations
+    closed          open minutes during which a room is closed or under maintenance ( RoomClosure )
+    free            open - booked - closed
+    reservations    active reservations overlapping the bucket
+One query computes them all: generate_series() makes the buckets, and the open intervals, reservations
+and closures overlapping each bucket are clipped to it and summed per bucket ( range scans on
+reservation_room_start_idx and room_closure_lookup_idx, each reservation is only joined with the
+buckets it spans ). The open intervals are passed in as arrays, calendar.open_windows() reads them
+from the materialized calendar, or expands them from the schedules beyond it
+
+The answer is columnar, one array per measure with an entry per bucket, bucket i starting at local
+midnight of `start` plus i days or hours ( wall clock, a day that changes to or from daylight saving
+time has 23 or 25 hours, its hours are still numbered 0 to 23 )
+
+Answers are cached for HEATMAP_CACHE_SECONDS under the library's availability version ( versions.py ),
+bumped whenever a reservation, closure or the opening hours of the library change, and the catalog
+version ( rooms added, moved or removed )
+"""
+
+RESOLUTIONS = {
+    'day': timedelta( days=1 ),
+    'hour': timedelta( hours=1 ),
+}
+
+MEASURES = ( 'open', 'booked', 'closed', 'free', 'reservations' )
+
+# which rooms are in scope, the parameter is the room's, floor's or library's primary key
+SCOPES = {
+    'room': 'room.id = %(scope)s',
+    'floor': 'room.floor_id = %(scope)s',
+    'library': 'floor.library_id = %(scope)s',
+}
+
+SQL = """
+WITH buckets AS (
+    SELECT n,
+        ( %(first)s::timestamp + n * %(step)s::interval ) AT TIME ZONE %(zone)s AS start_time,
+        ( %(first)s::timestamp + ( n + 1 ) * %(step)s::interval ) AT TIME ZONE %(zone)s AS end_time
+    FROM generate_series( 0, %(count)s - 1 ) AS n
+),
+opening AS (
+    SELECT * FROM unnest( %(open_starts)s::timestamptz[], %(open_ends)s::timestamptz[] ) AS opening( start_time, end_time )
+),
+scope AS (
+    SELECT room.id FROM {room} room JOIN {floor} floor ON floor.id = room.floor_id WHERE {condition}
+),
+opened AS (
+    SELECT buckets.n, SUM( LEAST( opening.end_time, buckets.end_time ) - GREATEST( opening.start_time, buckets.start_time ) ) AS span
+    FROM buckets JOIN opening ON opening.end_time > buckets.start_time AND opening.start_time < buckets.end_time
+    GROUP BY buckets.n
+),
+booked AS (
+    -- each reservation in the range joins only the buckets it spans ( give or take one, for daylight saving
+    -- time ), not every bucket probing the reservations
+    SELECT buckets.n, COUNT( * ) AS reservations,
+        SUM( LEAST( reservation.end_time, buckets.end_time ) - GREATEST( reservation.start_time, buckets.start_time ) ) AS span
+    FROM {reservation} reservation
+    CROSS JOIN LATERAL generate_series(
+        FLOOR( EXTRACT( EPOCH FROM ( reservation.start_time AT TIME ZONE %(zone)s ) - %(first)s::timestamp ) / %(step_seconds)s ) :: int - 1,
+        CEIL( EXTRACT( EPOCH FROM ( reservation.end_time AT TIME ZONE %(zone)s ) - %(first)s::timestamp ) / %(step_seconds)s ) :: int
+    ) AS spanned( n )
+    JOIN buckets ON buckets.n = spanned.n
+        AND reservation.end_time > buckets.start_time AND reservation.start_time < buckets.end_time
+    WHERE reservation.room_id IN ( SELECT id FROM scope ) AND reservation.status = ANY( %(active)s )
+        AND reservation.end_time > %(range_start)s AND reservation.start_time < %(range_end)s
+    GROUP BY buckets.n
+),
+closed AS (
+    SELECT buckets.n, SUM(
+        LEAST( COALESCE( closure.end_time, 'infinity' ), opening.end_time, buckets.end_time )
+        - GREATEST( closure.start_time, opening.start_time, buckets.start_time )
+    ) AS span
+    FROM buckets
+    JOIN opening ON opening.end_time > buckets.start_time AND opening.start_time < buckets.end_time
+    JOIN {closure} closure ON closure.room_id IN ( SELECT id FROM scope )
+        AND COALESCE( closure.end_time, 'infinity' ) > GREATEST( opening.start_time, buckets.start_time )
+        AND closure.start_time < LEAST( opening.end_time, buckets.end_time )
+    GROUP BY buckets.n
+)
+SELECT
+    ( SELECT COUNT( * ) FROM scope ),
+    COALESCE( EXTRACT( EPOCH FROM opened.span ), 0 ) :: bigint / 60,
+    COALESCE( EXTRACT( EPOCH FROM booked.span ), 0 ) :: bigint / 60,
+    COALESCE( EXTRACT( EPOCH FROM closed.span ), 0 ) :: bigint / 60,
+    COALESCE( booked.reservations, 0 )
+FROM buckets
+LEFT JOIN opened ON opened.n = buckets.n
+LEFT JOIN booked ON booked.n = buckets.n
+LEFT JOIN closed ON closed.n = buckets.n
+ORDER BY buckets.n
+"""
+
+
+def _sql( scope ):
+    return SQL.format(
+        room=Room._meta.db_table,
+        floor=Room._meta.get_field( 'floor' ).related_model._meta.db_table,
+        reservation=Reservation._meta.db_table,
+        closure=RoomClosure._meta.db_table,
+        condition=SCOPES[ scope ],
+    )
+
+
+def compute( library, scope, scope_id, start, end, resolution ):
+    """ The columnar heatmap of the rooms in scope, from local date `start` to `end` ( inclusive ). """
+    step = RESOLUTIONS[ resolution ]
+    count = ( ( end - start ).days + 1 ) * ( 24 if 'hour' == resolution else 1 )
+    range_start = calendar.local_day_bounds( library, start )[ 0 ]
+    range_end = calendar.local_day_bounds( library, end )[ 1 ]
+    windows = calendar.open_windows( library, range_start, range_end )
+
+    with connection.cursor() as cursor:
+        cursor.execute( _sql( scope ), {
+            'first': datetime.combine( start, datetime.min.time() ),
+            'step': step,
+            'step_seconds': step.total_seconds(),
+            'range_start': range_start,
+            'range_end': range_end,
+            'zone': library.time_zone,
+            'count': count,
+            'open_starts': [ window_start for window_start, _ in windows ],
+            'open_ends': [ window_end for _, window_end in windows ],
+            'scope': scope_id,
+            'active': list( Reservation.ACTIVE_STATUSES ),
+        } )
+        rows = cursor.fetchall()
+
+    rooms = rows[ 0 ][ 0 ] if rows else 0
+    columns = { measure: [] for measure in MEASURES }
+    for _, opened, booked, closed, reservations in rows:
+        opened *= rooms
+        columns[ 'open' ].append( opened )
+        columns[ 'booked' ].append( booked )
+        columns[ 'closed' ].append( closed )
+        columns[ 'free' ].append( max( opened - booked - closed, 0 ) )
+        columns[ 'reservations' ].append( reservations )
+    return {
+        'scope': scope,
+        'id': scope_id,
+        'library': library.pk,
+        'time_zone': library.time_zone,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'resolution': resolution,
+        'rooms': rooms,
+        'buckets': count,
+        **columns,
+    }
+
+
+def heatmap( library, scope, scope_id, start, end, resolution='day' ):
+    """ compute(), from the cache while nothing in the library has changed. """
+    # read the version before the data, a change committed in between bumps it past the entry written below
+    version = f"{versions.availability( library.pk )}.{versions.catalog()}"
+    key = f"heatmap:{scope}:{scope_id}:{start}:{end}:{resolution}:{version}"
+    result = cache.get( key )
+    if result is None:
+        result = compute( library, scope, scope_id, start, end, resolution )
+        cache.set( key, result, timeout=settings.HEATMAP_CACHE_SECONDS )
+    return result
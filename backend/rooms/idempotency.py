@@ -0,0 +1,99 @@
+# Purpose: Idempotency-Key support for reservation writes
+
+import functools
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+"""
+A write sent with an Idempotency-Key header runs at most once per ( user, key )
+
+The key row is inserted in the same transaction as the write itself and the response is
+stored in it before commit, so:
+- a retry after the first request finished finds the row and replays the stored response
+- a retry racing the first request blocks on the unique index until that transaction ends,
+  then replays the committed response ( or runs itself if the first request failed and rolled back )
+Server errors are never stored, the client may retry them with the same key
+"""
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+REPLAY_HEADER = 'Idempotent-Replayed'
+
+
+def key_ttl():
+    return timedelta( hours=getattr( settings, 'IDEMPOTENCY_KEY_TTL_HOURS', 24 ) )
+
+
+def _fingerprint( request ):
+    data = request.data
+    if hasattr( data, 'lists' ):
+        data = dict( data.lists() )
+    body = json.dumps( data, sort_keys=True, cls=DjangoJSONEncoder, default=str )
+    raw = f"{request.method}\n{request.get_full_path()}\n{body}"
+    return hashlib.sha256( raw.encode( 'utf-8' ) ).hexdigest()
+
+
+def _replay( record, fingerprint ):
+    if record.fingerprint != fingerprint:
+        return Response(
+            { "error": f"This {HEADER} was already used for a different request." },
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+    response = Response( record.response_body, status=record.response_status )
+    response[ REPLAY_HEADER ] = 'true'
+    return response
+
+
+def idempotent( handler ):
+    """ Decorate a viewset action so requests carrying an Idempotency-Key header execute once. """
+    @functools.wraps( handler )
+    def wrapper( viewset, request, *args, **kwargs ):
+        key = request.headers.get( HEADER )
+        if not key or not request.user.is_authenticated:
+            return handler( viewset, request, *args, **kwargs )
+        if len( key ) > MAX_KEY_LENGTH:
+            return Response(
+                { "error": f"{HEADER} must be at most {MAX_KEY_LENGTH} characters." },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        fingerprint = _fingerprint( request )
+        now = timezone.now()
+        with transaction.atomic():
+            IdempotencyKey.objects.filter( user=request.user, key=key, expires_at__lte=now ).delete()
+            try:
+                with transaction.atomic():
+                    # waits here while another transaction holds the same key
+                    record = IdempotencyKey.objects.create(
+                        user=request.user, key=key, fingerprint=fingerprint, expires_at=now + key_ttl() )
+            except IntegrityError:
+                return _replay( IdempotencyKey.objects.get( user=request.user, key=key ), fingerprint )
+
+            response = handler( viewset, request, *args, **kwargs )
+            if response.status_code >= 500:
+                # forget the key so the retry runs again
+                transaction.set_rollback( True )
+                return response
+
+            record.response_status = response.status_code
+            record.response_body = response.data
+            record.save( update_fields=[ 'response_status', 'response_body' ] )
+        return response
+
+    return wrapper
+
+
+def purge_expired_keys( now=None ):
+    """ Delete keys past their TTL, returns how many were removed. """
+    deleted, _ = IdempotencyKey.objects.filter( expires_at__lte=now or timezone.now() ).delete()
+    return deleted
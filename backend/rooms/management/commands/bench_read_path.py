@@ -0,0 +1,110 @@
+# Purpose: Compare the sync ( WSGI ) and async ( ASGI ) read endpoints under concurrent load
+
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings, setup_test_environment
+
+from rooms.models import Room
+
+"""
+Both sides run in this process against the real database:
+    wsgi    the DRF views, one django.test.Client per worker thread ( like a threaded WSGI server )
+    asgi    the async views, every request is a coroutine on one event loop ( like one ASGI worker )
+Both sides are offered --concurrency requests at once ( 1000 by default, a burst of users ) and get the
+same query, the rooms endpoint only uses filters both views understand
+    wsgi    runs them on --threads threads, each holding a database connection, as a WSGI server
+            caps its worker threads, the rest of the requests queue behind them
+    asgi    keeps all of them in flight as coroutines, sharing the async connection pool
+Reported latencies are per request, throughput is requests / wall clock seconds
+"""
+
+ENDPOINTS = {
+    'rooms': ( '/rooms/rooms/?status=available', '/rooms/async/rooms/?status=available' ),
+    'libraries': ( '/rooms/libraries/', '/rooms/async/libraries/' ),
+    'availability': ( '/rooms/rooms/{room_id}/availability/', '/rooms/async/rooms/{room_id}/availability/' ),
+}
+
+
+def _percentile( samples, fraction ):
+    ordered = sorted( samples )
+    return ordered[ min( int( fraction * len( ordered ) ), len( ordered ) - 1 ) ]
+
+
+class Command( BaseCommand ):
+    help = "Benchmark the sync and async read paths side by side."
+
+    def add_arguments( self, parser ):
+        parser.add_argument( '--endpoint', choices=sorted( ENDPOINTS ), default='availability' )
+        parser.add_argument( '--requests', type=int, default=1000, help="Requests per side" )
+        parser.add_argument( '--concurrency', type=int, default=1000, help="Requests offered at once, on either side" )
+        parser.add_argument( '--threads', type=int, default=32,
+                             help="Sync worker threads, and so database connections, at most" )
+        parser.add_argument( '--side', choices=( 'both', 'wsgi', 'asgi' ), default='both' )
+
+    def handle( self, *args, endpoint, requests, concurrency, threads, side, **options ):
+        if min( requests, concurrency, threads ) < 1:
+            raise CommandError( "--requests, --concurrency and --threads must be at least 1." )
+        room = Room.objects.order_by( 'room_id' ).first()
+        if room is None:
+            raise CommandError( "Add at least one room before benchmarking." )
+        sync_url, async_url = ( url.format( room_id=room.room_id ) for url in ENDPOINTS[ endpoint ] )
+        # lets the test clients' 'testserver' host through ALLOWED_HOSTS
+        setup_test_environment()
+        # measure the views, not the rate limits in front of them
+        with override_settings( THROTTLE_BUCKETS={} ):
+            if side in ( 'both', 'wsgi' ):
+                self.report( 'wsgi', sync_url, *self.run_sync( sync_url, requests, min( concurrency, threads ) ) )
+            if side in ( 'both', 'asgi' ):
+                self.report( 'asgi', async_url, *asyncio.run( self.run_async( async_url, requests, concurrency ) ) )
+
+    def run_sync( self, url, requests, threads ):
+        def worker( count ):
+            client = Client()
+            samples = []
+            try:
+                for _ in range( count ):
+                    started = time.perf_counter()
+                    response = client.get( url )
+                    samples.append( ( time.perf_counter() - started, response.status_code ) )
+            finally:
+                connections.close_all()
+            return samples
+
+        shares = [ requests // threads + ( 1 if index < requests % threads else 0 ) for index in range( threads ) ]
+        started = time.perf_counter()
+        with ThreadPoolExecutor( max_workers=threads ) as executor:
+            results = list( executor.map( worker, [ share for share in shares if share ] ) )
+        elapsed = time.perf_counter() - started
+        return [ sample for samples in results for sample in samples ], elapsed
+
+    async def run_async( self, url, requests, concurrency ):
+        client = AsyncClient()
+        gate = asyncio.Semaphore( concurrency )
+
+        async def one():
+            async with gate:
+                started = time.perf_counter()
+                response = await client.get( url )
+                return time.perf_counter() - started, response.status_code
+
+        # warm the connection pool so its startup is not part of the measurement
+        await client.get( url )
+        started = time.perf_counter()
+        samples = await asyncio.gather( *( one() for _ in range( requests ) ) )
+        return samples, time.perf_counter() - started
+
+    def report( self, name, url, samples, elapsed ):
+        latencies = [ seconds * 1000 for seconds, _ in samples ]
+        errors = sum( 1 for _, status in samples if status >= 400 )
+        self.stdout.write(
+            f"{name:<5} {url}\n"
+            f"      {len( samples )} requests in {elapsed:.2f}s = {len( samples ) / elapsed:.0f} req/s, {errors} errors\n"
+            f"      latency ms  p50 {_percentile( latencies, 0.50 ):.1f}  p95 {_percentile( latencies, 0.95 ):.1f}  "
+            f"p99 {_percentile( latencies, 0.99 ):.1f}  mean {statistics.mean( latencies ):.1f}"
+        )
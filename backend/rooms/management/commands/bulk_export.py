@@ -0,0 +1,24 @@
+# Purpose: Stream libraries, floors, rooms or reservations out as CSV / JSON lines
+
+from django.core.management.base import BaseCommand
+
+from rooms import bulk
+
+
+class Command( BaseCommand ):
+    help = "Bulk export libraries, floors, rooms or reservations as CSV or JSON lines."
+
+    def add_arguments( self, parser ):
+        parser.add_argument( 'kind', choices=bulk.KINDS )
+        parser.add_argument( '--format', dest='fmt', choices=bulk.FORMATS, default='csv' )
+        parser.add_argument( '--output', '-o', help="File to write, defaults to stdout" )
+        parser.add_argument( '--chunk-size', type=int, default=bulk.EXPORT_CHUNK_SIZE )
+
+    def handle( self, *args, kind, fmt, output, chunk_size, **options ):
+        chunks = bulk.stream_records( kind, fmt, chunk_size=chunk_size )
+        if output:
+            with open( output, 'w', newline='', encoding='utf-8' ) as stream:
+                stream.writelines( chunks )
+        else:
+            for chunk in chunks:
+                self.stdout.write( chunk, ending='' )
@@ -0,0 +1,37 @@
+# Purpose: Load libraries, floors, rooms or reservations from a CSV / JSON lines file
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rooms import bulk
+
+
+class Command( BaseCommand ):
+    help = "Bulk import libraries, floors, rooms or reservations from CSV or JSON lines ( '-' reads stdin )."
+
+    def add_arguments( self, parser ):
+        parser.add_argument( 'kind', choices=bulk.KINDS )
+        parser.add_argument( 'path', help="File to read, or '-' for stdin" )
+        parser.add_argument( '--format', dest='fmt', choices=bulk.FORMATS,
+                             help="Defaults to the file extension ( .csv, .jsonl or .json )" )
+        parser.add_argument( '--batch-size', type=int, default=bulk.DEFAULT_BATCH_SIZE )
+
+    def handle( self, *args, kind, path, fmt, batch_size, **options ):
+        fmt = fmt or bulk.format_from_name( path )
+        if fmt is None:
+            raise CommandError( "Cannot tell the format from the file name, pass --format." )
+
+        if '-' == path:
+            result = bulk.import_records( kind, bulk.read_records( sys.stdin, fmt ), batch_size )
+        else:
+            with open( path, newline='', encoding='utf-8' ) as stream:
+                result = bulk.import_records( kind, bulk.read_records( stream, fmt ), batch_size )
+
+        for line, message in result.errors:
+            self.stderr.write( f"line {line}: {message}" )
+        self.stdout.write( self.style.SUCCESS(
+            f"{kind}: {result.created} created, {result.updated} updated, "
+            f"{result.skipped} skipped, {len( result.errors )} rejected"
+        ) )
+
@@ -0,0 +1,23 @@
+# Purpose: Rebuild the precomputed open intervals of every library ( run nightly from cron )
+
+from django.core.management.base import BaseCommand
+
+from rooms import calendar
+from rooms.models import Library
+
+
+class Command( BaseCommand ):
+    help = "Expand library schedules and overrides into open intervals for the next weeks."
+
+    def add_arguments( self, parser ):
+        parser.add_argument( '--library', type=int, action='append', help="Only this library id ( repeatable )" )
+        parser.add_argument( '--weeks', type=int, help="Horizon, defaults to CALENDAR_HORIZON_WEEKS" )
+
+    def handle( self, *args, library, weeks, **options ):
+        libraries = Library.objects.all()
+        if library:
+            libraries = libraries.filter( pk__in=library )
+        for each in libraries:
+            count = calendar.materialize( each, weeks=weeks )
+            self.stdout.write( f"{each.name}: {count} open intervals until {each.calendar_until:%Y-%m-%d %H:%M} UTC" )
+        self.stdout.write( self.style.SUCCESS( "Calendar materialized" ) )
@@ -0,0 +1,13 @@
+# Purpose: Expire unaccepted waitlist holds and stale entries ( run every minute from cron )
+
+from django.core.management.base import BaseCommand
+
+from rooms import waitlist
+
+
+class Command( BaseCommand ):
+    help = "Expire waitlist holds nobody accepted in time and re-offer the freed slots."
+
+    def handle( self, *args, **options ):
+        holds, entries = waitlist.expire_holds()
+        self.stdout.write( self.style.SUCCESS( f"{holds} holds expired, {entries} stale entries expired" ) )
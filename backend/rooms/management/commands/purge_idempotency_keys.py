@@ -0,0 +1,12 @@
+# Purpose: Remove stored Idempotency-Key responses past their TTL ( run daily from cron )
+
+from django.core.management.base import BaseCommand
+
+from rooms.idempotency import purge_expired_keys
+
+
+class Command( BaseCommand ):
+    help = "Delete Idempotency-Key records older than IDEMPOTENCY_KEY_TTL_HOURS."
+
+    def handle( self, *args, **options ):
+        self.stdout.write( self.style.SUCCESS( f"{purge_expired_keys()} expired keys removed" ) )
@@ -0,0 +1,53 @@
+# Purpose: Run the outbox worker pool ( a long running process, start one or more per deployment )
+
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+
+from rooms import outbox
+
+
+class Command( BaseCommand ):
+    help = "Process outbox events ( emails, reminders, analytics ) until interrupted."
+
+    def add_arguments( self, parser ):
+        parser.add_argument( '--workers', type=int, default=4, help="Worker threads in this process" )
+        parser.add_argument( '--batch-size', type=int, help="Events per claim, defaults to OUTBOX_BATCH_SIZE" )
+        parser.add_argument( '--poll-interval', type=float, default=1.0, help="Seconds a worker sleeps when nothing is due" )
+        parser.add_argument( '--report-interval', type=float, default=60.0, help="Seconds between throughput reports" )
+        parser.add_argument( '--once', action='store_true', help="Process everything due now and exit" )
+
+    def handle( self, *args, workers, batch_size, poll_interval, report_interval, once, **options ):
+        if once:
+            started = time.monotonic()
+            processed = outbox.drain( batch_size )
+            self.stdout.write( self.style.SUCCESS(
+                f"{processed} events processed in {time.monotonic() - started:.2f}s" ) )
+            return
+
+        pool = outbox.WorkerPool( workers, batch_size=batch_size, poll_interval=poll_interval )
+        for signum in ( signal.SIGINT, signal.SIGTERM ):
+            signal.signal( signum, lambda *_: pool.stop_event.set() )
+        pool.start()
+        self.stdout.write( f"Outbox: {workers} workers started" )
+
+        last_count, last_report, last_purge = 0, time.monotonic(), 0.0
+        while not pool.stop_event.wait( report_interval ):
+            now = time.monotonic()
+            # this process's own rate, stats() reports the rate of every worker process together
+            rate = ( pool.processed - last_count ) / ( now - last_report )
+            last_count, last_report = pool.processed, now
+            stats = outbox.stats()
+            self.stdout.write(
+                f"Outbox: {rate:.1f} events/s here, {stats[ 'events_per_second' ]} events/s overall, "
+                f"{stats[ 'due' ]} due, {stats[ 'processing' ]} in flight, lag {stats[ 'lag_seconds' ]}s, {stats[ 'failed' ]} failed"
+            )
+            if now - last_purge >= 3600:
+                last_purge = now
+                purged = outbox.purge_processed()
+                if purged:
+                    self.stdout.write( f"Outbox: purged {purged} processed events" )
+
+        pool.stop()
+        self.stdout.write( self.style.SUCCESS( f"Outbox: stopped after {pool.processed} events" ) )
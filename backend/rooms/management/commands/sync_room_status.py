@@ -0,0 +1,13 @@
+# Purpose: Apply room closures that start or end now to Room.status ( run every minute from cron )
+
+from django.core.management.base import BaseCommand
+
+from rooms import room_status
+
+
+class Command( BaseCommand ):
+    help = "Set each room's status from the closure windows in effect now."
+
+    def handle( self, *args, **options ):
+        changed = room_status.sync_statuses()
+        self.stdout.write( self.style.SUCCESS( f"{changed} room statuses updated" ) )
@@ -0,0 +1,44 @@
+# Generated by Django 5.0.2 on 2026-10-18 22:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0002_material'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaitlistEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+                ('status', models.CharField(choices=[('waiting', 'Waiting'), ('offered', 'Hold Offered'), ('fulfilled', 'Fulfilled'), ('expired', 'Expired'), ('cancelled', 'Cancelled')], default='waiting', max_length=20)),
+                ('hold_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('floor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='waitlist_entries', to='rooms.floor')),
+                ('hold', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='waitlist_entries', to='rooms.reservation')),
+                ('room', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='waitlist_entries', to='rooms.room')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='waitlist_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Waitlist entries',
+                'ordering': ['created_at'],
+                'indexes': [models.Index(fields=['status', 'room', 'start_time', 'end_time'], name='waitlist_room_window_idx'), models.Index(fields=['status', 'floor', 'start_time', 'end_time'], name='waitlist_floor_window_idx'), models.Index(fields=['status', 'hold_expires_at'], name='waitlist_hold_expiry_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='waitlistentry',
+            constraint=models.CheckConstraint(check=models.Q(('end_time__gt', models.F('start_time'))), name='check_waitlist_end_time_after_start_time'),
+        ),
+        migrations.AddConstraint(
+            model_name='waitlistentry',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('floor__isnull', True), ('room__isnull', False)), models.Q(('floor__isnull', False), ('room__isnull', True)), _connector='OR'), name='check_waitlist_room_or_floor'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 22:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0004_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='floor',
+            name='layout_version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
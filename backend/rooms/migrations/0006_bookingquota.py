@@ -0,0 +1,52 @@
+# Generated by Django 5.0.2 on 2026-10-18 22:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('rooms', '0005_floor_layout_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookingQuota',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('max_hours_per_day', models.FloatField(blank=True, null=True)),
+                ('max_hours_per_week', models.FloatField(blank=True, null=True)),
+                ('max_active_reservations', models.PositiveIntegerField(blank=True, help_text='Upcoming or ongoing reservations at once', null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['user', 'status', 'end_time'], name='reservation_user_quota_idx'),
+        ),
+        migrations.AddField(
+            model_name='bookingquota',
+            name='group',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='booking_quotas', to='auth.group'),
+        ),
+        migrations.AddField(
+            model_name='bookingquota',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='booking_quotas', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='bookingquota',
+            constraint=models.CheckConstraint(check=models.Q(('user__isnull', True), ('group__isnull', True), _connector='OR'), name='check_quota_user_or_group'),
+        ),
+        migrations.AddConstraint(
+            model_name='bookingquota',
+            constraint=models.UniqueConstraint(condition=models.Q(('user__isnull', False)), fields=('user',), name='unique_quota_per_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='bookingquota',
+            constraint=models.UniqueConstraint(condition=models.Q(('group__isnull', False)), fields=('group',), name='unique_quota_per_group'),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.0.2 on 2026-10-18 22:24
+
+import django.db.models.deletion
+import rooms.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0006_bookingquota'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='library',
+            name='calendar_until',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='library',
+            name='time_zone',
+            field=models.CharField(default='UTC', help_text="IANA time zone of the opening hours (e.g. 'America/New_York')", max_length=64, validators=[rooms.models.validate_time_zone]),
+        ),
+        migrations.CreateModel(
+            name='ScheduleOverride',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('is_closed', models.BooleanField(default=False)),
+                ('opens_at', models.TimeField(blank=True, null=True)),
+                ('closes_at', models.TimeField(blank=True, null=True)),
+                ('note', models.CharField(blank=True, help_text="Shown to users, e.g. 'Thanksgiving'", max_length=255)),
+                ('library', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='schedule_overrides', to='rooms.library')),
+            ],
+            options={
+                'ordering': ['library', 'date', 'opens_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='WeeklySchedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weekday', models.PositiveSmallIntegerField(choices=[(0, 'Monday'), (1, 'Tuesday'), (2, 'Wednesday'), (3, 'Thursday'), (4, 'Friday'), (5, 'Saturday'), (6, 'Sunday')])),
+                ('opens_at', models.TimeField()),
+                ('closes_at', models.TimeField()),
+                ('library', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='weekly_schedules', to='rooms.library')),
+            ],
+            options={
+                'ordering': ['library', 'weekday', 'opens_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='OpenInterval',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+                ('library', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='open_intervals', to='rooms.library')),
+            ],
+            options={
+                'ordering': ['library', 'start_time'],
+                'indexes': [models.Index(fields=['library', 'end_time', 'start_time'], name='open_interval_lookup_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='openinterval',
+            constraint=models.CheckConstraint(check=models.Q(('end_time__gt', models.F('start_time'))), name='check_open_interval_end_after_start'),
+        ),
+        migrations.AddConstraint(
+            model_name='scheduleoverride',
+            constraint=models.CheckConstraint(check=models.Q(('is_closed', True), models.Q(('closes_at__isnull', False), ('opens_at__isnull', False)), _connector='OR'), name='check_override_closed_or_hours'),
+        ),
+    ]
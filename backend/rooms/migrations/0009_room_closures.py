@@ -0,0 +1,60 @@
+# Generated by Django 5.0.2 on 2026-10-18 22:36
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def close_unavailable_rooms(apps, schema_editor):
+    # rooms already out of service get an open ended closure, so bookings check them like any other
+    Room = apps.get_model('rooms', 'Room')
+    RoomClosure = apps.get_model('rooms', 'RoomClosure')
+    now = django.utils.timezone.now()
+    RoomClosure.objects.bulk_create([
+        RoomClosure(room=room, status=room.status, start_time=now, resolution='flag',
+                    reason="Out of service before closure windows existed")
+        for room in Room.objects.exclude(status='available')
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0008_outbox'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('maintenance', 'Under Maintenance'), ('closed', 'Closed')], max_length=20)),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField(blank=True, null=True)),
+                ('resolution', models.CharField(choices=[('cancel', 'Cancelled'), ('flag', 'Flagged for staff')], default='cancel', max_length=10)),
+                ('reason', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='closures', to='rooms.room')),
+            ],
+            options={
+                'ordering': ['-start_time'],
+            },
+        ),
+        migrations.AddField(
+            model_name='reservation',
+            name='closure',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='flagged_reservations', to='rooms.roomclosure'),
+        ),
+        migrations.AddIndex(
+            model_name='roomclosure',
+            index=models.Index(fields=['room', 'start_time'], name='room_closure_lookup_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='roomclosure',
+            constraint=models.CheckConstraint(check=models.Q(('end_time__isnull', True), ('end_time__gt', models.F('start_time')), _connector='OR'), name='check_closure_end_after_start'),
+        ),
+        migrations.RunPython(close_unavailable_rooms, migrations.RunPython.noop),
+    ]
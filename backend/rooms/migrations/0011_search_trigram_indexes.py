@@ -0,0 +1,52 @@
+# Generated by Django 5.0.2 on 2026-10-18 22:40
+
+from django.db import migrations
+
+
+# the indexes need the pg_trgm extension ( PostgreSQL contrib ), servers without it still migrate
+# and search falls back to unindexed substring matches; after installing contrib run
+#     manage.py migrate rooms 0010 && manage.py migrate
+# They are not in the models' Meta.indexes ( nor in the migration state ), since whether they exist
+# depends on the server, this migration is the only thing that creates or drops them
+TRIGRAM_INDEXES = [
+    # ( table, column, index name ), indexed as UPPER( column ) gin_trgm_ops
+    ('rooms_floor', 'description', 'floor_description_trgm_idx'),
+    ('rooms_library', 'name', 'library_name_trgm_idx'),
+    ('rooms_library', 'location', 'library_location_trgm_idx'),
+    ('rooms_library', 'description', 'library_description_trgm_idx'),
+    ('rooms_room', 'room_id', 'room_id_trgm_idx'),
+]
+
+
+def trigram_available(schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        return cursor.fetchone() is not None
+
+
+def create_indexes(apps, schema_editor):
+    if 'postgresql' != schema_editor.connection.vendor or not trigram_available(schema_editor):
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for table, column, name in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" USING gin ((UPPER("{column}")) gin_trgm_ops)'
+        )
+
+
+def drop_indexes(apps, schema_editor):
+    if 'postgresql' != schema_editor.connection.vendor:
+        return
+    for _, _, name in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS "{name}"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0010_calendar_feeds'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """ The sequence rooms/versions.py draws cache version numbers from. """
+
+    dependencies = [
+        ('rooms', '0011_search_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE SEQUENCE IF NOT EXISTS rooms_version_seq",
+            "DROP SEQUENCE IF EXISTS rooms_version_seq",
+        ),
+    ]
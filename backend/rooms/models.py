@@ -3,10 +3,22 @@
 # Modified: 2/28/2025 @ 9:20 PM EST
 
 from django.db import models
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Group, User
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
+import secrets
 import uuid
+import zoneinfo
+
+from . import versions
+
+def validate_time_zone( value ):
+    """ Reject names that are not IANA time zones ( e.g. 'America/New_York' ). """
+    try:
+        zoneinfo.ZoneInfo( value )
+    except ( zoneinfo.ZoneInfoNotFoundError, ValueError ):
+        raise ValidationError( f"{value} is not a known time zone." )
 
 class Library( models.Model ):
     """Model representing a physical library building on campus."""
@@ -18,20 +30,50 @@ class Library( models.Model ):
     description = models.TextField( blank=True )
 
     # TimeField stores the time of day (without date)
+    # default daily hours, used when the library has no weekly schedule
     opening_time = models.TimeField()
     closing_time = models.TimeField()
 
+    # schedules are written in the library's local time, reservations are stored in UTC
+    time_zone = models.CharField( max_length=64, default='UTC', validators=[ validate_time_zone ],
+                                  help_text="IANA time zone of the opening hours (e.g. 'America/New_York')" )
+
+    # end of the horizon materialized into OpenInterval rows, see rooms/calendar.py
+    calendar_until = models.DateTimeField( null=True, blank=True, editable=False )
+
     class Meta:
         # Meta class configures model-wide behaviors
         # controls how Django refers to multiple libraries in the admin
         verbose_name_plural = "Libraries"
         # default ordering when querying this model
         ordering = [ "name" ]
+        # the trigram indexes for search ( rooms/search.py ) are left to migration 0011, they only
+        # exist where pg_trgm is installed
 
     def __str__( self ):
         # determines how the object appears as a string
         return self.name
 
+    def save( self, *args, **kwargs ):
+        super().save( *args, **kwargs )
+        # cached data naming or counting libraries, floors and rooms is out of date
+        versions.bump_catalog()
+
+    def delete( self, *args, **kwargs ):
+        result = super().delete( *args, **kwargs )
+        versions.bump_catalog()
+        return result
+
+def is_number( value ):
+    # JSON numbers only, a bool is an int to python
+    return isinstance( value, ( int, float ) ) and not isinstance( value, bool )
+
+def is_outline( value ):
+    """ True for a list of [x, y] number pairs, a floor map outline. """
+    return isinstance( value, list ) and all(
+        isinstance( point, list ) and 2 == len( point ) and all( map( is_number, point ) ) for point in value
+    )
+
 class Floor( models.Model ):
     """Model representing a floor within a library."""
     # ForeignKey creats a many-to-one relationship
@@ -46,6 +88,10 @@ class Floor( models.Model ):
     floor_map = models.JSONField( blank=True, null=True, 
                                  help_text="JSON representation of the floor layout" )
 
+    # bumped whenever the floor is saved or one of its rooms is added, moved or removed ( Room.LAYOUT_FIELDS ),
+    # compiled maps are cached per version
+    layout_version = models.PositiveIntegerField( default=1, editable=False )
+
     class Meta:
         ordering = [ "library", "number" ]
         # unique_together ensures a library can't have duplicate floor numbers
@@ -54,6 +100,39 @@ class Floor( models.Model ):
     def __str__( self ):
         return f"{self.library.name} - Floor {self.number}"
 
+    def clean( self ):
+        """ Validate the floor_map keys the renderer reads ( rooms/floormaps.py ). """
+        if self.floor_map is None:
+            return
+        if not isinstance( self.floor_map, dict ):
+            raise ValidationError( { 'floor_map': "The floor map must be a JSON object." } )
+        for key in ( 'width', 'height' ):
+            value = self.floor_map.get( key )
+            if value is not None and ( not is_number( value ) or value <= 0 ):
+                raise ValidationError( { 'floor_map': f"The floor map's {key} must be a positive number." } )
+        outline = self.floor_map.get( 'outline' )
+        if outline is not None and not is_outline( outline ):
+            raise ValidationError( { 'floor_map': "The floor map's outline must be a list of [x, y] number pairs." } )
+
+    def save( self, *args, **kwargs ):
+        if self.pk and not kwargs.get( 'update_fields' ):
+            self.layout_version = models.F( 'layout_version' ) + 1
+        super().save( *args, **kwargs )
+        if isinstance( self.layout_version, models.expressions.Combinable ):
+            self.refresh_from_db( fields=[ 'layout_version' ] )
+        versions.bump_catalog()
+
+    def delete( self, *args, **kwargs ):
+        result = super().delete( *args, **kwargs )
+        versions.bump_catalog()
+        return result
+
+    @staticmethod
+    def bump_layout_version( *floor_ids ):
+        """ Invalidate the compiled maps of these floors ( one UPDATE ), and the cached catalog. """
+        Floor.objects.filter( pk__in=floor_ids ).update( layout_version=models.F( 'layout_version' ) + 1 )
+        versions.bump_catalog()
+
 class Room( models.Model ):
     """ Model representing a reserve-able study room. """
     room_id = models.CharField( max_length=20, unique=True, 
@@ -87,6 +166,34 @@ class Room( models.Model ):
     def __str__( self ):
         return f"{self.room_id} ({self.floor.library.name})"
 
+    # what the compiled floor maps are built from ( floormaps.py ), status and capacity are not part of them
+    LAYOUT_FIELDS = ( 'floor_id', 'room_id', 'position_x', 'position_y', 'width', 'height' )
+
+    @classmethod
+    def from_db( cls, db, field_names, values ):
+        instance = super().from_db( db, field_names, values )
+        # the layout it was loaded with, only a change to it invalidates the floor maps
+        instance._loaded_layout = instance._layout()
+        return instance
+
+    def _layout( self ):
+        return tuple( self.__dict__.get( name ) for name in self.LAYOUT_FIELDS )
+
+    def save( self, *args, **kwargs ):
+        loaded = getattr( self, '_loaded_layout', None )
+        super().save( *args, **kwargs )
+        layout = self._layout()
+        if layout != loaded:
+            # a moved room invalidates the map of the floor it left as well
+            Floor.bump_layout_version( *{ self.floor_id, loaded[ 0 ] if loaded else None } - { None } )
+        self._loaded_layout = layout
+
+    def delete( self, *args, **kwargs ):
+        floor_id = self.floor_id
+        result = super().delete( *args, **kwargs )
+        Floor.bump_layout_version( floor_id )
+        return result
+
     def is_available( self, start_time, end_time ):
         """ Check if room is available during the specified time period. """
         if 'available' != self.status:
@@ -97,7 +204,7 @@ class Room( models.Model ):
         # models.Q objects allow for complex queries ( think SQL )
         conflicting_reservations = self.reservations.filter(
             models.Q( start_time__lt=end_time ) & models.Q( end_time__gt=start_time ),
-            status__in=[ 'confirmed', 'pending' ]
+            status__in=Reservation.ACTIVE_STATUSES
         ).exists()
 
         return not conflicting_reservations
@@ -133,14 +240,29 @@ class Reservation( models.Model ):
     ]
     status = models.CharField( max_length=20, choices=STATUS_CHOICES, default='pending' )
 
+    # reservations in these states hold the room
+    ACTIVE_STATUSES = [ 'pending', 'confirmed' ]
+
     # additional fields for reservations
     purpose = models.CharField( max_length=255, blank=True,
                                help_text="Brief description of the reservation purpose" )
     num_attendees = models.IntegerField( default=1 )
     notes = models.TextField( blank=True )
 
+    # set when the room was closed over this reservation and staff chose to flag rather than cancel it
+    closure = models.ForeignKey( 'RoomClosure', on_delete=models.SET_NULL, null=True, blank=True,
+                                 related_name="flagged_reservations" )
+
     class Meta:
         ordering = [ "-start_time" ] # newest reservations first ( note the - sign )
+        indexes = [
+            # quota checks sum a user's active reservations that have not ended yet
+            models.Index( fields=[ 'user', 'status', 'end_time' ], name='reservation_user_quota_idx' ),
+            # a user's upcoming reservations in order, for their calendar feed
+            models.Index( fields=[ 'user', 'start_time' ], name='reservation_user_start_idx' ),
+            # a room's reservations in a time range ( availability, staff room feed )
+            models.Index( fields=[ 'room', 'start_time' ], name='reservation_room_start_idx' ),
+        ]
         # database-level constraint ensures end time is after start time
         # this is enforced even if someone bypasses Python validation
         constraints = [
@@ -155,6 +277,25 @@ class Reservation( models.Model ):
         end = self.end_time.strftime( '%H:%M' )
         return f"{self.room.room_id} - {srt} to {end}"
 
+    @classmethod
+    def from_db( cls, db, field_names, values ):
+        instance = super().from_db( db, field_names, values )
+        # the room it was loaded with, moving a reservation changes the availability of both rooms
+        instance._loaded_room_id = instance.__dict__.get( 'room_id' )
+        return instance
+
+    def save( self, *args, **kwargs ):
+        super().save( *args, **kwargs )
+        # cached availability ( heatmaps ) of the room's library is out of date
+        versions.bump_availability( room_ids={ self.room_id, getattr( self, '_loaded_room_id', None ) } )
+        self._loaded_room_id = self.room_id
+
+    def delete( self, *args, **kwargs ):
+        room_id = self.room_id
+        result = super().delete( *args, **kwargs )
+        versions.bump_availability( room_ids=[ room_id ] )
+        return result
+
     def clean( self ):
         """ Validate reservation times and availability. """
         # ensure start_time is in the future
@@ -184,19 +325,20 @@ class Reservation( models.Model ):
             if conflicting_reservations.exists():
                 raise ValidationError( "This room is already reserved during the selected time period." )
 
-        # now, check if the room status allows reservations
-        if 'available' != self.room.status:
-            raise ValidationError( "This room is not available for reservations at this time." )
-
-        # check if reservation is within library's opening hours
-        library = self.room.floor.library
-        start_time_hour = self.start_time.time()
-        end_time_hour = self.end_time.time()
-
-        if start_time_hour < library.opening_time or end_time_hour > library.closing_time:
-            raise ValidationError(
-                f"Reservations must be within library hours ({library.opening_time} - {library.closing_time})."
-            )
+        # now, check the room is not closed or under maintenance during the reservation
+        # imported here because rooms.calendar and rooms.room_status import this module
+        from .room_status import RoomUnavailable, check_room_open
+        try:
+            check_room_open( self.room, self.start_time, self.end_time )
+        except RoomUnavailable as unavailable:
+            raise ValidationError( str( unavailable ) )
+
+        # check if reservation is within library's opening hours ( in the library's time zone )
+        from .calendar import LibraryClosed, check_open
+        try:
+            check_open( self.room.floor.library, self.start_time, self.end_time )
+        except LibraryClosed as closed:
+            raise ValidationError( str( closed ) )
         
         # check if number of attendees exceeds room capacity
         if self.num_attendees > self.room.capacity:
@@ -219,3 +361,290 @@ class Material(models.Model):
 
     def __str__(self):
         return f"{self.get_name_display()} - {self.library.name}"
+
+class WaitlistEntry( models.Model ):
+    """ Model representing a user waiting for a room ( or any room on a floor ) to free up. """
+    user = models.ForeignKey( User, on_delete=models.CASCADE, related_name="waitlist_entries" )
+
+    # exactly one of room / floor is set, a floor entry accepts any room on that floor
+    room = models.ForeignKey( Room, on_delete=models.CASCADE, null=True, blank=True,
+                              related_name="waitlist_entries" )
+    floor = models.ForeignKey( Floor, on_delete=models.CASCADE, null=True, blank=True,
+                               related_name="waitlist_entries" )
+
+    # the window the user wants, the whole window must be free to be offered
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+
+    STATUS_CHOICES = [
+        ( 'waiting', 'Waiting' ),
+        ( 'offered', 'Hold Offered' ),
+        ( 'fulfilled', 'Fulfilled' ),
+        ( 'expired', 'Expired' ),
+        ( 'cancelled', 'Cancelled' )
+    ]
+    status = models.CharField( max_length=20, choices=STATUS_CHOICES, default='waiting' )
+
+    # pending reservation created for the user when a matching slot frees up
+    hold = models.ForeignKey( Reservation, on_delete=models.SET_NULL, null=True, blank=True,
+                              related_name="waitlist_entries" )
+    hold_expires_at = models.DateTimeField( null=True, blank=True )
+
+    created_at = models.DateTimeField( auto_now_add=True )
+
+    class Meta:
+        verbose_name_plural = "Waitlist entries"
+        # first come, first served
+        ordering = [ "created_at" ]
+        # matching looks up waiting entries of one room / floor whose window overlaps the freed interval
+        indexes = [
+            models.Index( fields=[ 'status', 'room', 'start_time', 'end_time' ], name='waitlist_room_window_idx' ),
+            models.Index( fields=[ 'status', 'floor', 'start_time', 'end_time' ], name='waitlist_floor_window_idx' ),
+            models.Index( fields=[ 'status', 'hold_expires_at' ], name='waitlist_hold_expiry_idx' ),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q( end_time__gt=models.F( 'start_time' ) ),
+                name='check_waitlist_end_time_after_start_time'
+            ),
+            models.CheckConstraint(
+                check=models.Q( room__isnull=False, floor__isnull=True ) | models.Q( room__isnull=True, floor__isnull=False ),
+                name='check_waitlist_room_or_floor'
+            )
+        ]
+
+    def __str__( self ):
+        target = self.room.room_id if self.room_id else str( self.floor )
+        return f"{self.user.username} waiting for {target} at {self.start_time.strftime( '%Y-%m-%d %H:%M' )}"
+
+class IdempotencyKey( models.Model ):
+    """ Model storing the response to a write sent with an Idempotency-Key header, so retries replay it. """
+    user = models.ForeignKey( User, on_delete=models.CASCADE, related_name="idempotency_keys" )
+    # the client generated key ( usually a UUID )
+    key = models.CharField( max_length=255 )
+
+    # hash of method, path and body, a key reused for a different request is rejected
+    fingerprint = models.CharField( max_length=64 )
+
+    # filled in before the transaction that claimed the key commits
+    response_status = models.IntegerField( null=True, blank=True )
+    response_body = models.JSONField( null=True, blank=True, encoder=DjangoJSONEncoder )
+
+    created_at = models.DateTimeField( auto_now_add=True )
+    # keys are forgotten after IDEMPOTENCY_KEY_TTL_HOURS
+    expires_at = models.DateTimeField( db_index=True )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint( fields=[ 'user', 'key' ], name='unique_idempotency_key_per_user' )
+        ]
+
+    def __str__( self ):
+        return f"{self.user.username}: {self.key}"
+
+class BookingQuota( models.Model ):
+    """ Model representing booking limits for one user, one role ( auth group ) or everyone. """
+    # set user for a personal quota, group for a role quota, neither for the default quota
+    # the most specific level wins: user, then role ( most generous of the user's groups ), then default
+    user = models.ForeignKey( User, on_delete=models.CASCADE, null=True, blank=True, related_name="booking_quotas" )
+    group = models.ForeignKey( Group, on_delete=models.CASCADE, null=True, blank=True, related_name="booking_quotas" )
+
+    # blank means no limit
+    max_hours_per_day = models.FloatField( null=True, blank=True )
+    max_hours_per_week = models.FloatField( null=True, blank=True )
+    max_active_reservations = models.PositiveIntegerField( null=True, blank=True,
+                                                           help_text="Upcoming or ongoing reservations at once" )
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q( user__isnull=True ) | models.Q( group__isnull=True ),
+                name='check_quota_user_or_group'
+            ),
+            models.UniqueConstraint( fields=[ 'user' ], condition=models.Q( user__isnull=False ),
+                                     name='unique_quota_per_user' ),
+            models.UniqueConstraint( fields=[ 'group' ], condition=models.Q( group__isnull=False ),
+                                     name='unique_quota_per_group' ),
+        ]
+
+    def __str__( self ):
+        if self.user_id:
+            return f"Quota for {self.user.username}"
+        if self.group_id:
+            return f"Quota for role {self.group.name}"
+        return "Default quota"
+
+class WeeklySchedule( models.Model ):
+    """ Model representing one opening period of a library on a day of the week ( local time ). """
+    WEEKDAY_CHOICES = [
+        ( 0, 'Monday' ), ( 1, 'Tuesday' ), ( 2, 'Wednesday' ), ( 3, 'Thursday' ),
+        ( 4, 'Friday' ), ( 5, 'Saturday' ), ( 6, 'Sunday' )
+    ]
+    library = models.ForeignKey( Library, on_delete=models.CASCADE, related_name="weekly_schedules" )
+    weekday = models.PositiveSmallIntegerField( choices=WEEKDAY_CHOICES )
+
+    # a closing time at or before the opening time runs past midnight, 00:00 - 00:00 is open all day
+    opens_at = models.TimeField()
+    closes_at = models.TimeField()
+
+    class Meta:
+        ordering = [ "library", "weekday", "opens_at" ]
+
+    def __str__( self ):
+        return f"{self.library.name} {self.get_weekday_display()} {self.opens_at} - {self.closes_at}"
+
+class ScheduleOverride( models.Model ):
+    """ Model representing different hours ( or a closure ) of a library on one date, e.g. holidays or exam week. """
+    library = models.ForeignKey( Library, on_delete=models.CASCADE, related_name="schedule_overrides" )
+    date = models.DateField()
+
+    # the overrides of a date replace its weekly schedule, a closed override keeps the library shut all day
+    is_closed = models.BooleanField( default=False )
+    opens_at = models.TimeField( null=True, blank=True )
+    closes_at = models.TimeField( null=True, blank=True )
+    note = models.CharField( max_length=255, blank=True, help_text="Shown to users, e.g. 'Thanksgiving'" )
+
+    class Meta:
+        ordering = [ "library", "date", "opens_at" ]
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q( is_closed=True ) | models.Q( opens_at__isnull=False, closes_at__isnull=False ),
+                name='check_override_closed_or_hours'
+            )
+        ]
+
+    def __str__( self ):
+        hours = "closed" if self.is_closed else f"{self.opens_at} - {self.closes_at}"
+        return f"{self.library.name} {self.date}: {hours}"
+
+class OpenInterval( models.Model ):
+    """ Model representing a precomputed stretch of time ( UTC ) during which a library is open. """
+    # rebuilt from the schedules by rooms/calendar.py, never edited by hand
+    library = models.ForeignKey( Library, on_delete=models.CASCADE, related_name="open_intervals" )
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+
+    class Meta:
+        ordering = [ "library", "start_time" ]
+        indexes = [
+            # intervals of a library never overlap, so the first one ending at or after a time is the only
+            # one that can contain it ( covering index, the lookup never touches the table )
+            models.Index( fields=[ 'library', 'end_time', 'start_time' ], name='open_interval_lookup_idx' ),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q( end_time__gt=models.F( 'start_time' ) ),
+                name='check_open_interval_end_after_start'
+            )
+        ]
+
+    def __str__( self ):
+        return f"{self.library.name} open {self.start_time:%Y-%m-%d %H:%M} - {self.end_time:%Y-%m-%d %H:%M} UTC"
+
+class OutboxEvent( models.Model ):
+    """ Model representing a side effect ( email, analytics update ) waiting to be processed by the outbox workers. """
+    # written in the same transaction as the change that caused it, so it exists exactly when the change does
+    topic = models.CharField( max_length=50 )
+    payload = models.JSONField( encoder=DjangoJSONEncoder )
+
+    STATUS_CHOICES = [
+        ( 'pending', 'Pending' ),
+        ( 'processing', 'Processing' ),   # claimed by a worker until available_at ( its lease )
+        ( 'done', 'Done' ),
+        ( 'failed', 'Failed' )   # gave up after OUTBOX_MAX_ATTEMPTS
+    ]
+    status = models.CharField( max_length=20, choices=STATUS_CHOICES, default='pending' )
+    attempts = models.PositiveIntegerField( default=0 )
+    last_error = models.TextField( blank=True )
+
+    # not processed before this time, used for scheduled events ( reminders ), retry backoff and worker leases
+    available_at = models.DateTimeField( default=timezone.now )
+    created_at = models.DateTimeField( auto_now_add=True )
+    processed_at = models.DateTimeField( null=True, blank=True )
+
+    class Meta:
+        ordering = [ "available_at", "id" ]
+        indexes = [
+            # workers claim the oldest due events, only unfinished rows are indexed so the index stays small
+            models.Index( fields=[ 'available_at', 'id' ], condition=models.Q( status__in=[ 'pending', 'processing' ] ),
+                          name='outbox_unfinished_idx' ),
+            models.Index( fields=[ 'status', 'processed_at' ], name='outbox_processed_idx' ),
+        ]
+
+    def __str__( self ):
+        return f"{self.topic} #{self.pk} ({self.status})"
+
+class RoomUsage( models.Model ):
+    """ Model representing the bookings of one room on one day ( library time ), kept up to date by the outbox. """
+    room = models.ForeignKey( Room, on_delete=models.CASCADE, related_name="usage" )
+    date = models.DateField()
+    bookings = models.PositiveIntegerField( default=0 )
+    cancellations = models.PositiveIntegerField( default=0 )
+    # minutes currently held by active reservations starting that day
+    booked_minutes = models.IntegerField( default=0 )
+
+    class Meta:
+        ordering = [ "-date", "room" ]
+        constraints = [
+            models.UniqueConstraint( fields=[ 'room', 'date' ], name='unique_room_usage_per_day' )
+        ]
+
+    def __str__( self ):
+        return f"{self.room.room_id} on {self.date}: {self.bookings} bookings"
+
+class RoomClosure( models.Model ):
+    """ Model representing a window during which a room is under maintenance or closed ( see room_status.py ). """
+    room = models.ForeignKey( Room, on_delete=models.CASCADE, related_name="closures" )
+    # the Room.status the room has during the window
+    status = models.CharField( max_length=20, choices=Room.STATUS_CHOICES[ 1: ] )
+    start_time = models.DateTimeField()
+    # null until the room is reopened
+    end_time = models.DateTimeField( null=True, blank=True )
+
+    # what happened to the reservations the window overlapped when it was created
+    RESOLUTION_CHOICES = [
+        ( 'cancel', 'Cancelled' ),
+        ( 'flag', 'Flagged for staff' )
+    ]
+    resolution = models.CharField( max_length=10, choices=RESOLUTION_CHOICES, default='cancel' )
+    reason = models.CharField( max_length=255, blank=True )
+    created_by = models.ForeignKey( User, on_delete=models.SET_NULL, null=True, blank=True, related_name="+" )
+    created_at = models.DateTimeField( auto_now_add=True )
+
+    class Meta:
+        ordering = [ "-start_time" ]
+        indexes = [
+            models.Index( fields=[ 'room', 'start_time' ], name='room_closure_lookup_idx' ),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q( end_time__isnull=True ) | models.Q( end_time__gt=models.F( 'start_time' ) ),
+                name='check_closure_end_after_start'
+            )
+        ]
+
+    def __str__( self ):
+        until = f"{self.end_time:%Y-%m-%d %H:%M}" if self.end_time else "further notice"
+        return f"{self.room.room_id} {self.status} {self.start_time:%Y-%m-%d %H:%M} until {until}"
+
+    def save( self, *args, **kwargs ):
+        super().save( *args, **kwargs )
+        versions.bump_availability( room_ids=[ self.room_id ] )
+
+    def delete( self, *args, **kwargs ):
+        room_id = self.room_id
+        result = super().delete( *args, **kwargs )
+        versions.bump_availability( room_ids=[ room_id ] )
+        return result
+
+def new_feed_token():
+    return secrets.token_urlsafe( 32 )
+
+class CalendarFeedToken( models.Model ):
+    """ Model holding the secret in a user's calendar feed URLs, calendar apps cannot log in so the URL is the login. """
+    user = models.OneToOneField( User, on_delete=models.CASCADE, related_name="calendar_feed_token" )
+    token = models.CharField( max_length=64, unique=True, default=new_feed_token )
+    created_at = models.DateTimeField( auto_now_add=True )
+
+    def __str__( self ):
+        return f"Calendar feed of {self.user.username}"
@@ -0,0 +1,210 @@
+# Purpose: Transactional outbox, side effects run by a database backed worker pool
+
+import logging
+import random
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from .models import OutboxEvent
+
+"""
+Side effects of a change ( emails, reminders, analytics ) are not run in the request
+emit() inserts an OutboxEvent in the same transaction as the change, so an event exists
+exactly when the change committed, and the request only pays for one INSERT
+
+Workers ( manage.py run_outbox ) claim due events in batches with
+SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers in any number of processes
+share the table without handing out an event twice and without a broker
+The claim is its own short transaction: it marks the batch processing with a lease of
+OUTBOX_LEASE_SECONDS and commits, so no row lock is held while handlers wait on a mail server.
+An event whose worker died is due again once its lease runs out
+Each event then runs its handlers in a transaction of its own:
+    success     the event is marked done in the same transaction as the handlers' own writes
+    failure     its writes are rolled back, it is retried after an exponential backoff with jitter,
+                and marked failed after OUTBOX_MAX_ATTEMPTS
+    lease lost  ( the handlers outran the lease and another worker claimed the event ) its writes are
+                rolled back, the other worker's run counts
+Database side effects therefore happen exactly once, emails at least once
+"""
+
+# pending, or processing by a worker whose lease may have run out
+CLAIMABLE_STATUSES = ( 'pending', 'processing' )
+
+logger = logging.getLogger( __name__ )
+
+_handlers = {}
+
+
+def handler( topic ):
+    """ Register a function( payload ) to run for every event of `topic`. """
+    def register( function ):
+        _handlers.setdefault( topic, [] ).append( function )
+        return function
+    return register
+
+
+def emit( topic, payload, available_at=None ):
+    """ Record an event in the current transaction, it is processed once that commits ( at `available_at` ). """
+    return OutboxEvent.objects.create( topic=topic, payload=payload, available_at=available_at or timezone.now() )
+
+
+def emit_many( topic, payloads ):
+    """ Record one event per payload with a single INSERT. """
+    now = timezone.now()
+    return OutboxEvent.objects.bulk_create( [
+        OutboxEvent( topic=topic, payload=payload, available_at=now ) for payload in payloads
+    ] )
+
+
+def backoff( attempts ):
+    """ Delay before retry number `attempts`: doubling from OUTBOX_RETRY_BASE_SECONDS, capped, with jitter. """
+    delay = min( settings.OUTBOX_RETRY_MAX_SECONDS, settings.OUTBOX_RETRY_BASE_SECONDS * 2 ** ( attempts - 1 ) )
+    return timedelta( seconds=delay * random.uniform( 0.5, 1.0 ) )
+
+
+def dispatch( event ):
+    for function in _handlers.get( event.topic, [] ):
+        function( event.payload )
+
+
+class LeaseLost( Exception ):
+    """ Raised to roll back a handler run whose event another worker claimed in the meantime. """
+
+
+def claim( batch_size=None ):
+    """ Claim up to `batch_size` due events for this worker ( committed at once ), oldest first. """
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    now = timezone.now()
+    with transaction.atomic():
+        events = list(
+            OutboxEvent.objects.select_for_update( skip_locked=True ).filter(
+                status__in=CLAIMABLE_STATUSES, available_at__lte=now
+            ).order_by( 'available_at', 'id' )[ :batch_size ]
+        )
+        lease_until = now + timedelta( seconds=settings.OUTBOX_LEASE_SECONDS )
+        for event in events:
+            event.status = 'processing'
+            event.attempts += 1
+            event.available_at = lease_until
+        # one UPDATE for the whole batch
+        OutboxEvent.objects.bulk_update( events, [ 'status', 'attempts', 'available_at' ] )
+    return events
+
+
+def _record( event, **fields ):
+    """ Store the outcome of a claimed event, False if another worker has claimed it since. """
+    return 1 == OutboxEvent.objects.filter(
+        pk=event.pk, status='processing', attempts=event.attempts ).update( **fields )
+
+
+def run( event ):
+    """ Run the handlers of a claimed event and record the outcome. """
+    try:
+        with transaction.atomic():
+            dispatch( event )
+            if not _record( event, status='done', processed_at=timezone.now() ):
+                raise LeaseLost()
+        return
+    except LeaseLost:
+        logger.warning( "Outbox event %s (%s) outran its lease, left to the worker that claimed it", event.pk, event.topic )
+        return
+    except Exception as exc:
+        last_error = ''.join( traceback.format_exception_only( exc ) ).strip()[ :2000 ]
+
+    if event.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+        _record( event, status='failed', last_error=last_error, processed_at=timezone.now() )
+        logger.error( "Outbox event %s (%s) failed for good: %s", event.pk, event.topic, last_error )
+    else:
+        _record( event, status='pending', last_error=last_error,
+                 available_at=timezone.now() + backoff( event.attempts ) )
+        logger.warning( "Outbox event %s (%s) failed, retrying: %s", event.pk, event.topic, last_error )
+
+
+def process_batch( batch_size=None ):
+    """ Claim up to `batch_size` due events, run their handlers and record the outcome, returns how many were claimed. """
+    events = claim( batch_size )
+    for event in events:
+        run( event )
+    return len( events )
+
+
+def drain( batch_size=None ):
+    """ Process batches until nothing is due, returns the number of events processed. """
+    total = 0
+    while True:
+        claimed = process_batch( batch_size )
+        total += claimed
+        if not claimed:
+            return total
+
+
+class WorkerPool:
+    """ Threads that each loop over process_batch(), sleeping `poll_interval` when nothing is due. """
+
+    def __init__( self, workers, batch_size=None, poll_interval=1.0 ):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.processed = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _work( self ):
+        while not self.stop_event.is_set():
+            close_old_connections()
+            try:
+                claimed = process_batch( self.batch_size )
+            except Exception:
+                logger.exception( "Outbox batch failed" )
+                claimed = 0
+            with self._lock:
+                self.processed += claimed
+            if not claimed:
+                self.stop_event.wait( self.poll_interval )
+        connection.close()
+
+    def start( self ):
+        self._threads = [
+            threading.Thread( target=self._work, name=f"outbox-{number}", daemon=True )
+            for number in range( self.workers )
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop( self ):
+        self.stop_event.set()
+        for thread in self._threads:
+            thread.join()
+
+
+def stats( window_seconds=60 ):
+    """ Backlog, events in flight, lag ( age of the oldest due event ) and throughput over the last `window_seconds`. """
+    now = timezone.now()
+    due = OutboxEvent.objects.filter( status__in=CLAIMABLE_STATUSES, available_at__lte=now ).aggregate(
+        count=Count( 'pk' ), oldest=Min( 'available_at' ) )
+    processed = OutboxEvent.objects.filter(
+        status='done', processed_at__gte=now - timedelta( seconds=window_seconds ) ).count()
+    return {
+        'due': due[ 'count' ],
+        'scheduled': OutboxEvent.objects.filter( status='pending', available_at__gt=now ).count(),
+        'processing': OutboxEvent.objects.filter( status='processing', available_at__gt=now ).count(),
+        'failed': OutboxEvent.objects.filter( status='failed' ).count(),
+        'lag_seconds': round( ( now - due[ 'oldest' ] ).total_seconds(), 3 ) if due[ 'oldest' ] else 0.0,
+        'processed_last_window': processed,
+        'events_per_second': round( processed / window_seconds, 2 ),
+        'window_seconds': window_seconds,
+    }
+
+
+def purge_processed( now=None ):
+    """ Delete events done more than OUTBOX_RETENTION_DAYS ago, returns how many were removed. """
+    cutoff = ( now or timezone.now() ) - timedelta( days=settings.OUTBOX_RETENTION_DAYS )
+    deleted, _ = OutboxEvent.objects.filter( status='done', processed_at__lt=cutoff ).delete()
+    return deleted
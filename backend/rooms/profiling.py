@@ -0,0 +1,301 @@
+# Purpose: Opt-in request profiling in production ( stack samples and SQL of a fraction of requests )
+
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.utils import timezone
+
+from .throttling import LocalBucketStore
+
+"""
+With PROFILING_ENABLED, ProfilingMiddleware profiles
+    a random PROFILING_SAMPLE_RATE fraction of requests, and
+    requests carrying the PROFILING_HEADER header ( X-Profile: 1 ) sent by staff, their response
+    has an X-Profile-Id header. The header is only looked at on requests with credentials, a staff
+    session or an Authorization header. A JWT client is only known to be staff once the view has run,
+    so such a request is profiled anyway and the profile dropped if it was not staff's. Header
+    profiles draw from one PROFILING_HEADER_BUCKET per process, so a client with a token cannot
+    have every one of its requests profiled
+Without PROFILING_ENABLED the middleware removes itself, requests pay nothing
+
+A profile holds
+    stack samples   one background thread looks at the stack of every thread handling a profiled
+                    request each PROFILING_INTERVAL seconds ( wall clock, so time spent waiting on
+                    the database or a lock shows up as well ). While the request's thread holds the GIL
+                    the sampler waits for it, up to sys.getswitchinterval() ( 5 ms ), each sample
+                    is weighted by the time since the previous one so totals stay right
+    SQL             every statement the request ran on its thread's connection with its duration
+                    ( no parameters, they can carry personal data ), the first PROFILING_MAX_QUERIES kept
+The last PROFILING_BUFFER_SIZE profiles of each worker process are kept in memory, staff list the
+slowest at rooms/metrics/profiles/ and download one as a speedscope profile ( speedscope.app ) or as
+collapsed stacks ( flamegraph.pl, speedscope ) from rooms/metrics/profiles/<id>/
+
+Async views ( async_views.py ) share their event loop thread with other requests, their samples
+only show the thread waiting for the loop
+"""
+
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+# deeper stacks are cut at the root end
+MAX_STACK_DEPTH = 128
+
+
+def _stack( frame ):
+    """ ( file, function, first line ) of every frame of a stack, outermost first. """
+    stack = []
+    while frame is not None and len( stack ) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        stack.append( ( code.co_filename, code.co_name, code.co_firstlineno ) )
+        frame = frame.f_back
+    stack.reverse()
+    return tuple( stack )
+
+
+class Profile:
+    """ The stack samples and SQL of one request. """
+
+    def __init__( self, request, reason ):
+        self.id = uuid.uuid4().hex[ :12 ]
+        self.reason = reason
+        self.method = request.method
+        self.path = request.get_full_path()
+        self.started_at = timezone.now()
+        self.status = None
+        self.user = None
+        self.duration = 0.0
+        # stack -> seconds sampled in it
+        self.samples = Counter()
+        self.sample_count = 0
+        self.queries = []
+        self.query_count = 0
+        self.query_seconds = 0.0
+        self._last_sample = time.perf_counter()
+
+    def add_sample( self, stack ):
+        now = time.perf_counter()
+        self.samples[ stack ] += now - self._last_sample
+        self.sample_count += 1
+        self._last_sample = now
+
+    def record_query( self, execute, sql, params, many, context ):
+        """ connection.execute_wrapper() hook. """
+        started = time.perf_counter()
+        try:
+            return execute( sql, params, many, context )
+        finally:
+            elapsed = time.perf_counter() - started
+            self.query_count += 1
+            self.query_seconds += elapsed
+            if len( self.queries ) < settings.PROFILING_MAX_QUERIES:
+                self.queries.append( { 'sql': sql, 'many': many, 'ms': round( elapsed * 1000, 3 ) } )
+
+    def finish( self, response, user, duration ):
+        self.status = response.status_code
+        self.user = user.get_username() if user is not None and user.is_authenticated else None
+        self.duration = duration
+
+    def summary( self ):
+        return {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'status': self.status,
+            'user': self.user,
+            'reason': self.reason,
+            'started_at': self.started_at,
+            'duration_ms': round( self.duration * 1000, 3 ),
+            'query_count': self.query_count,
+            'query_ms': round( self.query_seconds * 1000, 3 ),
+            'samples': self.sample_count,
+        }
+
+    def detail( self ):
+        detail = self.summary()
+        detail[ 'queries' ] = self.queries
+        return detail
+
+    def speedscope( self ):
+        """ The samples as a speedscope 'sampled' profile ( https://www.speedscope.app/file-format-schema.json ). """
+        frames, index = [], {}
+        samples, weights = [], []
+        for stack, seconds in self.samples.items():
+            for frame in stack:
+                if frame not in index:
+                    index[ frame ] = len( frames )
+                    frames.append( { 'name': frame[ 1 ], 'file': frame[ 0 ], 'line': frame[ 2 ] } )
+            samples.append( [ index[ frame ] for frame in stack ] )
+            weights.append( seconds )
+        name = f"{self.method} {self.path}"
+        return {
+            '$schema': SPEEDSCOPE_SCHEMA,
+            'name': name,
+            'exporter': 'libmaster',
+            'activeProfileIndex': 0,
+            'shared': { 'frames': frames },
+            'profiles': [ {
+                'type': 'sampled',
+                'name': name,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': sum( weights ),
+                'samples': samples,
+                'weights': weights,
+            } ],
+        }
+
+    def collapsed( self ):
+        """ The samples as collapsed stacks, one 'outer;...;inner microseconds' line per stack. """
+        return "".join(
+            ";".join( f"{name} ({filename}:{line})" for filename, name, line in stack ) + f" {round( seconds * 1000000 )}\n"
+            for stack, seconds in self.samples.most_common()
+        )
+
+
+class _Sampler:
+    """ One thread sampling the stacks of the threads that are handling a profiled request. """
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self._profiles = {}
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start( self, profile ):
+        with self._lock:
+            self._profiles[ threading.get_ident() ] = profile
+            if self._thread is None:
+                self._thread = threading.Thread( target=self._run, name='profiling-sampler', daemon=True )
+                self._thread.start()
+        self._wakeup.set()
+
+    def stop( self ):
+        with self._lock:
+            self._profiles.pop( threading.get_ident(), None )
+
+    def _run( self ):
+        while True:
+            # sampling under the lock, once stop() returns the profile gets no more samples
+            with self._lock:
+                sampling = bool( self._profiles )
+                if sampling:
+                    frames = sys._current_frames()
+                    for thread_id, profile in self._profiles.items():
+                        if thread_id in frames:
+                            profile.add_sample( _stack( frames[ thread_id ] ) )
+                    # frames keep every local variable of the sampled threads alive
+                    del frames
+                else:
+                    self._wakeup.clear()
+            if sampling:
+                time.sleep( settings.PROFILING_INTERVAL )
+            else:
+                self._wakeup.wait()
+
+
+class _Recent:
+    """ The last PROFILING_BUFFER_SIZE profiles of this process. """
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self._profiles = deque()
+
+    def add( self, profile ):
+        with self._lock:
+            self._profiles.append( profile )
+            while len( self._profiles ) > settings.PROFILING_BUFFER_SIZE:
+                self._profiles.popleft()
+
+    def slowest( self, limit ):
+        with self._lock:
+            profiles = list( self._profiles )
+        return sorted( profiles, key=lambda profile: profile.duration, reverse=True )[ :limit ]
+
+    def get( self, profile_id ):
+        with self._lock:
+            return next( ( profile for profile in self._profiles if profile.id == profile_id ), None )
+
+    def clear( self ):
+        with self._lock:
+            self._profiles.clear()
+
+
+sampler = _Sampler()
+recent = _Recent()
+
+
+def _header( request ):
+    return request.META.get( 'HTTP_' + settings.PROFILING_HEADER.upper().replace( '-', '_' ) )
+
+
+def _is_staff( user ):
+    return user is not None and user.is_authenticated and user.is_staff
+
+
+_header_bucket = LocalBucketStore()
+
+
+def _header_allowed():
+    """ Take a token from the bucket of header requested profiles, False when it is empty. """
+    rate, burst = settings.PROFILING_HEADER_BUCKET
+    return not _header_bucket.take( [ ( 'profile:header', rate, burst ) ] )[ 0 ]
+
+
+class ProfilingMiddleware:
+    """ Profiles sampled and staff requested requests into `recent`, see the module notes. """
+
+    def __init__( self, get_response ):
+        if not getattr( settings, 'PROFILING_ENABLED', False ):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def _reason( self, request ):
+        if _header( request ):
+            user = getattr( request, 'user', None )
+            # a session user is known up front, a JWT one only after the view ( checked in __call__ )
+            if user is not None and user.is_authenticated:
+                credentials = user.is_staff
+            else:
+                credentials = bool( request.META.get( 'HTTP_AUTHORIZATION' ) )
+            if credentials and _header_allowed():
+                return 'header'
+        if random.random() < settings.PROFILING_SAMPLE_RATE:
+            return 'sampled'
+        return None
+
+    def __call__( self, request ):
+        reason = self._reason( request )
+        if reason is None:
+            return self.get_response( request )
+
+        profile = Profile( request, reason )
+        started = time.perf_counter()
+        with connection.execute_wrapper( profile.record_query ):
+            sampler.start( profile )
+            try:
+                response = self.get_response( request )
+            finally:
+                sampler.stop()
+        duration = time.perf_counter() - started
+
+        # DRF sets request.user once it has authenticated the request
+        user = getattr( request, 'user', None )
+        if 'header' == reason and not _is_staff( user ):
+            return response
+        profile.finish( response, user, duration )
+        recent.add( profile )
+        if 'header' == reason:
+            response[ 'X-Profile-Id' ] = profile.id
+        return response
+
+
+def reset():
+    """ Forget the buffered profiles and the header profile bucket ( tests ). """
+    recent.clear()
+    _header_bucket.clear()
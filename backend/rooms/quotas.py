@@ -0,0 +1,116 @@
+# Purpose: Enforce per-user and per-role booking quotas
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Count, DateTimeField, DurationField, ExpressionWrapper, Q, Sum, Value
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
+from . import calendar
+from .models import BookingQuota, Reservation
+
+"""
+check_quota() runs inside the booking transaction, after the room lock
+It locks the user's row so concurrent bookings by the same user are serialized, then reads
+everything it needs with one aggregate over the user's reservations that have not ended before
+the start of the week ( an index range scan on user / status / end_time )
+Days and weeks ( starting Monday ) are the library's, in its time zone, as everywhere else in calendar.py
+"""
+
+QUOTA_FIELDS = ( 'max_hours_per_day', 'max_hours_per_week', 'max_active_reservations' )
+
+
+class QuotaExceeded( Exception ):
+    """ Raised when a reservation would take a user past one of their booking limits. """
+
+    def __init__( self, message, limit, value ):
+        super().__init__( message )
+        self.limit = limit
+        self.value = value
+
+
+def resolve_quota( user ):
+    """ The limits that apply to `user`, a dict of QUOTA_FIELDS ( None means unlimited ). """
+    rows = list( BookingQuota.objects.filter(
+        Q( user=user ) | Q( group__in=user.groups.all() ) | Q( user__isnull=True, group__isnull=True )
+    ).order_by( 'pk' ) )
+
+    personal = [ row for row in rows if row.user_id ]
+    roles = [ row for row in rows if row.group_id ]
+    defaults = [ row for row in rows if not row.user_id and not row.group_id ]
+    source = personal or roles or defaults[ :1 ]
+    if not source:
+        configured = getattr( settings, 'RESERVATION_QUOTA_DEFAULTS', {} )
+        return { name: configured.get( name ) for name in QUOTA_FIELDS }
+
+    # a user in several roles gets the most generous limit of each kind
+    limits = {}
+    for name in QUOTA_FIELDS:
+        values = [ getattr( row, name ) for row in source ]
+        limits[ name ] = None if None in values else max( values )
+    return limits
+
+
+def _overlap( start_time, end_time, window_start, window_end ):
+    return max( min( end_time, window_end ) - max( start_time, window_start ), timedelta() )
+
+
+def _clipped_duration( window_start, window_end ):
+    """ SQL expression for the part of a reservation that falls inside the window. """
+    return ExpressionWrapper(
+        Least( 'end_time', Value( window_end, output_field=DateTimeField() ) )
+        - Greatest( 'start_time', Value( window_start, output_field=DateTimeField() ) ),
+        output_field=DurationField()
+    )
+
+
+def check_quota( user, start_time, end_time, library, exclude=None ):
+    """ Raise QuotaExceeded if booking [start_time, end_time) at `library` would exceed the user's limits. """
+    limits = resolve_quota( user )
+    if all( limit is None for limit in limits.values() ):
+        return
+
+    # serialize bookings by the same user, the aggregate below then sees every committed booking
+    User.objects.select_for_update().filter( pk=user.pk ).first()
+
+    day = calendar.local_date( library, start_time )
+    day_start, day_end = calendar.local_day_bounds( library, day )
+    monday = day - timedelta( days=day.weekday() )
+    week_start = calendar.local_day_bounds( library, monday )[ 0 ]
+    week_end = calendar.local_day_bounds( library, monday + timedelta( days=7 ) )[ 0 ]
+    now = timezone.now()
+
+    reservations = Reservation.objects.filter(
+        user=user,
+        status__in=Reservation.ACTIVE_STATUSES,
+        end_time__gt=min( week_start, now ),
+    )
+    if exclude is not None:
+        reservations = reservations.exclude( pk=exclude.pk )
+    totals = reservations.aggregate(
+        day=Sum( _clipped_duration( day_start, day_end ),
+                 filter=Q( start_time__lt=day_end, end_time__gt=day_start ) ),
+        week=Sum( _clipped_duration( week_start, week_end ),
+                  filter=Q( start_time__lt=week_end, end_time__gt=week_start ) ),
+        active=Count( 'pk', filter=Q( end_time__gt=now ) ),
+    )
+
+    hour = timedelta( hours=1 )
+    day_hours = ( ( totals[ 'day' ] or timedelta() ) + _overlap( start_time, end_time, day_start, day_end ) ) / hour
+    week_hours = ( ( totals[ 'week' ] or timedelta() ) + _overlap( start_time, end_time, week_start, week_end ) ) / hour
+    active = totals[ 'active' ] + ( 1 if end_time > now else 0 )
+
+    if limits[ 'max_hours_per_day' ] is not None and day_hours > limits[ 'max_hours_per_day' ]:
+        raise QuotaExceeded(
+            f"This booking would exceed your limit of {limits[ 'max_hours_per_day' ]:g} hours per day.",
+            'max_hours_per_day', day_hours )
+    if limits[ 'max_hours_per_week' ] is not None and week_hours > limits[ 'max_hours_per_week' ]:
+        raise QuotaExceeded(
+            f"This booking would exceed your limit of {limits[ 'max_hours_per_week' ]:g} hours per week.",
+            'max_hours_per_week', week_hours )
+    if limits[ 'max_active_reservations' ] is not None and active > limits[ 'max_active_reservations' ]:
+        raise QuotaExceeded(
+            f"You can hold at most {limits[ 'max_active_reservations' ]} active reservations.",
+            'max_active_reservations', active )
@@ -0,0 +1,151 @@
+# Purpose: Room status transitions ( maintenance, closed, reopened ) and what they do to reservations
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import events, versions
+from .models import Reservation, Room, RoomClosure
+
+"""
+Taking a room out of service is a RoomClosure window [start_time, end_time), open ended until the room is
+reopened. transition() writes it in one transaction that holds the room's row lock, the same lock every
+booking takes before its overlap check ( booking.py ), so a booking racing the transition either
+    commits first      and is cancelled or flagged by the transition's UPDATE, or
+    waits for the lock and then sees the closure and is refused ( RoomUnavailable )
+There is no interleaving in which a reservation ends up inside a closure unnoticed
+
+Overlapping active reservations are locked with one SELECT ... FOR UPDATE, changed with one UPDATE
+and their events written with one INSERT:
+    cancel      status becomes cancelled, users get a cancellation email
+    flag        reservations stay, point at the closure ( Reservation.closure ) and users are told
+                staff will follow up
+
+Room.status is what the room is now, transition() sets it when the window has started and
+sync_statuses() ( manage.py sync_room_status, every minute from cron ) when a window starts or ends later
+"""
+
+UNAVAILABLE_MESSAGE = "This room is not available for reservations during the selected time period."
+
+
+class RoomUnavailable( Exception ):
+    """ Raised when a reservation overlaps a window in which its room is closed or under maintenance. """
+
+    def __init__( self, room, start_time, end_time, closure ):
+        super().__init__( UNAVAILABLE_MESSAGE )
+        self.room = room
+        self.start_time = start_time
+        self.end_time = end_time
+        self.closure = closure
+
+
+def _overlapping( start_time, end_time ):
+    """ Closures overlapping [start_time, end_time), an end_time of None means open ended. """
+    overlap = Q( end_time__isnull=True ) | Q( end_time__gt=start_time )
+    if end_time is not None:
+        overlap &= Q( start_time__lt=end_time )
+    return overlap
+
+
+def closures( room, start_time, end_time ):
+    return RoomClosure.objects.filter( _overlapping( start_time, end_time ), room=room )
+
+
+def check_room_open( room, start_time, end_time ):
+    """ Raise RoomUnavailable if the room is closed for any part of [start_time, end_time). """
+    closure = closures( room, start_time, end_time ).order_by( 'start_time' ).first()
+    if closure is not None:
+        raise RoomUnavailable( room, start_time, end_time, closure )
+
+
+def _active_reservations( room, start_time, end_time ):
+    reservations = Reservation.objects.filter(
+        room=room, status__in=Reservation.ACTIVE_STATUSES, end_time__gt=start_time )
+    if end_time is not None:
+        reservations = reservations.filter( start_time__lt=end_time )
+    return reservations
+
+
+def transition( room, status, start_time=None, end_time=None, resolution='cancel', reason='', user=None ):
+    """
+    Put `room` into `status` from `start_time` ( default now ) until `end_time` ( None: until reopened ).
+    'maintenance' and 'closed' create a RoomClosure and cancel or flag ( `resolution` ) the active
+    reservations it overlaps, 'available' reopens the room from `start_time` on.
+    Returns ( closure or None, number of reservations cancelled, flagged or unflagged ).
+    """
+    now = timezone.now()
+    start_time = start_time or now
+    with transaction.atomic():
+        # the lock bookings of this room take first, see booking.save_reservation
+        room = Room.objects.select_for_update().get( pk=room.pk )
+        if 'available' == status:
+            closure, affected = None, _reopen( room, start_time )
+        else:
+            closure = RoomClosure.objects.create(
+                room=room, status=status, start_time=start_time, end_time=end_time,
+                resolution=resolution, reason=reason, created_by=user,
+            )
+            affected = _close( room, closure, now )
+
+        if start_time <= now and room.status != status:
+            Room.objects.filter( pk=room.pk ).update( status=status )
+        events.room_status_changed( room, status, start_time, end_time, affected )
+        # the closure's save() covers closing, reopening changes closures and reservations in bulk
+        versions.bump_availability( room_ids=[ room.pk ] )
+    return closure, affected
+
+
+def close_new_rooms( rooms, reason='', user=None ):
+    """
+    An open ended closure from now for every just created room whose status is not 'available', so bookings
+    are refused until it is reopened ( a new room has no reservations to cancel or flag ).
+    """
+    now = timezone.now()
+    closures = RoomClosure.objects.bulk_create( [
+        RoomClosure( room=room, status=room.status, start_time=now, reason=reason, created_by=user )
+        for room in rooms if 'available' != room.status
+    ] )
+    if closures:
+        # bulk_create skips RoomClosure.save()
+        versions.bump_availability( room_ids=[ closure.room_id for closure in closures ] )
+    return closures
+
+
+def _close( room, closure, now ):
+    reservations = _active_reservations( room, closure.start_time, closure.end_time )
+    if 'flag' == closure.resolution:
+        # reservations flagged by an earlier closure keep pointing at that one
+        reservations = reservations.filter( closure__isnull=True )
+    # new bookings wait on the room lock, the row locks keep a concurrent cancel from being counted twice
+    affected = list( reservations.select_for_update() )
+    changed = Reservation.objects.filter( pk__in=[ reservation.pk for reservation in affected ] )
+    if 'cancel' == closure.resolution:
+        changed.update( status='cancelled', modified_at=now )
+    else:
+        changed.update( closure=closure, modified_at=now )
+    events.reservations_closed( affected, closure )
+    return len( affected )
+
+
+def _reopen( room, start_time ):
+    """ End every closure of the room at `start_time`, and unflag the reservations no longer inside one. """
+    current = RoomClosure.objects.filter( _overlapping( start_time, None ), room=room )
+    current.filter( start_time__gte=start_time ).delete()
+    current.filter( start_time__lt=start_time ).update( end_time=start_time )
+    return Reservation.objects.filter(
+        room=room, closure__isnull=False, start_time__gte=F( 'closure__end_time' )
+    ).update( closure=None )
+
+
+def sync_statuses( now=None ):
+    """ Bring Room.status in line with the closures in effect at `now`, returns the number of rooms changed. """
+    now = now or timezone.now()
+    in_effect = RoomClosure.objects.filter(
+        _overlapping( now, None ), room=OuterRef( 'pk' ), start_time__lte=now
+    ).order_by( '-start_time' ).values( 'status' )[ :1 ]
+    current = Coalesce( Subquery( in_effect ), Value( 'available' ) )
+    # rooms never closed through a transition keep whatever status they were given
+    stale = Room.objects.filter( pk__in=RoomClosure.objects.values( 'room' ) ).annotate(
+        current=current ).exclude( status=F( 'current' ) )
+    return Room.objects.filter( pk__in=stale.values( 'pk' ) ).update( status=current )
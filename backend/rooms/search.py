@@ -0,0 +1,171 @@
+# Purpose: Index backed fuzzy search over libraries, floors and rooms ( typeahead and admin )
+
+import threading
+import time
+
+from django.contrib.postgres.lookups import TrigramWordSimilar
+from django.contrib.postgres.search import TrigramWordSimilarity
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Case, FloatField, Q, Value, When
+from django.db.models.functions import Greatest, Upper
+
+from .models import Floor, Library, Room
+
+"""
+Every searched text column has a GIN index over UPPER( column ) with the pg_trgm operator class
+( migration 0011 ), which serves both kinds of match used here:
+    substring   column__icontains, Django's UPPER( column ) LIKE UPPER( '%term%' ), the admin's own lookup
+    fuzzy       UPPER( column ) %> term, the term is similar to a word of the column ( pg_trgm
+                word_similarity above pg_trgm.word_similarity_threshold ), so 'strozer' finds 'Strozier'
+Results are ranked by word_similarity, best first
+
+pg_trgm ships with PostgreSQL's contrib package; on a server without it the migration skips the
+indexes and search falls back to substring matches ranked exact > prefix > substring
+( sequential scans, fine for development data ). Whether it is installed is checked per database
+alias and rechecked every EXTENSION_CHECK_SECONDS, so installing it needs no restart
+"""
+
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+DEFAULT_LIMIT = 5
+MAX_LIMIT = 20
+# how long the answer to "is pg_trgm installed?" is trusted
+EXTENSION_CHECK_SECONDS = 300
+
+# searched columns and their weight in the rank, per kind of result
+KINDS = {
+    'library': ( Library, ( ( 'name', 1.0 ), ( 'location', 0.6 ), ( 'description', 0.3 ) ) ),
+    'floor': ( Floor, ( ( 'description', 0.6 ), ( 'library__name', 0.5 ) ) ),
+    'room': ( Room, ( ( 'room_id', 1.0 ), ) ),
+}
+
+
+class _Extensions:
+    """ Per database alias, whether pg_trgm is installed and when that was checked. """
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self._checked = {}
+
+    def installed( self, alias ):
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checked.get( alias )
+        if checked is not None and now - checked[ 0 ] < EXTENSION_CHECK_SECONDS:
+            return checked[ 1 ]
+        with connections[ alias ].cursor() as cursor:
+            cursor.execute( "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'" )
+            installed = cursor.fetchone() is not None
+        with self._lock:
+            self._checked[ alias ] = ( now, installed )
+        return installed
+
+    def clear( self ):
+        with self._lock:
+            self._checked.clear()
+
+
+extensions = _Extensions()
+
+
+def trigram_enabled( alias=DEFAULT_DB_ALIAS ):
+    """ Whether pg_trgm is installed in the database behind `alias` ( rechecked every EXTENSION_CHECK_SECONDS ). """
+    return 'postgresql' == connections[ alias ].vendor and extensions.installed( alias )
+
+
+def _field( model, path ):
+    """ The model field at `path` ( e.g. 'floor__library__name' ). """
+    *relations, name = path.split( '__' )
+    for relation in relations:
+        model = model._meta.get_field( relation ).related_model
+    return model._meta.get_field( name )
+
+
+def _word_matches( model, fields, word ):
+    condition = Q()
+    for path in fields:
+        field = _field( model, path )
+        if field.get_internal_type() not in ( 'CharField', 'TextField' ):
+            # numbers ( a floor number ) match exactly, when the word is one
+            try:
+                condition |= Q( **{ path: field.to_python( word ) } )
+            except ValidationError:
+                pass
+            continue
+        condition |= Q( **{ f"{path}__icontains": word } )
+        if trigram_enabled():
+            condition |= Q( TrigramWordSimilar( Upper( path ), Value( word ) ) )
+    return condition
+
+
+def matches( model, fields, term ):
+    """ Q for rows where every word of `term` matches at least one of `fields`. """
+    condition = Q()
+    for word in term.split():
+        condition &= _word_matches( model, fields, word )
+    return condition
+
+
+def _field_rank( field, term ):
+    if trigram_enabled():
+        return TrigramWordSimilarity( term, field )
+    return Case(
+        When( **{ f"{field}__iexact": term }, then=Value( 1.0 ) ),
+        When( **{ f"{field}__istartswith": term }, then=Value( 0.8 ) ),
+        When( **{ f"{field}__icontains": term }, then=Value( 0.5 ) ),
+        default=Value( 0.0 ),
+        output_field=FloatField(),
+    )
+
+
+def rank( weighted_fields, term ):
+    """ Expression scoring how well a row matches `term`, the best weighted field counts. """
+    scores = [ _field_rank( field, term ) * Value( weight ) for field, weight in weighted_fields ]
+    return scores[ 0 ] if 1 == len( scores ) else Greatest( *scores )
+
+
+def clean_term( term ):
+    """ The term as searched, None when it is too short to search for. """
+    term = ' '.join( ( term or '' ).split() )[ :MAX_TERM_LENGTH ]
+    return term if len( term ) >= MIN_TERM_LENGTH else None
+
+
+def ranked( kind, term, limit=DEFAULT_LIMIT, related=() ):
+    """ The best `limit` rows of one kind for `term`, annotated with their score. """
+    model, weighted_fields = KINDS[ kind ]
+    fields = [ field for field, _ in weighted_fields ]
+    return model.objects.select_related( *related ).filter( matches( model, fields, term ) ).annotate(
+        score=rank( weighted_fields, term )
+    ).order_by( '-score', 'pk' )[ :limit ]
+
+
+def typeahead( term, kinds=None, limit=DEFAULT_LIMIT ):
+    """ Ranked libraries, floors and rooms matching `term`, at most `limit` of each. """
+    term = clean_term( term )
+    kinds = kinds or list( KINDS )
+    results = { 'query': term, 'libraries': [], 'floors': [], 'rooms': [] }
+    if term is None:
+        return results
+    if 'library' in kinds:
+        results[ 'libraries' ] = [
+            { 'id': library.pk, 'name': library.name, 'location': library.location, 'score': round( library.score, 3 ) }
+            for library in ranked( 'library', term, limit )
+        ]
+    if 'floor' in kinds:
+        results[ 'floors' ] = [
+            {
+                'id': floor.pk, 'library': floor.library_id, 'library_name': floor.library.name,
+                'number': floor.number, 'description': floor.description, 'score': round( floor.score, 3 ),
+            }
+            for floor in ranked( 'floor', term, limit, related=( 'library', ) )
+        ]
+    if 'room' in kinds:
+        results[ 'rooms' ] = [
+            {
+                'room_id': room.room_id, 'library_name': room.floor.library.name, 'floor_number': room.floor.number,
+                'capacity': room.capacity, 'status': room.status, 'score': round( room.score, 3 ),
+            }
+            for room in ranked( 'room', term, limit, related=( 'floor__library', ) )
+        ]
+    return results
@@ -1,15 +1,17 @@
 from rest_framework import serializers
-from .models import Library, Floor, Room, Reservation, Material
+from django.conf import settings
+from django.utils import timezone
+from .models import Library, Floor, Room, Reservation, Material, WaitlistEntry, RoomClosure
 
 class LibrarySerializer(serializers.ModelSerializer):
     class Meta:
         model = Library
-        fields = ['id', 'name', 'location', 'description', 'opening_time', 'closing_time']
+        fields = ['id', 'name', 'location', 'description', 'opening_time', 'closing_time', 'time_zone']
 
 class FloorSerializer(serializers.ModelSerializer):
     class Meta:
         model = Floor
-        fields = ['id', 'library', 'number', 'description', 'floor_map']
+        fields = ['id', 'library', 'number', 'description', 'floor_map', 'layout_version']
 
 class RoomSerializer(serializers.ModelSerializer):
     library_name = serializers.CharField(source='floor.library.name', read_only=True)
@@ -32,14 +34,151 @@ class ReservationSerializer(serializers.ModelSerializer):
         fields = [
             'reservation_id', 'room', 'room_id', 'user', 'username',
             'start_time', 'end_time', 'status', 'purpose', 
-            'num_attendees', 'notes', 'created_at', 'modified_at'
+            'num_attendees', 'notes', 'closure', 'created_at', 'modified_at'
         ]
-        read_only_fields = ['reservation_id', 'user', 'created_at', 'modified_at']
+        # closure is set when the room was closed over the reservation, see room_status.py
+        read_only_fields = ['reservation_id', 'user', 'closure', 'created_at', 'modified_at']
+
+    def validate(self, attrs):
+        start_time = attrs.get('start_time', getattr(self.instance, 'start_time', None))
+        end_time = attrs.get('end_time', getattr(self.instance, 'end_time', None))
+        if start_time and end_time and end_time <= start_time:
+            raise serializers.ValidationError("Reservation end time must be after start time.")
+        return attrs
+
+
+class RoomClosureSerializer(serializers.ModelSerializer):
+    flagged_reservations = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+
+    class Meta:
+        model = RoomClosure
+        fields = [
+            'id', 'status', 'start_time', 'end_time', 'resolution', 'reason',
+            'created_by', 'created_at', 'flagged_reservations'
+        ]
+
+class RoomStatusChangeSerializer(serializers.Serializer):
+    status = serializers.ChoiceField(choices=Room.STATUS_CHOICES)
+    # defaults to now, a later start schedules the change
+    start_time = serializers.DateTimeField(required=False)
+    # until reopened when left out
+    end_time = serializers.DateTimeField(required=False, allow_null=True)
+    resolution = serializers.ChoiceField(choices=RoomClosure.RESOLUTION_CHOICES, default='cancel')
+    reason = serializers.CharField(max_length=255, required=False, allow_blank=True, default='')
+
+    def validate(self, attrs):
+        start_time = attrs.get('start_time') or timezone.now()
+        end_time = attrs.get('end_time')
+        if 'available' == attrs['status'] and end_time is not None:
+            raise serializers.ValidationError("A room is reopened from start_time on, end_time only applies to closures.")
+        if end_time is not None and end_time <= max(start_time, timezone.now()):
+            raise serializers.ValidationError("end_time must be after start_time and in the future.")
+        return attrs
+
+
+class WaitlistEntrySerializer(serializers.ModelSerializer):
+    room_id = serializers.SlugRelatedField(
+        source='room', slug_field='room_id', queryset=Room.objects.all(), required=False, allow_null=True
+    )
+
+    class Meta:
+        model = WaitlistEntry
+        fields = [
+            'id', 'room_id', 'floor', 'start_time', 'end_time',
+            'status', 'hold', 'hold_expires_at', 'created_at'
+        ]
+        read_only_fields = ['id', 'status', 'hold', 'hold_expires_at', 'created_at']
+
+    def validate(self, attrs):
+        if (attrs.get('room') is None) == (attrs.get('floor') is None):
+            raise serializers.ValidationError("Wait for either a room_id or a floor, not both.")
+        if attrs['end_time'] <= attrs['start_time']:
+            raise serializers.ValidationError("end_time must be after start_time.")
+        if attrs['start_time'] <= timezone.now():
+            raise serializers.ValidationError("start_time must be in the future.")
+        return attrs
 
 
 class RoomAvailabilitySerializer(serializers.Serializer):
     date = serializers.DateField()
 
+class TimeWindowSerializer(serializers.Serializer):
+    start = serializers.DateTimeField()
+    end = serializers.DateTimeField()
+
+    def validate(self, attrs):
+        if attrs['end'] <= attrs['start']:
+            raise serializers.ValidationError("end must be after start.")
+        return attrs
+
+class RoomSuggestionSerializer(TimeWindowSerializer):
+    days = serializers.IntegerField(required=False, min_value=1, max_value=7, default=1)
+    limit = serializers.IntegerField(required=False, min_value=1, max_value=20, default=5)
+    scope = serializers.ChoiceField(choices=['floor', 'library'], required=False, default='floor')
+
+class HeatmapQuerySerializer(serializers.Serializer):
+    # exactly one of room ( its room_id ), floor or library
+    room = serializers.CharField(required=False)
+    floor = serializers.IntegerField(required=False)
+    library = serializers.IntegerField(required=False)
+    # local dates, both included, start defaults to today and end to a week from start
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    resolution = serializers.ChoiceField(choices=['day', 'hour'], required=False, default='day')
+
+    def validate(self, attrs):
+        scopes = [scope for scope in ('room', 'floor', 'library') if scope in attrs]
+        if 1 != len(scopes):
+            raise serializers.ValidationError("Give exactly one of room, floor or library.")
+        attrs['scope'] = scopes[0]
+        return attrs
+
+class SearchQuerySerializer(serializers.Serializer):
+    SEARCH_KINDS = ('library', 'floor', 'room')
+
+    q = serializers.CharField(allow_blank=True)
+    # comma separated, e.g. ?kinds=library,room
+    kinds = serializers.CharField(required=False, default=','.join(SEARCH_KINDS))
+    limit = serializers.IntegerField(required=False, min_value=1, max_value=20, default=5)
+
+    def validate_kinds(self, value):
+        kinds = [kind for kind in value.split(',') if kind]
+        unknown = sorted(set(kinds) - set(self.SEARCH_KINDS))
+        if unknown:
+            raise serializers.ValidationError(f"Unknown kinds: {', '.join(unknown)}.")
+        return kinds
+
+class BatchRequestSerializer(serializers.Serializer):
+    # defaults to the sub-request's position in the batch
+    id = serializers.CharField(required=False, max_length=64)
+    method = serializers.CharField(required=False, default='GET')
+    # e.g. /rooms/rooms/STR101/availability/?date=2025-03-01
+    path = serializers.CharField(max_length=2048)
+    # query parameters added to those of the path, a list value repeats the parameter
+    params = serializers.DictField(required=False, default=dict)
+
+    def validate_method(self, value):
+        return value.upper()
+
+class BatchSerializer(serializers.Serializer):
+    requests = serializers.ListField(child=BatchRequestSerializer(), min_length=1)
+
+    def validate_requests(self, value):
+        limit = settings.BATCH_MAX_REQUESTS
+        if len(value) > limit:
+            raise serializers.ValidationError(f"At most {limit} requests can be batched.")
+        for position, spec in enumerate(value):
+            spec.setdefault('id', str(position))
+        ids = [spec['id'] for spec in value]
+        if len(set(ids)) != len(ids):
+            raise serializers.ValidationError("Request ids must be unique.")
+        return value
+
+class MapPointSerializer(serializers.Serializer):
+    x = serializers.FloatField()
+    y = serializers.FloatField()
+    radius = serializers.FloatField(required=False, min_value=0, default=0)
+
 class MaterialSerializer(serializers.ModelSerializer):
     class Meta:
         model = Material
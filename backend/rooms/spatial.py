@@ -0,0 +1,96 @@
+# Purpose: Static R-tree over room rectangles for hit testing and radius queries
+
+import math
+
+"""
+Floors are small and change rarely, so the index is bulk loaded once per floor layout version
+with Sort-Tile-Recursive packing ( every node is full, the tree is perfectly balanced )
+Point and radius queries only descend into nodes whose bounding box can still match,
+which is O(log n) plus the number of results
+"""
+
+NODE_CAPACITY = 8
+
+
+class _Node:
+    __slots__ = ( 'bbox', 'children', 'leaf' )
+
+    def __init__( self, children, leaf ):
+        self.children = children
+        self.leaf = leaf
+        boxes = [ child[ 0 ] if leaf else child.bbox for child in children ]
+        self.bbox = (
+            min( box[ 0 ] for box in boxes ), min( box[ 1 ] for box in boxes ),
+            max( box[ 2 ] for box in boxes ), max( box[ 3 ] for box in boxes ),
+        )
+
+
+def _center( box ):
+    return ( ( box[ 0 ] + box[ 2 ] ) / 2, ( box[ 1 ] + box[ 3 ] ) / 2 )
+
+
+def _pack( entries, bbox_of, leaf, capacity ):
+    """ One level of Sort-Tile-Recursive packing, returns the parent nodes. """
+    node_count = math.ceil( len( entries ) / capacity )
+    slice_count = math.ceil( math.sqrt( node_count ) )
+    slice_size = slice_count * capacity
+
+    entries = sorted( entries, key=lambda entry: _center( bbox_of( entry ) )[ 0 ] )
+    nodes = []
+    for start in range( 0, len( entries ), slice_size ):
+        vertical_slice = sorted( entries[ start:start + slice_size ], key=lambda entry: _center( bbox_of( entry ) )[ 1 ] )
+        for offset in range( 0, len( vertical_slice ), capacity ):
+            nodes.append( _Node( vertical_slice[ offset:offset + capacity ], leaf ) )
+    return nodes
+
+
+def _distance_to_box( x, y, box ):
+    dx = max( box[ 0 ] - x, 0, x - box[ 2 ] )
+    dy = max( box[ 1 ] - y, 0, y - box[ 3 ] )
+    return math.hypot( dx, dy )
+
+
+class RTree:
+    """ Read-only R-tree of ( ( min_x, min_y, max_x, max_y ), value ) entries. """
+
+    def __init__( self, entries, capacity=NODE_CAPACITY ):
+        self.size = len( entries )
+        self.root = None
+        if not entries:
+            return
+        nodes = _pack( list( entries ), lambda entry: entry[ 0 ], True, capacity )
+        while len( nodes ) > 1:
+            nodes = _pack( nodes, lambda node: node.bbox, False, capacity )
+        self.root = nodes[ 0 ]
+
+    def __len__( self ):
+        return self.size
+
+    def _search( self, may_contain, matches ):
+        if self.root is None:
+            return
+        stack = [ self.root ]
+        while stack:
+            node = stack.pop()
+            if not may_contain( node.bbox ):
+                continue
+            if node.leaf:
+                for box, value in node.children:
+                    if matches( box ):
+                        yield box, value
+            else:
+                stack.extend( node.children )
+
+    def at_point( self, x, y ):
+        """ Values whose rectangle contains ( x, y ). """
+        def contains( box ):
+            return box[ 0 ] <= x <= box[ 2 ] and box[ 1 ] <= y <= box[ 3 ]
+        return [ value for _, value in self._search( contains, contains ) ]
+
+    def within( self, x, y, radius ):
+        """ ( distance, value ) pairs for rectangles within `radius` of ( x, y ), nearest first. """
+        def near( box ):
+            return _distance_to_box( x, y, box ) <= radius
+        found = [ ( _distance_to_box( x, y, box ), value ) for box, value in self._search( near, near ) ]
+        found.sort( key=lambda pair: pair[ 0 ] )
+        return found
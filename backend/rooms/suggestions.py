@@ -0,0 +1,169 @@
+# Purpose: Suggest free time windows and alternative rooms when a booking conflicts
+
+import math
+from datetime import timedelta
+
+from django.db.models import F, Q, Value
+from django.db.models.functions import Abs
+from django.utils import timezone
+
+from . import calendar
+from .calendar import merge_intervals
+from .models import Room, Reservation, RoomClosure
+
+"""
+Suggestions are computed from one bulk fetch of booked intervals for every candidate room,
+after that all gap finding happens in memory
+The search horizon and the number of candidate rooms are both capped, so the cost of a request
+is bounded even when the whole library is searched
+"""
+
+DEFAULT_HORIZON_DAYS = 1
+MAX_HORIZON_DAYS = 7
+DEFAULT_LIMIT = 5
+MAX_LIMIT = 20
+MAX_CANDIDATE_ROOMS = 200
+
+AMENITIES = ( 'has_whiteboard', 'has_monitor', 'has_window' )
+
+
+def free_windows( busy, open_windows, duration, limit ):
+    """
+    Return up to `limit` back-to-back ( start, end ) windows of `duration`
+    inside `open_windows` that do not touch any interval in `busy`.
+    Both inputs are sorted lists of non-overlapping ( start, end ) pairs.
+    """
+    windows = []
+    index = 0
+    for open_start, open_end in open_windows:
+        cursor = open_start
+        # skip bookings that ended before this open window
+        while index < len( busy ) and busy[ index ][ 1 ] <= cursor:
+            index += 1
+        # the window's own cursor, an interval running past open_end ( an overnight closure ) must still
+        # be seen by the next window, so `index` only moves past intervals that ended
+        probe = index
+        while cursor + duration <= open_end:
+            if probe < len( busy ) and busy[ probe ][ 0 ] < cursor + duration:
+                # the next booking cuts into the candidate, resume after it
+                cursor = max( cursor, busy[ probe ][ 1 ] )
+                probe += 1
+                continue
+            windows.append( ( cursor, cursor + duration ) )
+            if len( windows ) >= limit:
+                return windows
+            cursor += duration
+    return windows
+
+
+def is_free( busy, start, end ):
+    """ True if [start, end) does not overlap any interval in `busy`. """
+    return not any( booked_start < end and booked_end > start for booked_start, booked_end in busy )
+
+
+def _distance( origin, room ):
+    if None in ( origin.position_x, origin.position_y, room.position_x, room.position_y ):
+        return None
+    return math.hypot( room.position_x - origin.position_x, room.position_y - origin.position_y )
+
+
+def suggest( room, start, end, days=DEFAULT_HORIZON_DAYS, limit=DEFAULT_LIMIT, scope='floor' ):
+    """
+    Suggestions for booking `room` between `start` and `end`:
+    the earliest free windows of the same length in that room over the next `days`, and
+    rooms on the same floor ( or library ) with at least the same capacity and amenities
+    that are free for the requested window, nearest first.
+    """
+    days = min( max( days, 1 ), MAX_HORIZON_DAYS )
+    limit = min( max( limit, 1 ), MAX_LIMIT )
+    duration = end - start
+    library = room.floor.library
+
+    # candidate rooms: same capacity or more and every amenity the requested room has
+    candidates = Room.objects.select_related( 'floor' ).filter(
+        status='available',
+        capacity__gte=room.capacity,
+        **{ amenity: True for amenity in AMENITIES if getattr( room, amenity ) }
+    ).exclude( pk=room.pk )
+    if 'library' == scope:
+        candidates = candidates.filter( floor__library=library )
+    else:
+        candidates = candidates.filter( floor=room.floor )
+    # the cap keeps the nearest rooms: same floor first, then by floors away, then by distance on the map
+    candidates = candidates.annotate(
+        floors_away=Abs( F( 'floor__number' ) - Value( room.floor.number ) ) )
+    ordering = [ 'floors_away' ]
+    if None not in ( room.position_x, room.position_y ):
+        # squared, the order is the same
+        candidates = candidates.annotate( map_distance=(
+            ( F( 'position_x' ) - Value( room.position_x ) ) * ( F( 'position_x' ) - Value( room.position_x ) )
+            + ( F( 'position_y' ) - Value( room.position_y ) ) * ( F( 'position_y' ) - Value( room.position_y ) )
+        ) )
+        ordering.append( F( 'map_distance' ).asc( nulls_last=True ) )
+    candidates = list( candidates.order_by( *ordering, 'room_id' )[ :MAX_CANDIDATE_ROOMS ] )
+
+    # look from the start of the requested day ( never the past ) so earlier free slots are offered too
+    day_start, _ = calendar.local_day_bounds( library, calendar.local_date( library, start ) )
+    horizon_start = max( day_start, timezone.now() )
+    horizon_end = horizon_start + timedelta( days=days )
+
+    # one query for every interval the suggestions need
+    busy = { room.pk: [] }
+    busy.update( { candidate.pk: [] for candidate in candidates } )
+    for room_pk, booked_start, booked_end in Reservation.objects.filter(
+        room_id__in=busy.keys(),
+        status__in=Reservation.ACTIVE_STATUSES,
+        start_time__lt=max( horizon_end, end ),
+        end_time__gt=min( horizon_start, start ),
+    ).order_by( 'start_time' ).values_list( 'room_id', 'start_time', 'end_time' ):
+        busy[ room_pk ].append( ( booked_start, booked_end ) )
+    # closure windows ( room_status.py ) are as busy as a reservation, an open ended one runs past the horizon
+    window_end = max( horizon_end, end )
+    for room_pk, closed_start, closed_end in RoomClosure.objects.filter(
+        Q( end_time__isnull=True ) | Q( end_time__gt=min( horizon_start, start ) ),
+        room_id__in=busy.keys(),
+        start_time__lt=window_end,
+    ).values_list( 'room_id', 'start_time', 'end_time' ):
+        busy[ room_pk ].append( ( closed_start, closed_end or window_end ) )
+    busy = { room_pk: merge_intervals( sorted( intervals ) ) for room_pk, intervals in busy.items() }
+
+    next_available = []
+    if 'available' == room.status:
+        next_available = free_windows(
+            busy[ room.pk ], calendar.open_windows( library, horizon_start, horizon_end ), duration, limit )
+
+    alternatives = []
+    for candidate in candidates:
+        if is_free( busy[ candidate.pk ], start, end ):
+            alternatives.append( ( candidate, _distance( room, candidate ) ) )
+
+    # same floor first, then nearest on the map, rooms without coordinates last
+    alternatives.sort( key=lambda pair: (
+        abs( pair[ 0 ].floor.number - room.floor.number ),
+        pair[ 1 ] is None,
+        pair[ 1 ] or 0,
+        pair[ 0 ].room_id,
+    ) )
+
+    return {
+        'room': room.room_id,
+        'start_time': start,
+        'end_time': end,
+        'is_free': 'available' == room.status and is_free( busy[ room.pk ], start, end ),
+        'next_available': [
+            { 'start_time': window_start, 'end_time': window_end }
+            for window_start, window_end in next_available
+        ],
+        'alternatives': [
+            {
+                'room_id': candidate.room_id,
+                'floor_number': candidate.floor.number,
+                'capacity': candidate.capacity,
+                'has_whiteboard': candidate.has_whiteboard,
+                'has_monitor': candidate.has_monitor,
+                'has_window': candidate.has_window,
+                'distance': None if distance is None else round( distance, 2 ),
+            }
+            for candidate, distance in alternatives[ :limit ]
+        ],
+    }
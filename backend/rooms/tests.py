@@ -1,3 +1,1432 @@
-from django.test import TestCase
+import asyncio
+import base64
+import importlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time as clock
+from datetime import datetime, time, timedelta
+from time import sleep
+from unittest import mock
+from zoneinfo import ZoneInfo
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.db.migrations.loader import MigrationLoader
+from django.http import StreamingHttpResponse
+from django.test import AsyncClient, TransactionTestCase, override_settings
+from django.urls import ResolverMatch
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import async_db, batch, calendar, outbox, profiling, room_status, search, spatial, suggestions, throttling, versions
+from .booking import ReservationConflict, save_reservation
+from .models import (
+    Library, Floor, Room, Reservation, IdempotencyKey, BookingQuota, WeeklySchedule, ScheduleOverride, OpenInterval,
+    OutboxEvent, RoomUsage, RoomClosure, WaitlistEntry,
+)
+from .serializers import ReservationSerializer
+
+
+def make_room(room_id='STR101', capacity=4):
+    library, _ = Library.objects.get_or_create(
+        name='Strozier', defaults={'location': 'Main campus', 'opening_time': time(0, 0), 'closing_time': time(23, 59)}
+    )
+    floor, _ = Floor.objects.get_or_create(library=library, number=1)
+    return Room.objects.create(room_id=room_id, floor=floor, capacity=capacity)
+
+
+def future_slot(days=1, hour=10, hours=1):
+    start = (timezone.now() + timedelta(days=days)).replace(hour=hour, minute=0, second=0, microsecond=0)
+    return start, start + timedelta(hours=hours)
+
+
+def run_concurrently(target, args_list):
+    """ Start one thread per args tuple behind a barrier, returns the exceptions they raised. """
+    barrier = threading.Barrier(len(args_list))
+    errors = []
+
+    def run(*args):
+        try:
+            barrier.wait()
+            target(*args)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=args) for args in args_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+class BulkImportExportTests(TransactionTestCase):
+    """ Exports load back unchanged, re-imports skip what is there, upcoming reservations are checked like clean(). """
+
+    def setUp(self):
+        self.room = make_room()
+        make_room('STR102', capacity=8)
+        self.user = User.objects.create_user('student', password='not-a-real-password')
+        self.staff = APIClient()
+        self.staff.force_authenticate(User.objects.create_user('librarian', password='not-a-real-password', is_staff=True))
+        self.start, self.end = future_slot()
+
+    def export(self, kind, file_format='jsonl'):
+        response = self.staff.get(f'/rooms/bulk/{kind}/export/', {'file_format': file_format})
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def load(self, kind, content, name=None):
+        upload = SimpleUploadedFile(name or f'{kind}.jsonl', content.encode())
+        return self.staff.post(f'/rooms/bulk/{kind}/import/', {'file': upload}, format='multipart').json()
+
+    def reservation_line(self, start, end, room_id='STR101', **fields):
+        return json.dumps(dict({
+            'username': 'student', 'room_id': room_id, 'start_time': start.isoformat(), 'end_time': end.isoformat(),
+            'status': 'confirmed', 'num_attendees': 1,
+        }, **fields)) + '\n'
+
+    def test_round_trip(self):
+        Reservation.objects.create(room=self.room, user=self.user, start_time=self.start, end_time=self.end,
+                                   status='confirmed', purpose='Study group', num_attendees=2)
+        kinds = ['libraries', 'floors', 'rooms', 'reservations']
+        exports = {kind: self.export(kind, 'csv' if 'rooms' == kind else 'jsonl') for kind in kinds}
+        Library.objects.all().delete()
+
+        for kind in kinds:
+            name = f'{kind}.csv' if 'rooms' == kind else f'{kind}.json'
+            result = self.load(kind, exports[kind], name)
+            self.assertEqual((result['error_count'], result['skipped']), (0, 0), result)
+        self.assertEqual({kind: self.export(kind, 'csv' if 'rooms' == kind else 'jsonl') for kind in kinds}, exports)
+
+        # a second load of the same reservations skips them
+        result = self.load('reservations', exports['reservations'])
+        self.assertEqual((result['created'], result['skipped']), (0, 1))
+
+    def test_conflicts_with_overlapping_existing_rows(self):
+        day = self.start.replace(hour=0)
+        # rows already in the table overlap each other, nothing checks old data
+        for start_hour, end_hour in ((9, 17), (10, 11)):
+            Reservation.objects.create(room=self.room, user=self.user, status='confirmed',
+                                       start_time=day + timedelta(hours=start_hour), end_time=day + timedelta(hours=end_hour))
+        result = self.load('reservations', ''.join([
+            self.reservation_line(day + timedelta(hours=12), day + timedelta(hours=13)),
+            self.reservation_line(day + timedelta(hours=17), day + timedelta(hours=18)),
+            self.reservation_line(day + timedelta(hours=17, minutes=30), day + timedelta(hours=19)),
+            self.reservation_line(day + timedelta(hours=12), day + timedelta(hours=13), room_id='STR102'),
+        ]))
+        self.assertEqual(result['created'], 2, result)
+        self.assertEqual([error['line'] for error in result['errors']], [1, 3])
+
+    def test_upcoming_reservations_respect_closures_and_hours(self):
+        room_status.transition(self.room, 'maintenance', self.start, self.end)
+        past_start, past_end = future_slot(days=-3)
+        result = self.load('reservations', ''.join([
+            self.reservation_line(self.start, self.end),
+            # the library closes at 23:59
+            self.reservation_line(self.start.replace(hour=23), self.start.replace(hour=23) + timedelta(hours=2),
+                                  room_id='STR102'),
+            self.reservation_line(self.start, self.end, room_id='STR102', status='cancelled'),
+            # history loads as it was
+            self.reservation_line(past_start, past_end, status='completed'),
+        ]))
+        self.assertEqual(result['created'], 2)
+        self.assertEqual([error['line'] for error in result['errors']], [1, 2])
+
+
+@override_settings(WAITLIST_MATCH_ASYNC=False, THROTTLE_BUCKETS={})
+class BookingSuggestionTests(TransactionTestCase):
+    """ Overlapping bookings are refused with the room's next free windows and the nearest free rooms. """
+
+    def setUp(self):
+        self.room = make_room()
+        self.user = User.objects.create_user('student', password='not-a-real-password')
+        self.start, self.end = future_slot()
+
+    def save(self, room, start, end, instance=None):
+        serializer = ReservationSerializer(instance, data={
+            'room': room.pk, 'start_time': start.isoformat(), 'end_time': end.isoformat(), 'status': 'confirmed',
+        })
+        serializer.is_valid(raise_exception=True)
+        return save_reservation(serializer, **({} if instance else {'user': self.user}))
+
+    def test_save_reservation_refuses_overlaps(self):
+        reservation = self.save(self.room, self.start, self.end)
+        with self.assertRaises(ReservationConflict) as raised:
+            self.save(self.room, self.start + timedelta(minutes=30), self.end + timedelta(minutes=30))
+        self.assertEqual((raised.exception.room, raised.exception.start_time), (self.room, self.start + timedelta(minutes=30)))
+        # back to back is fine, and moving a reservation does not conflict with itself
+        self.save(self.room, self.end, self.end + timedelta(hours=1))
+        self.save(self.room, self.start - timedelta(minutes=30), self.end - timedelta(minutes=30), instance=reservation)
+        self.assertEqual(Reservation.objects.filter(status='confirmed').count(), 2)
+
+    def test_conflict_suggests_free_windows_and_rooms(self):
+        floor = self.room.floor
+        Room.objects.filter(pk=self.room.pk).update(position_x=0, position_y=0)
+        Room.objects.create(room_id='STR102', floor=floor, capacity=4, position_x=10, position_y=0)
+        Room.objects.create(room_id='STR103', floor=floor, capacity=4, position_x=3, position_y=0)
+        # too small, and taken
+        Room.objects.create(room_id='STR104', floor=floor, capacity=2, position_x=1, position_y=0)
+        taken = Room.objects.create(room_id='STR105', floor=floor, capacity=6, position_x=2, position_y=0)
+        self.save(taken, self.start, self.end)
+        self.save(self.room, self.start, self.end)
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post('/rooms/reservations/', {
+            'room': self.room.pk, 'start_time': self.start.isoformat(), 'end_time': self.end.isoformat(),
+        }, format='json')
+        self.assertEqual(response.status_code, 409)
+        suggested = response.json()['suggestions']
+        self.assertFalse(suggested['is_free'])
+        self.assertEqual([room['room_id'] for room in suggested['alternatives']], ['STR103', 'STR102'])
+        self.assertEqual(suggested['alternatives'][0]['distance'], 3.0)
+        windows = [(window['start_time'], window['end_time']) for window in suggested['next_available']]
+        self.assertEqual(len(windows), 5)
+        self.assertNotIn((self.start.isoformat().replace('+00:00', 'Z'), self.end.isoformat().replace('+00:00', 'Z')), windows)
+
+    def test_candidate_cap_keeps_the_nearest_rooms(self):
+        library = self.room.floor.library
+        for number in (1, 2, 3):
+            floor, _ = Floor.objects.get_or_create(library=library, number=number)
+            # room ids sort the far floors first
+            Room.objects.create(room_id=f'A{4 - number}00', floor=floor, capacity=4)
+        with mock.patch.object(suggestions, 'MAX_CANDIDATE_ROOMS', 2):
+            suggested = suggestions.suggest(self.room, self.start, self.end, scope='library')
+        self.assertEqual([(room['room_id'], room['floor_number']) for room in suggested['alternatives']],
+                         [('A300', 1), ('A200', 2)])
+
+    def test_free_windows_skip_bookings(self):
+        hour = timedelta(hours=1)
+        day = self.start.replace(hour=0)
+        busy = [(day + 2 * hour, day + 3 * hour), (day + 4 * hour, day + 6 * hour)]
+        windows = suggestions.free_windows(busy, [(day, day + 8 * hour)], 2 * hour, 10)
+        self.assertEqual(windows, [(day, day + 2 * hour), (day + 6 * hour, day + 8 * hour)])
+
+    def test_free_windows_respect_a_closure_spanning_open_windows(self):
+        hour = timedelta(hours=1)
+        day = self.start.replace(hour=0)
+        next_day = day + 24 * hour
+        open_windows = [(day + 8 * hour, day + 20 * hour), (next_day + 8 * hour, next_day + 20 * hour)]
+        # closed from 11:00 until 10:00 the next day
+        busy = [(day + 11 * hour, next_day + 10 * hour)]
+        windows = suggestions.free_windows(busy, open_windows, hour, 5)
+        self.assertEqual(windows, [
+            (day + 8 * hour, day + 9 * hour), (day + 9 * hour, day + 10 * hour), (day + 10 * hour, day + 11 * hour),
+            (next_day + 10 * hour, next_day + 11 * hour), (next_day + 11 * hour, next_day + 12 * hour),
+        ])
+
+
+@override_settings(WAITLIST_MATCH_ASYNC=False)
+class WaitlistTests(TransactionTestCase):
+    """ A freed slot is held for the longest waiting user, who accepts it or loses it to the next. """
+
+    def setUp(self):
+        self.room = make_room()
+        self.start, self.end = future_slot()
+        self.owner = self.api_client('owner')
+        response = self.owner.post('/rooms/reservations/', {
+            'room': self.room.pk, 'start_time': self.start.isoformat(), 'end_time': self.end.isoformat(),
+        }, format='json')
+        self.reservation_id = response.json()['reservation_id']
+        self.first, self.first_entry = self.join('first')
+        self.second, self.second_entry = self.join('second')
+
+    def api_client(self, username):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username, password='not-a-real-password'))
+        return client
+
+    def join(self, username):
+        client = self.api_client(username)
+        response = client.post('/rooms/waitlist/', {
+            'room_id': 'STR101', 'start_time': self.start.isoformat(), 'end_time': self.end.isoformat(),
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return client, WaitlistEntry.objects.get(pk=response.json()['id'])
+
+    def cancel(self):
+        self.owner.post(f'/rooms/reservations/{self.reservation_id}/cancel/')
+
+    def test_cancellation_offers_a_hold_to_accept(self):
+        self.cancel()
+        self.first_entry.refresh_from_db()
+        self.assertEqual(self.first_entry.status, 'offered')
+        self.assertEqual(self.first_entry.hold.status, 'pending')
+        # the second entry's window is no longer free
+        self.second_entry.refresh_from_db()
+        self.assertEqual(self.second_entry.status, 'waiting')
+
+        self.assertEqual(self.second.post(f'/rooms/waitlist/{self.second_entry.pk}/accept/').status_code, 409)
+        response = self.first.post(f'/rooms/waitlist/{self.first_entry.pk}/accept/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'fulfilled')
+        self.first_entry.hold.refresh_from_db()
+        self.assertEqual(self.first_entry.hold.status, 'confirmed')
+        self.assertEqual(self.first.post(f'/rooms/waitlist/{self.first_entry.pk}/accept/').status_code, 409)
+
+    def test_withdrawing_passes_the_hold_on(self):
+        self.cancel()
+        self.first_entry.refresh_from_db()
+        self.assertEqual(self.first.delete(f'/rooms/waitlist/{self.first_entry.pk}/').status_code, 204)
+        self.first_entry.refresh_from_db()
+        self.first_entry.hold.refresh_from_db()
+        self.assertEqual((self.first_entry.status, self.first_entry.hold.status), ('cancelled', 'cancelled'))
+        self.second_entry.refresh_from_db()
+        self.assertEqual(self.second_entry.status, 'offered')
+
+    def test_process_waitlist_expires_holds_and_stale_entries(self):
+        self.cancel()
+        WaitlistEntry.objects.filter(pk=self.first_entry.pk).update(hold_expires_at=timezone.now() - timedelta(minutes=1))
+        past_start, past_end = future_slot(days=-1)
+        stale = WaitlistEntry.objects.create(user=self.first_entry.user, room=self.room,
+                                             start_time=past_start, end_time=past_end)
+
+        call_command('process_waitlist', stdout=mock.Mock())
+        self.first_entry.refresh_from_db()
+        self.assertEqual((self.first_entry.status, self.first_entry.hold.status), ('expired', 'cancelled'))
+        self.second_entry.refresh_from_db()
+        self.assertEqual(self.second_entry.status, 'offered')
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, 'expired')
+        self.assertEqual(self.first.post(f'/rooms/waitlist/{self.first_entry.pk}/accept/').status_code, 409)
+
+    def test_expired_holds_are_not_reported_as_cancellations(self):
+        User.objects.update(email='patron@example.edu')
+        self.cancel()
+        WaitlistEntry.objects.filter(pk=self.first_entry.pk).update(hold_expires_at=timezone.now() - timedelta(minutes=1))
+        call_command('process_waitlist', stdout=mock.Mock())
+        outbox.drain()
+
+        # the owner's cancellation only, the expired hold was never the first user's booking
+        subjects = [message.subject for message in mail.outbox]
+        self.assertEqual(subjects.count('Reservation cancelled'), 1)
+        self.assertEqual(subjects.count('A room you were waiting for is free'), 2)
+        usage = RoomUsage.objects.get(room=self.room)
+        # the second user's hold still occupies the slot, it is counted as a booking once accepted
+        self.assertEqual((usage.bookings, usage.cancellations, usage.booked_minutes), (1, 1, 60))
+        self.assertEqual(self.second.post(f'/rooms/waitlist/{self.second_entry.pk}/accept/').status_code, 200)
+        outbox.drain()
+        usage.refresh_from_db()
+        self.assertEqual((usage.bookings, usage.cancellations, usage.booked_minutes), (2, 1, 60))
+
+    @override_settings(WAITLIST_MATCH_ASYNC=True)
+    def test_freed_slots_are_matched_from_the_outbox(self):
+        self.cancel()
+        # recorded with the cancellation, nothing is lost if the process stops before matching
+        self.assertTrue(OutboxEvent.objects.filter(topic='waitlist.match', status='pending').exists())
+        self.first_entry.refresh_from_db()
+        self.assertEqual(self.first_entry.status, 'waiting')
+
+        outbox.drain()
+        self.first_entry.refresh_from_db()
+        self.assertEqual(self.first_entry.status, 'offered')
+
+
+@override_settings(WAITLIST_MATCH_ASYNC=False)
+class IdempotencyKeyTests(TransactionTestCase):
+    """ Retries of reservation writes carrying the same Idempotency-Key run once. """
+
+    def setUp(self):
+        self.user = User.objects.create_user('student', password='not-a-real-password')
+        self.room = make_room()
+        start, end = future_slot()
+        self.payload = {'room': self.room.pk, 'start_time': start.isoformat(), 'end_time': end.isoformat()}
+
+    def api_client(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        return client
+
+    def test_concurrent_retries_execute_once(self):
+        workers = 16
+        barrier = threading.Barrier(workers)
+        responses, errors = [], []
+
+        def hammer():
+            client = self.api_client()
+            try:
+                barrier.wait()
+                response = client.post('/rooms/reservations/', self.payload, format='json',
+                                       HTTP_IDEMPOTENCY_KEY='flaky-wifi-retry')
+                responses.append((response.status_code, response.json()))
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=hammer) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(responses), workers)
+        self.assertEqual({code for code, _ in responses}, {201})
+        self.assertEqual(len({body['reservation_id'] for _, body in responses}), 1)
+        self.assertEqual(Reservation.objects.count(), 1)
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+    def test_retry_replays_stored_response(self):
+        client = self.api_client()
+        first = client.post('/rooms/reservations/', self.payload, format='json', HTTP_IDEMPOTENCY_KEY='k1')
+        second = client.post('/rooms/reservations/', self.payload, format='json', HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(first.json(), second.json())
+
+        reservation_id = first.json()['reservation_id']
+        for _ in range(2):
+            cancelled = client.post(f'/rooms/reservations/{reservation_id}/cancel/', HTTP_IDEMPOTENCY_KEY='k2')
+            self.assertEqual(cancelled.status_code, 200)
+            self.assertEqual(cancelled.json()['status'], 'cancelled')
+
+    def test_key_reused_for_different_request_is_rejected(self):
+        client = self.api_client()
+        client.post('/rooms/reservations/', self.payload, format='json', HTTP_IDEMPOTENCY_KEY='k1')
+        other = dict(self.payload, notes='different body')
+        response = client.post('/rooms/reservations/', other, format='json', HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEqual(response.status_code, 422)
+
+    def test_without_key_second_booking_conflicts(self):
+        client = self.api_client()
+        self.assertEqual(client.post('/rooms/reservations/', self.payload, format='json').status_code, 201)
+        response = client.post('/rooms/reservations/', self.payload, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('suggestions', response.json())
+        self.assertEqual(Reservation.objects.count(), 1)
+
+
+@override_settings(THROTTLE_BUCKETS={})
+class FloorMapTests(TransactionTestCase):
+    """ Floors compile to an SVG, an availability bitmap and an R-tree, recompiled only when the layout changes. """
+
+    def setUp(self):
+        self.floor = make_room('STR100').floor
+        # a row of 4 x 3 rooms, one metre apart
+        self.rooms = [
+            Room.objects.create(room_id=f'STR1{index:02}', floor=self.floor, capacity=4,
+                                position_x=index * 5.0, position_y=0.0, width=4.0, height=3.0)
+            for index in range(1, 5)
+        ]
+        self.start, self.end = future_slot()
+
+    def floor_map(self, **headers):
+        return APIClient().get(f'/rooms/floors/{self.floor.pk}/map/', **headers)
+
+    def test_rtree_matches_a_linear_scan(self):
+        boxes = [((x, y, x + 1.5, y + 0.5), (x, y)) for x in range(0, 40, 2) for y in range(0, 30, 3)]
+        index = spatial.RTree(boxes, capacity=4)
+        self.assertEqual(len(index), len(boxes))
+        for x, y, radius in ((3.2, 3.1, 0), (10.0, 9.0, 2.5), (100.0, 100.0, 5), (0.0, 0.0, 40)):
+            distances = sorted((spatial._distance_to_box(x, y, box), value) for box, value in boxes)
+            found = index.within(x, y, radius)
+            # nearest first, ties in any order
+            self.assertEqual(sorted(found), [pair for pair in distances if pair[0] <= radius])
+            self.assertEqual([distance for distance, _ in found], sorted(distance for distance, _ in found))
+            inside = [value for box, value in boxes if box[0] <= x <= box[2] and box[1] <= y <= box[3]]
+            self.assertEqual(sorted(index.at_point(x, y)), inside)
+        self.assertEqual(spatial.RTree([]).at_point(0, 0), [])
+
+    def test_svg_revalidates_with_etag(self):
+        response = self.floor_map()
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        svg = response.content.decode()
+        self.assertEqual(svg.count('class="room"'), 4)
+        self.assertIn('id="room-STR103" class="room" data-index="2" x="15" y="0" width="4" height="3"', svg)
+        self.assertEqual(self.floor_map(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        # status and capacity are not drawn, the map stays valid
+        room = Room.objects.get(room_id='STR101')
+        room.status, room.capacity = 'maintenance', 8
+        room.save()
+        self.assertEqual(self.floor_map(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        room.position_x = 30.0
+        room.save()
+        moved = self.floor_map(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(moved.status_code, 200)
+        self.assertNotEqual(moved['ETag'], response['ETag'])
+        self.assertIn('id="room-STR101" class="room" data-index="0" x="30"', moved.content.decode())
+
+    def test_floor_map_numbers_are_validated(self):
+        for floor_map in ({'width': '20'}, {'height': -1}, {'outline': [[0, 0], ['1', 2]]}, {'outline': 'square'}, [1]):
+            with self.assertRaises(ValidationError):
+                Floor(library=self.floor.library, number='9', floor_map=floor_map).clean()
+        Floor(library=self.floor.library, number='9', floor_map={'width': 40, 'outline': [[0, 0], [40, 0], [40, 30]]}).clean()
+
+        # maps stored before the check render with the computed size and outline
+        Floor.objects.filter(pk=self.floor.pk).update(floor_map={'width': '20', 'outline': [['a', 0]]})
+        response = self.floor_map()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('polygon', response.content.decode())
+
+    def test_availability_bitmap_and_hit_test(self):
+        Reservation.objects.create(room=self.rooms[1], user=User.objects.create_user('student'),
+                                   start_time=self.start, end_time=self.end, status='confirmed')
+        response = APIClient().get(f'/rooms/floors/{self.floor.pk}/availability/', {
+            'start': self.start.isoformat(), 'end': self.end.isoformat(),
+        }).json()
+        # STR102 is booked, the others are free
+        self.assertEqual(response['room_count'], 4)
+        self.assertEqual(base64.b64decode(response['bitmap']), bytes([0b10110000]))
+
+        def bitmap():
+            return base64.b64decode(APIClient().get(f'/rooms/floors/{self.floor.pk}/availability/', {
+                'start': self.start.isoformat(), 'end': self.end.isoformat(),
+            }).json()['bitmap'])
+
+        # a closure scheduled to start during the window, the room is still available now
+        room_status.transition(self.rooms[2], 'maintenance', start_time=self.start + timedelta(minutes=30))
+        self.assertEqual(Room.objects.get(pk=self.rooms[2].pk).status, 'available')
+        self.assertEqual(bitmap(), bytes([0b10010000]))
+        # nothing is bookable while the library is closed
+        library = self.floor.library
+        ScheduleOverride.objects.create(library=library, date=calendar.local_date(library, self.start), is_closed=True)
+        self.assertEqual(bitmap(), bytes([0]))
+
+        hit = APIClient().get(f'/rooms/floors/{self.floor.pk}/hit/', {'x': 11, 'y': 1}).json()
+        self.assertEqual(hit['rooms'], [{'room_id': 'STR102', 'distance': 0}])
+        near = APIClient().get(f'/rooms/floors/{self.floor.pk}/hit/', {'x': 14.2, 'y': 1, 'radius': 1}).json()
+        self.assertEqual([room['room_id'] for room in near['rooms']], ['STR102', 'STR103'])
+
+
+@override_settings(WAITLIST_MATCH_ASYNC=False)
+class BookingQuotaTests(TransactionTestCase):
+    """ Quotas hold when one user books several rooms at the same moment. """
+
+    def setUp(self):
+        self.user = User.objects.create_user('student', password='not-a-real-password')
+        self.rooms = [make_room(f'STR10{number}') for number in range(6)]
+
+    def book(self, room, start, end):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        return client.post('/rooms/reservations/', {
+            'room': room.pk, 'start_time': start.isoformat(), 'end_time': end.isoformat()
+        }, format='json')
+
+    def test_concurrent_bookings_respect_active_limit(self):
+        BookingQuota.objects.create(user=self.user, max_active_reservations=2)
+        start, end = future_slot()
+        codes = []
+        errors = run_concurrently(lambda room: codes.append(self.book(room, start, end).status_code),
+                                  [(room,) for room in self.rooms])
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(codes), [201, 201, 403, 403, 403, 403])
+        self.assertEqual(Reservation.objects.filter(user=self.user).count(), 2)
+
+    def test_daily_and_weekly_hours(self):
+        BookingQuota.objects.create(max_hours_per_day=3, max_hours_per_week=4)
+        monday, _ = future_slot(days=7 - timezone.now().weekday(), hour=9)
+        hours = timedelta(hours=1)
+
+        self.assertEqual(self.book(self.rooms[0], monday, monday + 2 * hours).status_code, 201)
+        response = self.book(self.rooms[1], monday + 3 * hours, monday + 5 * hours)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()['limit'], 'max_hours_per_day')
+
+        tuesday = monday + timedelta(days=1)
+        self.assertEqual(self.book(self.rooms[1], tuesday, tuesday + 2 * hours).status_code, 201)
+        wednesday = monday + timedelta(days=2)
+        response = self.book(self.rooms[2], wednesday, wednesday + hours)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()['limit'], 'max_hours_per_week')
+
+    def test_days_are_the_librarys(self):
+        library = self.rooms[0].floor.library
+        library.time_zone = 'America/New_York'
+        library.save()
+        zone = ZoneInfo('America/New_York')
+        day = timezone.localtime(timezone.now(), zone).date() + timedelta(days=7)
+        BookingQuota.objects.create(max_hours_per_day=2)
+
+        self.assertEqual(self.book(self.rooms[0], datetime.combine(day, time(10), tzinfo=zone),
+                                   datetime.combine(day, time(11), tzinfo=zone)).status_code, 201)
+        # 21:00 - 23:00 in New York is the next day in UTC, but the same day at the library
+        response = self.book(self.rooms[1], datetime.combine(day, time(21), tzinfo=zone),
+                             datetime.combine(day, time(23), tzinfo=zone))
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()['limit'], 'max_hours_per_day')
+        self.assertEqual(self.book(self.rooms[1], datetime.combine(day, time(22), tzinfo=zone),
+                                   datetime.combine(day, time(23), tzinfo=zone)).status_code, 201)
+
+
+class AsyncReadPathTests(TransactionTestCase):
+    """ The async catalog and availability views return what the DRF views do. """
+
+    def setUp(self):
+        user = User.objects.create_user('student', password='not-a-real-password')
+        self.rooms = [make_room(f'STR1{number:02}', capacity=number) for number in range(12)]
+        self.start, self.end = future_slot()
+        Reservation.objects.create(room=self.rooms[0], user=user, start_time=self.start, end_time=self.end,
+                                   status='confirmed', purpose='Study group', num_attendees=3)
+        # as the nightly materialize_calendar run would, the async views only read the calendar
+        calendar.materialize(self.rooms[0].floor.library)
+
+    def fetch_async(self, paths):
+        async def fetch():
+            client = AsyncClient()
+            try:
+                return [await client.get(path) for path in paths]
+            finally:
+                await async_db.close_pool()
+        return asyncio.run(fetch())
+
+    def test_responses_match_sync_views(self):
+        date = timezone.localtime(self.start).date().isoformat()
+        paths = [
+            '/rooms/libraries/',
+            '/rooms/floors/',
+            '/rooms/rooms/?page=2',
+            f'/rooms/rooms/STR100/availability/?date={date}',
+            '/rooms/rooms/MISSING/availability/',
+        ]
+        async_responses = self.fetch_async([path.replace('/rooms/', '/rooms/async/', 1) for path in paths])
+        for path, async_response in zip(paths, async_responses):
+            response = APIClient().get(path)
+            self.assertEqual(async_response.status_code, response.status_code, path)
+            expected = response.json()
+            if expected.get('previous'):
+                expected['previous'] = expected['previous'].replace('/rooms/', '/rooms/async/', 1)
+            self.assertEqual(async_response.json(), expected, path)
+
+    def test_search_filters(self):
+        response = self.fetch_async(['/rooms/async/rooms/?min_capacity=10&has_window=false'])[0]
+        self.assertEqual(response.json()['count'], 2)
+        self.assertEqual([room['room_id'] for room in response.json()['results']], ['STR110', 'STR111'])
+
+    def test_wsgi_requests_do_not_open_pools(self):
+        # behind WSGI each request gets an event loop of its own, a pool opened on it would leak
+        response = APIClient().get('/rooms/async/rooms/?min_capacity=10')
+        self.assertEqual(response.json()['count'], 2)
+        self.assertEqual(async_db._pools, {})
+
+
+@override_settings(WAITLIST_MATCH_ASYNC=False)
+class LibraryCalendarTests(TransactionTestCase):
+    """ Bookings are checked against the library's own hours, in its own time zone. """
+
+    def setUp(self):
+        self.user = User.objects.create_user('student', password='not-a-real-password')
+        self.room = make_room()
+        self.library = self.room.floor.library
+        self.library.time_zone = 'America/New_York'
+        self.library.save()
+        self.zone = ZoneInfo('America/New_York')
+        for weekday in range(7):
+            WeeklySchedule.objects.create(library=self.library, weekday=weekday, opens_at=time(8), closes_at=time(22))
+        self.day = timezone.localtime(timezone.now(), self.zone).date() + timedelta(days=7)
+
+    def at(self, day, hour):
+        return datetime.combine(day, time(hour), tzinfo=self.zone)
+
+    def book(self, start, end):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        return client.post('/rooms/reservations/', {
+            'room': self.room.pk, 'start_time': start.isoformat(), 'end_time': end.isoformat()
+        }, format='json')
+
+    def test_hours_are_local(self):
+        # 21:00 - 22:00 in New York is after 22:00 UTC
+        self.assertEqual(self.book(self.at(self.day, 21), self.at(self.day, 22)).status_code, 201)
+        response = self.book(self.at(self.day, 7), self.at(self.day, 9))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['open_hours'][0]['start_time'],
+                         self.at(self.day, 8).astimezone(ZoneInfo('UTC')).isoformat().replace('+00:00', 'Z'))
+
+    def test_overrides(self):
+        exam_day, holiday = self.day + timedelta(days=1), self.day + timedelta(days=3)
+        for day in (exam_day, exam_day + timedelta(days=1)):
+            ScheduleOverride.objects.create(library=self.library, date=day, opens_at=time(0), closes_at=time(0))
+        ScheduleOverride.objects.create(library=self.library, date=holiday, is_closed=True, note='Holiday')
+        # as the admin does after saving the schedules
+        calendar.materialize(self.library)
+
+        # the two 24 hour days are one open interval, so a booking can run past midnight
+        self.assertEqual(self.book(self.at(exam_day, 23), self.at(exam_day + timedelta(days=1), 1)).status_code, 201)
+        self.assertEqual(self.book(self.at(holiday, 10), self.at(holiday, 11)).status_code, 400)
+        self.assertEqual(OpenInterval.objects.filter(
+            library=self.library, start_time__lte=self.at(exam_day, 0), end_time__gte=self.at(exam_day + timedelta(days=2), 0)
+        ).count(), 1)
+
+    def test_rebuild_keeps_intervals_disjoint(self):
+        calendar.materialize(self.library)
+        WeeklySchedule.objects.filter(library=self.library).update(opens_at=time(10), closes_at=time(2))
+        calendar.materialize(self.library)
+        intervals = list(OpenInterval.objects.filter(library=self.library).values_list('start_time', 'end_time'))
+        for (_, end), (next_start, _) in zip(intervals, intervals[1:]):
+            self.assertLess(end, next_start)
+        self.assertEqual(self.book(self.at(self.day, 23), self.at(self.day + timedelta(days=1), 1)).status_code, 201)
+
+    def test_reads_and_bookings_do_not_write_the_calendar(self):
+        self.assertEqual(self.book(self.at(self.day, 10), self.at(self.day, 11)).status_code, 201)
+        for path in ('/rooms/rooms/STR101/availability/', '/rooms/async/rooms/STR101/availability/'):
+            response = APIClient().get(path, {'date': self.day.isoformat()})
+            self.assertEqual(response.json()['open_hours'], [{
+                'start_time': self.at(self.day, 8).astimezone(ZoneInfo('UTC')).isoformat().replace('+00:00', 'Z'),
+                'end_time': self.at(self.day, 22).astimezone(ZoneInfo('UTC')).isoformat().replace('+00:00', 'Z'),
+            }])
+        self.library.refresh_from_db()
+        self.assertIsNone(self.library.calendar_until)
+        self.assertFalse(OpenInterval.objects.exists())
+
+    def test_beyond_the_horizon_the_schedules_apply(self):
+        WeeklySchedule.objects.filter(library=self.library).update(opens_at=time(10), closes_at=time(2))
+        # the materialized calendar ends at local midnight of self.day
+        calendar.materialize(self.library, weeks=1)
+        before = self.day - timedelta(days=1)
+        # an overnight period runs on across the end of the materialized calendar
+        self.assertEqual(self.book(self.at(before, 23), self.at(self.day, 1)).status_code, 201)
+
+        later = self.day + timedelta(weeks=12)
+        self.assertEqual(self.book(self.at(later, 11), self.at(later, 12)).status_code, 201)
+        self.assertEqual(self.book(self.at(later, 3), self.at(later, 4)).status_code, 400)
+        self.assertEqual(calendar.open_windows(self.library, self.at(later, 0), self.at(later, 12)),
+                         [(self.at(later, 0), self.at(later, 2)), (self.at(later, 10), self.at(later, 12))])
+        self.library.refresh_from_db()
+        self.assertEqual(self.library.calendar_until, self.at(self.day, 0))
+
+    @override_settings(BOOKING_HORIZON_WEEKS=8)
+    def test_booking_horizon_setting(self):
+        later = self.day + timedelta(weeks=8)
+        response = self.book(self.at(later, 10), self.at(later, 11))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('at most 8 weeks ahead', json.dumps(response.json()))
+        self.assertEqual(self.book(self.at(self.day, 10), self.at(self.day, 11)).status_code, 201)
+
+
+@override_settings(WAITLIST_MATCH_ASYNC=False, THROTTLE_BUCKETS={
+    'availability': {'ip': (1, 3)},
+    'booking': {'user': (0.1, 2)},
+})
+class AdmissionControlTests(TransactionTestCase):
+    """ Rate limits and the booking write limiter answer 429 with Retry-After. """
+
+    def setUp(self):
+        throttling.reset()
+        self.user = User.objects.create_user('student', password='not-a-real-password')
+        self.room = make_room()
+
+    def book(self, days):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        start, end = future_slot(days=days)
+        return client.post('/rooms/reservations/', {
+            'room': self.room.pk, 'start_time': start.isoformat(), 'end_time': end.isoformat()
+        }, format='json')
+
+    def test_token_buckets(self):
+        responses = [APIClient().get('/rooms/rooms/STR101/availability/') for _ in range(4)]
+        self.assertEqual([response.status_code for response in responses], [200, 200, 200, 429])
+        self.assertEqual(responses[-1]['Retry-After'], '1')
+
+        # reads of your own reservations do not use up booking tokens
+        client = APIClient()
+        client.force_authenticate(self.user)
+        for _ in range(3):
+            self.assertEqual(client.get('/rooms/reservations/').status_code, 200)
+        self.assertEqual([self.book(days).status_code for days in (1, 2, 3)], [201, 201, 429])
+        self.assertEqual(throttling.metrics_snapshot()['rejected'], {'availability:ip': 1, 'booking:user': 1})
+
+    def test_forwarded_for_cannot_pick_the_ip_bucket(self):
+        def statuses(*forwarded_for):
+            return [APIClient().get('/rooms/rooms/STR101/availability/', HTTP_X_FORWARDED_FOR=address).status_code
+                    for address in forwarded_for]
+
+        self.assertEqual(statuses('10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4'), [200, 200, 200, 429])
+
+        # behind one proxy only the address it appended counts
+        throttling.reset()
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}):
+            self.assertEqual(statuses(*(f'10.0.0.{number}, 192.0.2.1' for number in range(4))), [200, 200, 200, 429])
+            self.assertEqual(statuses('10.0.0.1, 192.0.2.2'), [200])
+
+    @override_settings(THROTTLE_BUCKETS={'booking': {'user': (0.1, 1), 'endpoint': (0.1, 3)}})
+    def test_refused_requests_take_no_tokens(self):
+        self.assertEqual([self.book(days).status_code for days in (1, 2, 3, 4, 5)], [201, 429, 429, 429, 429])
+        # the endpoint bucket still holds the two tokens the refused requests did not take
+        self.user = User.objects.create_user('other', password='not-a-real-password')
+        self.assertEqual([self.book(days).status_code for days in (6, 7, 8)], [201, 429, 429])
+        self.assertEqual(throttling.metrics_snapshot()['rejected'], {'booking:user': 6})
+
+    @override_settings(THROTTLE_STORE='cache', CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'throttle_test_cache',
+    }})
+    def test_async_views_take_from_the_cache_off_the_event_loop(self):
+        call_command('createcachetable')
+
+        async def fetch():
+            client = AsyncClient()
+            try:
+                return [(await client.get('/rooms/async/rooms/STR101/availability/')).status_code for _ in range(4)]
+            finally:
+                await async_db.close_pool()
+                # the connection the cache store opened in its worker thread
+                await sync_to_async(lambda: connection.close())()
+
+        # the database cache refuses to run on the event loop
+        self.assertEqual(asyncio.run(fetch()), [200, 200, 200, 429])
+
+    @override_settings(BOOKING_MAX_CONCURRENT_WRITES=1, BOOKING_MAX_QUEUED=0)
+    def test_saturated_writes_are_shed(self):
+        with throttling.booking_limiter().slot():
+            response = self.book(1)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(self.book(1).status_code, 201)
+        # the slot held by the test counts as admitted too
+        self.assertEqual(throttling.metrics_snapshot()['writes'], {'shed': 1, 'admitted': 2})
+
+    @override_settings(BOOKING_MAX_CONCURRENT_WRITES=1, BOOKING_MAX_QUEUED=1, BOOKING_QUEUE_TIMEOUT=10)
+    def test_queued_write_runs_when_a_slot_frees(self):
+        limiter = throttling.booking_limiter()
+        codes = []
+        with limiter.slot():
+            thread = threading.Thread(target=lambda: codes.append(self.book(1).status_code))
+            thread.start()
+            while not limiter.waiting:
+                sleep(0.01)
+        thread.join()
+        self.assertEqual(codes, [201])
+        self.assertEqual(throttling.metrics_snapshot()['writes'], {'admitted': 1, 'queued': 1})
+        self.assertEqual(limiter.in_flight, 0)
+
+
+@override_settings(WAITLIST_MATCH_ASYNC=False, THROTTLE_BUCKETS={})
+class OutboxTests(TransactionTestCase):
+    """ Side effects are recorded with the booking and processed by outbox workers. """
+
+    def setUp(self):
+        self.user = User.objects.create_user('student', email='student@example.edu', password='not-a-real-password')
+        self.room = make_room()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def book(self, start, end):
+        return self.client.post('/rooms/reservations/', {
+            'room': self.room.pk, 'start_time': start.isoformat(), 'end_time': end.isoformat()
+        }, format='json')
+
+    def test_events_are_written_with_the_booking(self):
+        start, end = future_slot(hours=2)
+        reservation_id = self.book(start, end).json()['reservation_id']
+        self.assertEqual(self.book(start, end).status_code, 409)
+        self.assertEqual(sorted(OutboxEvent.objects.values_list('topic', flat=True)),
+                         ['reservation.created', 'reservation.reminder'])
+
+        # the reminder is scheduled for later, only the confirmation is due
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual([message.subject for message in mail.outbox], ['Your room reservation'])
+        usage = RoomUsage.objects.get(room=self.room)
+        self.assertEqual((usage.bookings, usage.cancellations, usage.booked_minutes), (1, 0, 120))
+
+        self.client.post(f'/rooms/reservations/{reservation_id}/cancel/')
+        OutboxEvent.objects.filter(topic='reservation.reminder').update(available_at=timezone.now())
+        self.assertEqual(outbox.drain(), 2)
+        # the reminder of the cancelled reservation is dropped
+        self.assertEqual([message.subject for message in mail.outbox], ['Your room reservation', 'Reservation cancelled'])
+        usage.refresh_from_db()
+        self.assertEqual((usage.bookings, usage.cancellations, usage.booked_minutes), (1, 1, 0))
+        self.assertEqual(outbox.stats()['due'], 0)
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2)
+    def test_failing_handler_backs_off_then_fails(self):
+        def flaky(payload):
+            RoomUsage.objects.create(room_id=payload['room'], date=timezone.now().date())
+            raise RuntimeError('smtp down')
+
+        with mock.patch.dict(outbox._handlers, {'test.flaky': [flaky]}):
+            event = outbox.emit('test.flaky', {'room': self.room.pk})
+            with self.assertLogs('rooms.outbox', 'WARNING'):
+                self.assertEqual(outbox.process_batch(), 1)
+            event.refresh_from_db()
+            self.assertEqual((event.status, event.attempts), ('pending', 1))
+            self.assertIn('smtp down', event.last_error)
+            self.assertGreater(event.available_at, timezone.now())
+            # not due again until the backoff has passed
+            self.assertEqual(outbox.process_batch(), 0)
+
+            OutboxEvent.objects.filter(pk=event.pk).update(available_at=timezone.now())
+            with self.assertLogs('rooms.outbox', 'ERROR'):
+                self.assertEqual(outbox.process_batch(), 1)
+            event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), ('failed', 2))
+        # the handler's writes were rolled back with each attempt
+        self.assertFalse(RoomUsage.objects.exists())
+
+    def test_handlers_run_after_the_claim_commits(self):
+        seen = []
+
+        def inspect(payload):
+            # another connection can lock the row, so the claim holds no lock while handlers run
+            def check():
+                with transaction.atomic():
+                    seen.append(OutboxEvent.objects.select_for_update(nowait=True).values_list('status', 'attempts').get())
+
+            self.assertEqual(run_concurrently(check, [()]), [])
+
+        with mock.patch.dict(outbox._handlers, {'test.inspect': [inspect]}):
+            outbox.emit('test.inspect', {})
+            self.assertEqual(outbox.process_batch(), 1)
+        self.assertEqual(seen, [('processing', 1)])
+        self.assertEqual(OutboxEvent.objects.get().status, 'done')
+
+    def test_an_event_whose_lease_ran_out_is_claimed_again(self):
+        def slow(payload):
+            RoomUsage.objects.create(room_id=payload['room'], date=timezone.now().date())
+            # the lease runs out while the handler is still running, another worker claims the event
+            def take_over():
+                OutboxEvent.objects.update(available_at=timezone.now())
+                self.assertEqual(len(outbox.claim()), 1)
+
+            self.assertEqual(run_concurrently(take_over, [()]), [])
+
+        with mock.patch.dict(outbox._handlers, {'test.slow': [slow]}):
+            event = outbox.emit('test.slow', {'room': self.room.pk})
+            with self.assertLogs('rooms.outbox', 'WARNING'):
+                self.assertEqual(outbox.process_batch(), 1)
+        event.refresh_from_db()
+        # left to the worker that claimed it last, the first run's writes are rolled back
+        self.assertEqual((event.status, event.attempts), ('processing', 2))
+        self.assertGreater(event.available_at, timezone.now())
+        self.assertFalse(RoomUsage.objects.exists())
+        self.assertEqual(outbox.stats()['processing'], 1)
+
+    def test_concurrent_workers_process_each_event_once(self):
+        seen = []
+        with mock.patch.dict(outbox._handlers, {'test.count': [lambda payload: seen.append(payload['n'])]}):
+            for number in range(200):
+                outbox.emit('test.count', {'n': number})
+            self.assertEqual(run_concurrently(outbox.drain, [(10,)] * 4), [])
+        self.assertEqual(sorted(seen), list(range(200)))
+        self.assertEqual(OutboxEvent.objects.filter(status='done').count(), 200)
+        self.assertEqual(outbox.stats()['processed_last_window'], 200)
+
+
+@override_settings(WAITLIST_MATCH_ASYNC=False, THROTTLE_BUCKETS={})
+class RoomStatusTests(TransactionTestCase):
+    """ Closing a room resolves the reservations it overlaps, even while bookings are racing it. """
+
+    def setUp(self):
+        self.user = User.objects.create_user('student', password='not-a-real-password')
+        self.staff = User.objects.create_user('librarian', password='not-a-real-password', is_staff=True)
+        self.room = make_room()
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def book(self, start, end, room=None):
+        return self.client_for(self.user).post('/rooms/reservations/', {
+            'room': (room or self.room).pk, 'start_time': start.isoformat(), 'end_time': end.isoformat()
+        }, format='json')
+
+    def change_status(self, room_id='STR101', **data):
+        return self.client_for(self.staff).post(f'/rooms/rooms/{room_id}/status/', data, format='json')
+
+    def test_rooms_added_out_of_service_are_not_bookable(self):
+        start, end = future_slot()
+        admin_client = self.client_for(self.staff)
+        admin_client.force_login(User.objects.create_superuser('admin', password='not-a-real-password'))
+        response = admin_client.post('/admin/rooms/room/add/', {
+            'room_id': 'STR102', 'floor': self.room.floor_id, 'capacity': 4, 'status': 'closed',
+        })
+        self.assertEqual(response.status_code, 302)
+
+        booked = self.book(start, end).json()['reservation_id']
+        lines = [json.dumps({'room_id': room_id, 'library': 'Strozier', 'floor': 1, 'capacity': 4, 'status': status})
+                 for room_id, status in (('STR101', 'closed'), ('STR103', 'maintenance'), ('STR104', 'available'))]
+        upload = SimpleUploadedFile('rooms.jsonl', '\n'.join(lines).encode())
+        result = self.client_for(self.staff).post('/rooms/bulk/rooms/import/', {'file': upload}, format='multipart').json()
+        self.assertEqual((result['created'], result['updated'], result['error_count']), (2, 1, 0), result)
+
+        codes = {room_id: self.book(start, end, Room.objects.get(room_id=room_id)).status_code
+                 for room_id in ('STR102', 'STR103', 'STR104')}
+        self.assertEqual(codes, {'STR102': 409, 'STR103': 409, 'STR104': 201})
+        self.assertEqual(set(RoomClosure.objects.filter(end_time__isnull=True).values_list('room__room_id', 'status')),
+                         {('STR101', 'closed'), ('STR102', 'closed'), ('STR103', 'maintenance')})
+        # an existing room closed by the import goes through a transition, its reservations are flagged
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.status, 'closed')
+        self.assertIsNotNone(Reservation.objects.get(pk=booked).closure)
+
+    def test_closures_change_only_through_transitions_in_the_admin(self):
+        start, end = future_slot()
+        booked = self.book(start, end).json()['reservation_id']
+        closure, _ = room_status.transition(self.room, 'maintenance', start_time=end, resolution='flag')
+        admin_client = APIClient()
+        admin_client.force_login(User.objects.create_superuser('admin', password='not-a-real-password'))
+
+        self.assertEqual(admin_client.get('/admin/rooms/roomclosure/add/').status_code, 403)
+        self.assertEqual(admin_client.post(f'/admin/rooms/roomclosure/{closure.pk}/delete/', {'post': 'yes'}).status_code, 403)
+        # widening the window would cover the reservation without flagging it, only the reason is taken
+        response = admin_client.post(f'/admin/rooms/roomclosure/{closure.pk}/change/', {
+            'start_time_0': start.date().isoformat(), 'start_time_1': '00:00:00', 'status': 'closed',
+            'reason': 'Leaking roof',
+        })
+        self.assertEqual(response.status_code, 302)
+        closure.refresh_from_db()
+        self.assertEqual((closure.start_time, closure.status, closure.reason), (end, 'maintenance', 'Leaking roof'))
+        self.assertIsNone(Reservation.objects.get(pk=booked).closure)
+
+    def test_closure_cancels_overlapping_and_blocks_new_bookings(self):
+        inside, inside_end = future_slot(hour=10)
+        after, after_end = future_slot(hour=15)
+        inside_id = self.book(inside, inside_end).json()['reservation_id']
+        after_id = self.book(after, after_end).json()['reservation_id']
+
+        response = self.change_status(status='maintenance', end_time=(inside_end + timedelta(hours=2)).isoformat(),
+                                      reason='Broken window')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.json()['status'], response.json()['reservations_affected']), ('maintenance', 1))
+        self.assertEqual(Reservation.objects.get(pk=inside_id).status, 'cancelled')
+        self.assertEqual(Reservation.objects.get(pk=after_id).status, 'pending')
+        cancelled = OutboxEvent.objects.get(topic='reservation.cancelled')
+        self.assertEqual((cancelled.payload['reservation_id'], cancelled.payload['reason']), (inside_id, 'Broken window'))
+
+        refused = self.book(inside, inside_end)
+        self.assertEqual(refused.status_code, 409)
+        self.assertEqual(refused.json()['room_status'], 'maintenance')
+        self.assertEqual(self.client_for(self.user).post('/rooms/rooms/STR101/status/', {'status': 'available'}).status_code, 403)
+
+        self.assertEqual(self.change_status(status='available').status_code, 200)
+        self.assertEqual(Room.objects.get(pk=self.room.pk).status, 'available')
+        self.assertEqual(self.book(inside, inside_end).status_code, 201)
+
+    def test_flagged_reservations_are_released_when_the_room_reopens(self):
+        start, end = future_slot(hour=10)
+        reservation_id = self.book(start, end).json()['reservation_id']
+        closes = start - timedelta(hours=1)
+        response = self.change_status(status='closed', start_time=closes.isoformat(), resolution='flag')
+        closure = RoomClosure.objects.get()
+        self.assertEqual(response.json()['closure']['flagged_reservations'], [reservation_id])
+        reservation = Reservation.objects.get(pk=reservation_id)
+        self.assertEqual((reservation.status, reservation.closure_id), ('pending', closure.pk))
+        # the window has not started yet
+        self.assertEqual(Room.objects.get(pk=self.room.pk).status, 'available')
+        self.assertEqual(room_status.sync_statuses(now=closes), 1)
+        self.assertEqual(Room.objects.get(pk=self.room.pk).status, 'closed')
+
+        self.change_status(status='available', start_time=start.isoformat())
+        self.assertIsNone(Reservation.objects.get(pk=reservation_id).closure_id)
+        closure.refresh_from_db()
+        self.assertEqual(closure.end_time, start)
+
+    def test_concurrent_bookings_never_survive_a_closure(self):
+        for round_number in range(5):
+            room = make_room(f'STR2{round_number:02d}')
+            slots = [future_slot(hour=hour) for hour in range(4, 20)]
+            window_start, window_end = slots[0][0], slots[-1][1]
+            codes = []
+
+            def act(slot):
+                if slot is None:
+                    # start the closure later each round so it lands before, among and after the bookings
+                    sleep(0.02 * round_number)
+                    room_status.transition(room, 'closed', start_time=window_start, end_time=window_end)
+                else:
+                    codes.append(self.book(*slot, room=room).status_code)
+
+            self.assertEqual(run_concurrently(act, [(slot,) for slot in slots] + [(None,)]), [])
+            self.assertEqual(set(codes) - {201, 409}, set())
+            # bookings that beat the closure were cancelled by it, the rest were refused
+            self.assertEqual(Reservation.objects.filter(room=room).count(), codes.count(201))
+            self.assertFalse(Reservation.objects.filter(room=room, status__in=Reservation.ACTIVE_STATUSES).exists())
+            self.assertEqual(
+                OutboxEvent.objects.filter(topic='reservation.cancelled', payload__room=room.pk).count(),
+                codes.count(201))
+
+
+@override_settings(WAITLIST_MATCH_ASYNC=False, THROTTLE_BUCKETS={})
+class CalendarFeedTests(TransactionTestCase):
+    """ iCal feeds render upcoming reservations and answer unchanged polls with 304. """
+
+    def setUp(self):
+        self.user = User.objects.create_user('student', password='not-a-real-password')
+        self.room = make_room()
+        self.client_api = APIClient()
+        self.client_api.force_authenticate(self.user)
+        start, end = future_slot()
+        self.reservation_id = self.client_api.post('/rooms/reservations/', {
+            'room': self.room.pk, 'start_time': start.isoformat(), 'end_time': end.isoformat(),
+            'purpose': 'Group project; chapter 3, ' + 'really ' * 20 + 'long',
+        }, format='json').json()['reservation_id']
+
+    def feed_path(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.get('/rooms/feeds/token/').json()['url'].replace('http://testserver', '')
+
+    def test_user_feed_is_revalidated_with_etag(self):
+        path = self.feed_path(self.user)
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        body = response.content.decode()
+        self.assertIn(f'UID:{self.reservation_id}@libmaster\r\n', body)
+        self.assertIn('Group project\\; chapter 3\\,', body)
+        self.assertTrue(all(len(line.encode()) <= 75 for line in body.split('\r\n')))
+
+        # token lookup and one aggregate, no reservations are read
+        with self.assertNumQueries(2):
+            cached = self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+        self.client_api.post(f'/rooms/reservations/{self.reservation_id}/cancel/')
+        changed = self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotIn('BEGIN:VEVENT', changed.content.decode())
+
+    def test_room_feed_needs_a_staff_token_and_tokens_rotate(self):
+        staff = User.objects.create_user('librarian', password='not-a-real-password', is_staff=True)
+        student_room_feed = self.feed_path(self.user).replace('reservations.ics', 'rooms/STR101.ics')
+        self.assertEqual(self.client.get(student_room_feed).status_code, 404)
+
+        staff_room_feed = self.feed_path(staff).replace('reservations.ics', 'rooms/STR101.ics')
+        response = self.client.get(staff_room_feed)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('SUMMARY:Study room STR101 ( student )', response.content.decode())
+
+        old_path = self.feed_path(self.user)
+        self.client_api.post('/rooms/feeds/token/')
+        self.assertEqual(self.client.get(old_path).status_code, 404)
+        self.assertEqual(self.client.get(self.feed_path(self.user)).status_code, 200)
+
+
+class SearchTests(TransactionTestCase):
+    """ Typeahead and admin search match words of names and room ids, best match first. """
+
+    def setUp(self):
+        for room_id in ('STR101', 'STR102', 'DIR201'):
+            make_room(room_id)
+        Library.objects.create(name='Dirac Science Library', location='West campus',
+                               opening_time=time(8, 0), closing_time=time(22, 0))
+
+    def test_typeahead_ranks_matches_and_filters_kinds(self):
+        response = APIClient().get('/rooms/search/', {'q': 'stroz'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([library['name'] for library in response.json()['libraries']], ['Strozier'])
+
+        rooms = APIClient().get('/rooms/search/', {'q': 'str102', 'kinds': 'room'}).json()
+        self.assertEqual(rooms['rooms'][0]['room_id'], 'STR102')
+        self.assertEqual(rooms['libraries'], [])
+
+        # every word has to match
+        both = APIClient().get('/rooms/search/', {'q': 'dirac west', 'kinds': 'library'}).json()
+        self.assertEqual([library['name'] for library in both['libraries']], ['Dirac Science Library'])
+
+        self.assertEqual(APIClient().get('/rooms/search/', {'q': 's'}).json()['rooms'], [])
+        self.assertEqual(APIClient().get('/rooms/search/', {'q': 'str', 'kinds': 'desk'}).status_code, 400)
+
+    def test_admin_search_and_trigram_queries(self):
+        staff = User.objects.create_superuser('librarian', password='not-a-real-password')
+        self.client.force_login(staff)
+        response = self.client.get('/admin/rooms/room/', {'q': 'dir2'})
+        self.assertContains(response, 'DIR201')
+        self.assertNotContains(response, 'STR101')
+
+        # with pg_trgm installed, matches use the %> operator the GIN indexes serve
+        with mock.patch.object(search, 'trigram_enabled', return_value=True):
+            sql = str(search.ranked('library', 'strozer').query)
+        self.assertIn('%>', sql)
+        self.assertIn('WORD_SIMILARITY', sql)
+
+    def test_trigram_indexes_are_left_to_the_migration(self):
+        state = MigrationLoader(connection).project_state()
+        for model_name in ('library', 'floor', 'room'):
+            indexes = state.apps.get_model('rooms', model_name)._meta.indexes
+            self.assertFalse([index.name for index in indexes if index.name.endswith('_trgm_idx')])
+        migration = importlib.import_module('rooms.migrations.0011_search_trigram_indexes')
+        # both directions run on a server with or without pg_trgm, and run again
+        for _ in range(2):
+            with connection.schema_editor() as editor:
+                migration.drop_indexes(None, editor)
+            with connection.schema_editor() as editor:
+                migration.create_indexes(None, editor)
+
+    def test_extension_check_is_per_alias_and_expires(self):
+        search.extensions.clear()
+        installed = search.extensions.installed('default')
+        self.assertEqual(search.trigram_enabled(), installed)
+        # an answer older than EXTENSION_CHECK_SECONDS is checked again
+        search.extensions._checked['default'] = (clock.monotonic() - search.EXTENSION_CHECK_SECONDS - 1, not installed)
+        self.assertEqual(search.trigram_enabled('default'), installed)
+        search.extensions._checked['default'] = (clock.monotonic(), not installed)
+        self.assertEqual(search.trigram_enabled('default'), not installed)
+        search.extensions.clear()
+
+
+class BatchTests(TransactionTestCase):
+    """ Batched reads answer like the same requests sent one by one, each with its own status. """
+
+    def setUp(self):
+        throttling.reset()
+        self.room = make_room()
+        self.user = User.objects.create_user('student', password='not-a-real-password')
+        self.client_api = APIClient()
+        self.client_api.force_authenticate(self.user)
+        start, end = future_slot()
+        self.client_api.post('/rooms/reservations/', {
+            'room': self.room.pk, 'start_time': start.isoformat(), 'end_time': end.isoformat(),
+        }, format='json')
+        self.date = start.date().isoformat()
+
+    def batch(self, requests, client=None):
+        return (client or self.client_api).post('/rooms/batch/', {'requests': requests}, format='json')
+
+    def test_sub_requests_run_with_shared_authentication(self):
+        response = self.batch([
+            {'id': 'libraries', 'path': '/rooms/libraries/'},
+            {'id': 'availability', 'path': '/rooms/rooms/STR101/availability/', 'params': {'date': self.date}},
+            {'id': 'mine', 'path': '/rooms/reservations/?page=1'},
+            {'id': 'missing', 'path': '/rooms/rooms/NOPE/availability/'},
+            {'id': 'write', 'method': 'post', 'path': '/rooms/reservations/'},
+            {'id': 'elsewhere', 'path': '/rooms/async/libraries/'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        answers = {answer['id']: answer for answer in response.json()['responses']}
+        self.assertEqual(list(answers), ['libraries', 'availability', 'mine', 'missing', 'write', 'elsewhere'])
+        self.assertEqual(answers['libraries']['body'], self.client_api.get('/rooms/libraries/').json())
+        self.assertEqual(len(answers['availability']['body']['reservations']), 1)
+        self.assertEqual(answers['mine']['body']['count'], 1)
+        self.assertEqual([answers[name]['status'] for name in ('missing', 'write', 'elsewhere')], [404, 405, 400])
+
+        # anonymous batches only see what anonymous requests see
+        anonymous = self.batch([{'path': '/rooms/reservations/'}, {'path': '/rooms/libraries/'}], APIClient())
+        self.assertEqual([answer['status'] for answer in anonymous.json()['responses']], [401, 200])
+
+    def test_conditional_headers_stay_with_the_batch(self):
+        floor = Floor.objects.get(pk=self.room.floor_id)
+        etag = f'"floor-{floor.pk}-v{floor.layout_version}"'
+        self.assertEqual(APIClient().get(f'/rooms/floors/{floor.pk}/map/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        response = self.client_api.post('/rooms/batch/', {'requests': [{'path': f'/rooms/floors/{floor.pk}/map/'}]},
+                                        format='json', HTTP_IF_NONE_MATCH=etag, HTTP_IF_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['responses'][0]['status'], 200)
+        self.assertEqual(response.json()['responses'][0]['headers']['ETag'], etag)
+
+    def test_streaming_responses_are_not_batched(self):
+        staff = APIClient()
+        staff.force_authenticate(User.objects.create_user('librarian', password='not-a-real-password', is_staff=True))
+        self.assertEqual(staff.get('/rooms/bulk/rooms/export/').status_code, 200)
+        response = self.batch([{'id': 'export', 'path': '/rooms/bulk/rooms/export/'},
+                               {'id': 'libraries', 'path': '/rooms/libraries/'}], staff)
+        self.assertEqual([answer['status'] for answer in response.json()['responses']], [400, 200])
+
+        # any other view answering with a stream is refused before its body is read
+        read = []
+
+        def chunks():
+            read.append(True)
+            yield b'row\n'
+
+        streaming = ResolverMatch(lambda request: StreamingHttpResponse(chunks()), (), {})
+        with mock.patch.object(batch, '_view', return_value=streaming):
+            answer = self.batch([{'path': '/rooms/libraries/'}]).json()['responses'][0]
+        self.assertEqual(answer['status'], 400)
+        self.assertEqual(read, [])
+
+    def test_one_executor_per_process(self):
+        executors = []
+        with mock.patch.object(batch, '_executor', None):
+            self.assertEqual(run_concurrently(lambda: executors.append(batch._executor_pool()), [()] * 8), [])
+            batch._executor.shutdown()
+        self.assertEqual(len(executors), 8)
+        self.assertEqual(len(set(map(id, executors))), 1)
+
+    def test_batch_size_is_capped(self):
+        with override_settings(BATCH_MAX_REQUESTS=3):
+            self.assertEqual(self.batch([{'path': '/rooms/libraries/'}] * 4).status_code, 400)
+        self.assertEqual(self.batch([{'id': 'a', 'path': '/rooms/libraries/'}] * 2).status_code, 400)
+        self.assertEqual(self.batch([]).status_code, 400)
+
+
+class HeatmapTests(TransactionTestCase):
+    """ Heatmaps sum open, booked and closed room-minutes per bucket, cached until a reservation changes. """
+
+    def setUp(self):
+        cache.clear()
+        throttling.reset()
+        self.room = make_room()
+        make_room('STR102')
+        # materializing opening hours invalidates cached heatmaps too, get it out of the way
+        calendar.materialize(self.room.floor.library)
+        self.user = User.objects.create_user('student', password='not-a-real-password')
+        self.client_api = APIClient()
+        self.client_api.force_authenticate(self.user)
+        self.start, self.end = future_slot()
+
+    def heatmap(self, **params):
+        params.setdefault('start', self.start.date().isoformat())
+        params.setdefault('end', (self.start.date() + timedelta(days=6)).isoformat())
+        return APIClient().get('/rooms/heatmap/', params)
+
+    def book(self):
+        return self.client_api.post('/rooms/reservations/', {
+            'room': self.room.pk, 'start_time': self.start.isoformat(), 'end_time': self.end.isoformat(),
+        }, format='json')
+
+    def test_day_and_hour_buckets(self):
+        self.book()
+        floor = self.heatmap(floor=self.room.floor_id).json()
+        self.assertEqual((floor['rooms'], floor['buckets']), (2, 7))
+        # open 00:00 - 23:59 in both rooms
+        self.assertEqual(floor['open'][0], 2 * 1439)
+        self.assertEqual((floor['booked'][0], floor['reservations'][0], floor['free'][0]), (60, 1, 2 * 1439 - 60))
+        self.assertEqual(floor['booked'][1:], [0] * 6)
+
+        room = self.heatmap(room='STR101', resolution='hour', end=self.start.date().isoformat()).json()
+        self.assertEqual(room['buckets'], 24)
+        self.assertEqual([hour for hour, booked in enumerate(room['booked']) if booked], [10])
+        self.assertEqual(room['free'][10], 0)
+
+        self.assertEqual(self.heatmap(library=self.room.floor.library_id, end='2999-01-01').status_code, 400)
+        self.assertEqual(self.heatmap().status_code, 400)
+
+    def test_cached_until_reservations_or_closures_change(self):
+        first = self.heatmap(room='STR101').json()
+        # the room lookup only, the heatmap comes from the cache
+        with self.assertNumQueries(1):
+            self.assertEqual(self.heatmap(room='STR101').json(), first)
+
+        self.book()
+        self.assertEqual(self.heatmap(room='STR101').json()['booked'][0], 60)
+
+        closure_start = self.start + timedelta(days=1)
+        room_status.transition(self.room, 'maintenance', closure_start, closure_start + timedelta(hours=2))
+        self.assertEqual(self.heatmap(room='STR101').json()['closed'][1], 120)
+
+
+@override_settings(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=0)
+class ProfilingTests(TransactionTestCase):
+    """ Staff requested and sampled requests are profiled into the buffer and can be downloaded. """
+
+    def setUp(self):
+        profiling.reset()
+        throttling.reset()
+        make_room()
+        self.staff = User.objects.create_user('librarian', password='not-a-real-password', is_staff=True)
+        self.staff_client = APIClient()
+        self.staff_client.force_authenticate(self.staff)
+        # the header is only honoured on requests with credentials
+        self.staff_client.force_login(self.staff)
+
+    def test_staff_header_profiles_a_request(self):
+        student = APIClient()
+        student.force_authenticate(User.objects.create_user('student', password='not-a-real-password'))
+        self.assertNotIn('X-Profile-Id', student.get('/rooms/rooms/STR101/availability/', HTTP_X_PROFILE='1'))
+        self.assertNotIn('X-Profile-Id', self.staff_client.get('/rooms/rooms/STR101/availability/'))
+
+        response = self.staff_client.get('/rooms/rooms/STR101/availability/', HTTP_X_PROFILE='1')
+        profile_id = response['X-Profile-Id']
+        listed = self.staff_client.get('/rooms/metrics/profiles/').json()['profiles']
+        self.assertEqual([profile['id'] for profile in listed], [profile_id])
+
+        detail = self.staff_client.get(f'/rooms/metrics/profiles/{profile_id}/').json()
+        self.assertEqual((detail['status'], detail['user'], detail['reason']), (200, 'librarian', 'header'))
+        self.assertGreater(detail['query_count'], 0)
+        self.assertIn('rooms_room', detail['queries'][0]['sql'])
+
+        speedscope = self.staff_client.get(f'/rooms/metrics/profiles/{profile_id}/', {'download': 'speedscope'}).json()
+        profile = speedscope['profiles'][0]
+        self.assertEqual(profile['type'], 'sampled')
+        self.assertEqual(len(profile['samples']), len(profile['weights']))
+        self.assertEqual(student.get('/rooms/metrics/profiles/').status_code, 403)
+
+    @override_settings(PROFILING_SAMPLE_RATE=0, PROFILING_HEADER_BUCKET=(0.001, 2))
+    def test_header_needs_credentials_and_is_rate_limited(self):
+        anonymous = APIClient()
+        with mock.patch.object(profiling, 'Profile', wraps=profiling.Profile) as profile:
+            for _ in range(3):
+                self.assertNotIn('X-Profile-Id', anonymous.get('/rooms/libraries/', HTTP_X_PROFILE='1'))
+        # not even profiled and dropped
+        self.assertEqual(profile.call_count, 0)
+        # anonymous requests took no tokens, staff get the whole burst and no more
+        responses = [self.staff_client.get('/rooms/libraries/', HTTP_X_PROFILE='1') for _ in range(3)]
+        self.assertEqual(['X-Profile-Id' in response for response in responses], [True, True, False])
+        self.assertEqual(len(profiling.recent.slowest(10)), 2)
+
+    def test_sampled_requests_fill_a_bounded_buffer(self):
+        with override_settings(PROFILING_SAMPLE_RATE=1, PROFILING_BUFFER_SIZE=3):
+            client = APIClient()
+            for _ in range(5):
+                client.get('/rooms/libraries/')
+            profiles = profiling.recent.slowest(10)
+        self.assertEqual(len(profiles), 3)
+        self.assertEqual({profile.reason for profile in profiles}, {'sampled'})
+        durations = [profile.duration for profile in profiles]
+        self.assertEqual(durations, sorted(durations, reverse=True))
+
+
+# a worker process: reports the library's availability version, then when it changed and to what
+VERSION_WATCHER = """
+import sys, time
+import django
+django.setup()
+from rooms import versions
+library_id = int(sys.argv[1])
+seen = versions.availability(library_id)
+print('ready', seen, flush=True)
+deadline = time.time() + 10
+while versions.availability(library_id) == seen and time.time() < deadline:
+    time.sleep(0.0005)
+print('changed', versions.availability(library_id), time.time(), flush=True)
+"""
+
+
+class CacheInvalidationBusTests(TransactionTestCase):
+    """ A version bump in one process reaches the other worker processes through LISTEN/NOTIFY. """
+
+    def setUp(self):
+        cache.clear()
+        self.library = make_room().floor.library
+
+    def watchers(self, count):
+        env = dict(os.environ, DB_NAME=connection.settings_dict['NAME'], CACHE_INVALIDATION_BUS='1')
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+        processes = [
+            subprocess.Popen(
+                [sys.executable, '-c', VERSION_WATCHER, str(self.library.pk)],
+                cwd=settings.BASE_DIR, env=env, stdout=subprocess.PIPE, text=True,
+            )
+            for _ in range(count)
+        ]
+        for process in processes:
+            self.addCleanup(process.kill)
+            self.addCleanup(process.stdout.close)
+        return processes
+
+    def test_workers_converge_on_a_bump(self):
+        processes = self.watchers(3)
+        before = versions.availability(self.library.pk)
+        for process in processes:
+            self.assertEqual(process.stdout.readline().split()[0], 'ready')
+
+        bumped_at = clock.time()
+        versions.bump_availability(library_ids=[self.library.pk])
+        after = versions.availability(self.library.pk)
+        self.assertGreater(after, before)
+
+        for process in processes:
+            changed, version, changed_at = process.stdout.readline().split()
+            self.assertEqual((changed, int(version)), ('changed', after))
+            # within milliseconds, a second leaves room for a loaded machine
+            self.assertLess(float(changed_at) - bumped_at, 1.0)
+            self.assertEqual(process.wait(timeout=10), 0)
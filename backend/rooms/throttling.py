@@ -0,0 +1,293 @@
+# Purpose: Token bucket rate limits and a concurrency limit for booking writes
+
+import contextlib
+import functools
+import math
+import threading
+import time
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.exceptions import Throttled
+from rest_framework.throttling import BaseThrottle
+
+"""
+Two layers of admission control, both answering 429 with Retry-After:
+
+Rate limits ( DRF throttles, checked before the view runs )
+    Every scope in THROTTLE_BUCKETS ( 'availability', 'booking' ) has up to three token buckets:
+    one per user, one per client IP and one for the endpoint as a whole. A bucket holds `burst`
+    tokens and refills `rate` tokens per second. A request takes one token from each of its buckets,
+    or none at all when any of them is empty, so a rejected request does not use up the others.
+    Buckets are kept as GCRA timestamps ( one float per key ) either in process memory
+    ( THROTTLE_STORE = 'local', exact ) or in CACHES['default'] ( 'cache', shared by every worker,
+    concurrent requests racing on one key can both pass, so a burst may overshoot by a few requests ).
+    The cache is network or database I/O, async views take from it in a worker thread
+
+Concurrency limit ( booking writes only, around the view )
+    At most BOOKING_MAX_CONCURRENT_WRITES writes run at once in each worker process, the next
+    BOOKING_MAX_QUEUED wait up to BOOKING_QUEUE_TIMEOUT seconds for a slot and the rest are shed,
+    so the database sees a bounded number of booking transactions however hard clients retry
+
+Counters for both layers are exposed to staff at rooms/metrics/throttling/
+"""
+
+# local buckets are swept when there are more keys than this
+MAX_LOCAL_KEYS = 10000
+
+
+class _Metrics:
+    """ Per process counters of admitted, rejected, queued and shed requests. """
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset( self ):
+        with self._lock:
+            self.rejected = Counter()
+            self.writes = Counter()
+            self.queue_wait_seconds = 0.0
+
+    def reject( self, scope, kind ):
+        with self._lock:
+            self.rejected[ f"{scope}:{kind}" ] += 1
+
+    def write( self, outcome, waited=0.0 ):
+        with self._lock:
+            self.writes[ outcome ] += 1
+            self.queue_wait_seconds += waited
+
+    def snapshot( self ):
+        with self._lock:
+            return {
+                'rejected': dict( self.rejected ),
+                'writes': dict( self.writes ),
+                'queue_wait_seconds': round( self.queue_wait_seconds, 3 ),
+            }
+
+
+metrics = _Metrics()
+
+
+def _gcra( tat, now, rate, burst ):
+    """
+    Generic cell rate algorithm, the token bucket as one timestamp ( the theoretical arrival time ).
+    Returns ( new tat, 0 ) when a token is available, else ( None, seconds until one is ).
+    """
+    interval = 1.0 / rate
+    new_tat = max( tat or now, now ) + interval
+    wait = new_tat - now - burst * interval
+    if wait > 0:
+        return None, wait
+    return new_tat, 0.0
+
+
+class LocalBucketStore:
+    """ Buckets in this process's memory. """
+
+    def __init__( self ):
+        self._tats = {}
+        self._lock = threading.Lock()
+
+    def take( self, buckets ):
+        """ Take a token from every ( key, rate, burst ) bucket, or from none if one is empty, returns their waits. """
+        now = time.monotonic()
+        with self._lock:
+            results = [ _gcra( self._tats.get( key ), now, rate, burst ) for key, rate, burst in buckets ]
+            if not any( wait for _, wait in results ):
+                for ( key, _, _ ), ( tat, _ ) in zip( buckets, results ):
+                    self._tats[ key ] = tat
+                if len( self._tats ) > MAX_LOCAL_KEYS:
+                    # a bucket whose tat has passed is full again, forgetting it changes nothing
+                    self._tats = { name: value for name, value in self._tats.items() if value > now }
+        return [ wait for _, wait in results ]
+
+    def clear( self ):
+        with self._lock:
+            self._tats.clear()
+
+
+class CacheBucketStore:
+    """ Buckets in the default cache, shared by every process that uses it. """
+
+    def take( self, buckets ):
+        """ Take a token from every ( key, rate, burst ) bucket, or from none if one is empty, returns their waits. """
+        cache = caches[ 'default' ]
+        now = time.time()
+        tats = cache.get_many( [ key for key, _, _ in buckets ] )
+        results = [ _gcra( tats.get( key ), now, rate, burst ) for key, rate, burst in buckets ]
+        if not any( wait for _, wait in results ):
+            for ( key, _, _ ), ( tat, _ ) in zip( buckets, results ):
+                # the entry is only needed until the bucket would be full again
+                cache.set( key, tat, timeout=math.ceil( tat - now ) + 1 )
+        return [ wait for _, wait in results ]
+
+    def clear( self ):
+        pass
+
+
+_local_store = LocalBucketStore()
+_cache_store = CacheBucketStore()
+
+
+def bucket_store():
+    return _cache_store if 'cache' == getattr( settings, 'THROTTLE_STORE', 'local' ) else _local_store
+
+
+def take( scope, idents ):
+    """
+    Take a token from the scope's bucket of every kind in `idents` ( { kind: ident } ), or from none of them
+    when one is empty. Returns 0 when admitted, else the seconds until every bucket has a token.
+    """
+    config = getattr( settings, 'THROTTLE_BUCKETS', {} ).get( scope, {} )
+    kinds = [ kind for kind, ident in idents.items() if ident is not None and kind in config ]
+    if not kinds:
+        return 0.0
+    waits = bucket_store().take( [
+        ( f"throttle:{scope}:{kind}:{idents[ kind ]}", *config[ kind ] ) for kind in kinds
+    ] )
+    for kind, wait in zip( kinds, waits ):
+        if wait:
+            metrics.reject( scope, kind )
+    return max( waits )
+
+
+class TokenBucketThrottle( BaseThrottle ):
+    """ Base class, subclasses say which scope's user, IP and endpoint buckets a request draws from. """
+    scope = None
+
+    def get_bucket_idents( self, request ):
+        return {
+            # anonymous clients are covered by the IP bucket
+            'user': request.user.pk if request.user and request.user.is_authenticated else None,
+            'ip': self.get_ident( request ),
+            'endpoint': 'all',
+        }
+
+    def allow_request( self, request, view ):
+        self.wait_seconds = take( self.scope, self.get_bucket_idents( request ) )
+        return not self.wait_seconds
+
+    def wait( self ):
+        return self.wait_seconds
+
+
+def anonymous_wait( scope, request ):
+    """ For plain Django views: take from the IP and endpoint buckets, returns the wait ( 0 admits ). """
+    return take( scope, { 'ip': BaseThrottle().get_ident( request ), 'endpoint': 'all' } )
+
+
+async def aanonymous_wait( scope, request ):
+    """ anonymous_wait() for async views, the cache store is I/O and runs in a worker thread. """
+    if bucket_store() is _local_store:
+        return anonymous_wait( scope, request )
+    return await sync_to_async( anonymous_wait )( scope, request )
+
+
+@functools.lru_cache( maxsize=None )
+def throttles_for( scope ):
+    """ The throttle classes for a scope, for throttle_classes on views and actions. """
+    # one throttle for all three buckets, DRF asks every throttle in the list even after one refused
+    return [ type( f"TokenBucketThrottle_{scope}", ( TokenBucketThrottle, ), { 'scope': scope } ) ]
+
+
+class ConcurrencyLimiter:
+    """ At most `limit` callers inside at once, `max_queued` more wait up to `timeout` seconds. """
+
+    def __init__( self, limit, max_queued, timeout ):
+        self.limit = limit
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore( limit )
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        # moving average of how long a write holds its slot, for Retry-After
+        self.average_seconds = 0.1
+
+    def retry_after( self ):
+        return max( 1, math.ceil( ( self.waiting + 1 ) / self.limit * self.average_seconds ) )
+
+    def _acquire( self ):
+        if self._slots.acquire( blocking=False ):
+            metrics.write( 'admitted' )
+            return
+        with self._lock:
+            if self.waiting >= self.max_queued:
+                metrics.write( 'shed' )
+                raise Throttled( wait=self.retry_after() )
+            self.waiting += 1
+        started = time.monotonic()
+        try:
+            admitted = self._slots.acquire( timeout=self.timeout )
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        waited = time.monotonic() - started
+        if not admitted:
+            metrics.write( 'timed_out', waited )
+            raise Throttled( wait=self.retry_after() )
+        metrics.write( 'queued', waited )
+
+    @contextlib.contextmanager
+    def slot( self ):
+        """ Hold one slot for the body of the with block, raises Throttled when none frees up in time. """
+        self._acquire()
+        with self._lock:
+            self.in_flight += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            held = time.monotonic() - started
+            with self._lock:
+                self.in_flight -= 1
+                self.average_seconds = 0.9 * self.average_seconds + 0.1 * held
+            self._slots.release()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def booking_limiter():
+    """ The process wide limiter for booking writes, rebuilt if its settings change. """
+    config = (
+        settings.BOOKING_MAX_CONCURRENT_WRITES,
+        settings.BOOKING_MAX_QUEUED,
+        settings.BOOKING_QUEUE_TIMEOUT,
+    )
+    with _limiters_lock:
+        if config not in _limiters:
+            _limiters[ config ] = ConcurrencyLimiter( *config )
+        return _limiters[ config ]
+
+
+def admission_controlled( view_method ):
+    """ Run a DRF view method under the booking write limiter, 429 when it is saturated. """
+    @functools.wraps( view_method )
+    def wrapper( self, request, *args, **kwargs ):
+        with booking_limiter().slot():
+            return view_method( self, request, *args, **kwargs )
+    return wrapper
+
+
+def metrics_snapshot():
+    limiter = booking_limiter()
+    snapshot = metrics.snapshot()
+    snapshot.update( {
+        'store': 'cache' if bucket_store() is _cache_store else 'local',
+        'booking_writes_in_flight': limiter.in_flight,
+        'booking_writes_waiting': limiter.waiting,
+        'booking_write_limit': limiter.limit,
+    } )
+    return snapshot
+
+
+def reset():
+    """ Forget every local bucket and counter ( tests ). """
+    _local_store.clear()
+    metrics.reset()
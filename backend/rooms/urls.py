@@ -5,7 +5,7 @@
 # rooms/urls.py
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from . import api_views
+from . import api_views, async_views, feeds
 
 router = DefaultRouter()
 router.register(r'libraries', api_views.LibraryViewSet)
@@ -13,6 +13,7 @@ router.register(r'floors', api_views.FloorViewSet)
 router.register(r'rooms', api_views.RoomViewSet)
 router.register(r'reservations', api_views.ReservationViewSet)
 router.register(r'materials', api_views.MaterialViewSet)
+router.register(r'waitlist', api_views.WaitlistEntryViewSet)
 
 urlpatterns = [
     path('demo/', api_views.demo_view, name='demo'),
@@ -20,6 +21,29 @@ urlpatterns = [
     path('', include(router.urls)),
 
     path('rooms/<str:room_id>/availability/', api_views.check_room_availability, name='room-availability'),
+    path('rooms/<str:room_id>/suggestions/', api_views.room_suggestions, name='room-suggestions'),
+    path('rooms/<str:room_id>/status/', api_views.room_status_view, name='room-status'),
+
+    path('heatmap/', api_views.availability_heatmap, name='availability-heatmap'),
+    path('search/', api_views.typeahead_search, name='typeahead-search'),
+    path('batch/', api_views.batch_view, name='batch'),
+
+    path('async/libraries/', async_views.library_list, name='async-library-list'),
+    path('async/floors/', async_views.floor_list, name='async-floor-list'),
+    path('async/rooms/', async_views.room_search, name='async-room-search'),
+    path('async/rooms/<str:room_id>/availability/', async_views.room_availability, name='async-room-availability'),
+
+    path('feeds/token/', api_views.calendar_feed_token, name='calendar-feed-token'),
+    path('feeds/<str:token>/reservations.ics', feeds.user_feed, name='user-calendar-feed'),
+    path('feeds/<str:token>/rooms/<str:room_id>.ics', feeds.room_feed, name='room-calendar-feed'),
+
+    path('metrics/throttling/', api_views.throttling_metrics, name='throttling-metrics'),
+    path('metrics/outbox/', api_views.outbox_metrics, name='outbox-metrics'),
+    path('metrics/profiles/', api_views.profile_list, name='profile-list'),
+    path('metrics/profiles/<str:profile_id>/', api_views.profile_detail, name='profile-detail'),
+
+    path('bulk/<str:kind>/export/', api_views.bulk_export, name='bulk-export'),
+    path('bulk/<str:kind>/import/', api_views.bulk_import, name='bulk-import'),
     
     path('libraries/<int:library_id>/floors/', 
          api_views.FloorViewSet.as_view({'get': 'list'}), 
@@ -0,0 +1,201 @@
+# Purpose: Version numbers that cached data is keyed by, and the bus that moves them on in every worker process
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+try:
+    import psycopg
+except ImportError:  # psycopg 3 not installed, versions only move on in the process that bumps them
+    psycopg = None
+
+"""
+Floor.layout_version versions the compiled floor maps in the database. Data that changes far more often
+( every booking would update one shared row ) is versioned here instead, one number per name:
+    availability:<library id>   reservations, room closures and opening hours of the library's rooms
+    catalog                     libraries, floors and rooms
+Everything cached from that data has the versions in its key, a bump makes the old entries unreachable
+and they expire with their TTL. Readers take the version before reading the data, so an entry written
+while a change commits is filed under the old version
+
+Versions are read from this process's memory ( no round trip per request ). A bump, once the writing
+transaction has committed, is one statement: it draws the new numbers from the PostgreSQL sequence
+rooms_version_seq and broadcasts them with NOTIFY on VERSIONS_CHANNEL
+    this process        takes the new numbers from the statement's result, a client sees its own change
+    other processes     with CACHE_INVALIDATION_BUS, a thread per process LISTENs on its own connection
+                        and takes them within milliseconds, on every node that uses the database
+A name this process has not seen yet starts at the sequence's value when the process started listening,
+which every later bump is above. A listener that lost its connection cannot know what it missed, on
+reconnecting it moves every version to the sequence's current value
+
+Without the bus ( development, a single process ) the numbers only move in the process that bumps them,
+other processes see a change when their cached entries expire
+"""
+
+logger = logging.getLogger( __name__ )
+
+VERSIONS_CHANNEL = 'rooms_versions'
+SEQUENCE = 'rooms_version_seq'
+
+BUMP_SQL = """
+SELECT bumped.name, bumped.version, pg_notify( %(channel)s, bumped.name || '=' || bumped.version )
+FROM (
+    SELECT names.name, nextval( '{sequence}' ) AS version
+    FROM (
+        SELECT unnest( %(names)s::text[] ) AS name
+        UNION
+        SELECT 'availability:' || floor.library_id
+        FROM {room} room JOIN {floor} floor ON floor.id = room.floor_id
+        WHERE room.id = ANY( %(rooms)s )
+    ) AS names
+) AS bumped
+"""
+
+
+class _Versions:
+    """ This process's version numbers, and the thread that keeps them in step with the other processes. """
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._base = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _start_listening( self ):
+        with self._lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread( target=self._listen, name='versions-listener', daemon=True )
+                self._thread.start()
+        # the first request of a process waits for the listener, later ones find it ready
+        self._ready.wait( settings.CACHE_INVALIDATION_STARTUP_TIMEOUT )
+
+    def _sequence_value( self ):
+        with connection.cursor() as cursor:
+            cursor.execute( f"SELECT last_value FROM {SEQUENCE}" )
+            return cursor.fetchone()[ 0 ]
+
+    def base( self ):
+        if self._base is None:
+            if bus_enabled():
+                self._start_listening()
+            if self._base is None:
+                # no bus, or it could not connect yet
+                value = self._sequence_value()
+                with self._lock:
+                    if self._base is None:
+                        self._base = value
+        return self._base
+
+    def get( self, name ):
+        version = self._versions.get( name )
+        if version is None:
+            base = self.base()
+            with self._lock:
+                version = self._versions.setdefault( name, base )
+        return version
+
+    def set( self, name, version ):
+        with self._lock:
+            if version > self._versions.get( name, self._base or 0 ):
+                self._versions[ name ] = version
+
+    def reset( self, base ):
+        """ Every version moves to `base`, above any bump this process may have missed. """
+        with self._lock:
+            self._base = base
+            self._versions.clear()
+
+    def _listen( self ):
+        from .async_db import _conninfo
+
+        while not self._stop.is_set():
+            try:
+                with psycopg.connect( _conninfo(), autocommit=True ) as listener:
+                    listener.execute( f"LISTEN {VERSIONS_CHANNEL}" )
+                    # read after LISTEN, no bump can fall between the two
+                    self.reset( listener.execute( f"SELECT last_value FROM {SEQUENCE}" ).fetchone()[ 0 ] )
+                    self._ready.set()
+                    while not self._stop.is_set():
+                        for notify in listener.notifies( timeout=1.0 ):
+                            name, _, version = notify.payload.rpartition( '=' )
+                            self.set( name, int( version ) )
+            except Exception:
+                if self._stop.is_set():
+                    break
+                logger.exception( "Version listener lost its connection, reconnecting" )
+                self._ready.clear()
+                time.sleep( 1.0 )
+
+    def stop( self ):
+        """ Stop listening ( tests, before the test database is dropped ). """
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join( timeout=5.0 )
+        self._ready.clear()
+
+
+_versions = _Versions()
+
+
+def bus_enabled():
+    return psycopg is not None and getattr( settings, 'CACHE_INVALIDATION_BUS', False )
+
+
+def get( name ):
+    """ The current version of `name`. """
+    return _versions.get( name )
+
+
+def _bump( names, room_ids ):
+    # imported here because rooms.models imports this module
+    from .models import Floor, Room
+
+    sql = BUMP_SQL.format( sequence=SEQUENCE, room=Room._meta.db_table, floor=Floor._meta.db_table )
+    with connection.cursor() as cursor:
+        cursor.execute( sql, {
+            'channel': VERSIONS_CHANNEL,
+            'names': sorted( names ),
+            'rooms': sorted( room_ids ),
+        } )
+        bumped = cursor.fetchall()
+    for name, version, _ in bumped:
+        _versions.set( name, version )
+
+
+def bump( *names, room_ids=() ):
+    """
+    Move the versions of `names`, and the availability of the libraries of `room_ids`, on in every
+    process once the current transaction commits ( at once outside one ).
+    """
+    names = set( names )
+    room_ids = set( room_ids ) - { None }
+    if names or room_ids:
+        transaction.on_commit( lambda: _bump( names, room_ids ) )
+
+
+def availability( library_id ):
+    return get( f"availability:{library_id}" )
+
+
+def bump_availability( library_ids=(), room_ids=() ):
+    """ Invalidate cached availability of these libraries and of the libraries of these rooms, on commit. """
+    bump( *( f"availability:{library_id}" for library_id in library_ids ), room_ids=room_ids )
+
+
+def catalog():
+    return get( 'catalog' )
+
+
+def bump_catalog():
+    bump( 'catalog' )
+
+
+def stop():
+    _versions.stop()
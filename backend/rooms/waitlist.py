@@ -0,0 +1,145 @@
+# Purpose: Match freed reservation intervals against the waitlist and hand out holds
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Room, Reservation, WaitlistEntry
+from . import booking, events, outbox, quotas, room_status
+
+"""
+When an active reservation is cancelled, deleted, moved or its waitlist hold runs out,
+the interval it held is handed to schedule_match(), which records a waitlist.match outbox
+event in the same transaction. The outbox workers run the match ( retried on failure ), so the
+request that freed the slot never waits for it and a restart loses no freed slot
+
+Each match locks the room, then walks the waiting entries whose window overlaps the freed
+interval ( an index range scan on status/room/start_time ) oldest first, and gives every
+entry whose whole window is now free a pending reservation that expires after
+WAITLIST_HOLD_MINUTES unless the user accepts it
+"""
+
+# waiting entries examined per freed interval
+MATCH_BATCH_SIZE = 50
+
+
+def hold_duration():
+    return timedelta( minutes=getattr( settings, 'WAITLIST_HOLD_MINUTES', 15 ) )
+
+
+def schedule_match( room_id, start_time, end_time ):
+    """ Match the freed interval once the current transaction commits, off the request path. """
+    if not getattr( settings, 'WAITLIST_MATCH_ASYNC', True ):
+        transaction.on_commit( lambda: match_freed_interval( room_id, start_time, end_time ) )
+        return
+    outbox.emit( 'waitlist.match', { 'room': room_id, 'start_time': start_time, 'end_time': end_time } )
+
+
+@outbox.handler( 'waitlist.match' )
+def run_match( payload ):
+    match_freed_interval( payload[ 'room' ], parse_datetime( payload[ 'start_time' ] ), parse_datetime( payload[ 'end_time' ] ) )
+
+
+def match_freed_interval( room_id, start_time, end_time ):
+    """ Offer the interval [start_time, end_time) of a room to matching waitlist entries, returns the offers made. """
+    now = timezone.now()
+    offers = []
+    with transaction.atomic():
+        room = Room.objects.select_for_update().filter( pk=room_id ).first()
+        if room is None or 'available' != room.status or end_time <= now:
+            return offers
+
+        entries = WaitlistEntry.objects.select_for_update( skip_locked=True, of=( 'self', ) ).filter(
+            Q( room_id=room.pk ) | Q( floor_id=room.floor_id ),
+            status='waiting',
+            start_time__gte=now,
+            start_time__lt=end_time,
+            end_time__gt=start_time,
+        ).select_related( 'user' ).order_by( 'created_at' )[ :MATCH_BATCH_SIZE ]
+
+        for entry in entries:
+            # the freed slot is only offered when it covers the whole window the user asked for
+            if booking.conflicting_reservations( room, entry.start_time, entry.end_time ).exists() \
+                    or room_status.closures( room, entry.start_time, entry.end_time ).exists():
+                continue
+            try:
+                quotas.check_quota( entry.user, entry.start_time, entry.end_time, room.floor.library )
+            except quotas.QuotaExceeded:
+                continue
+            entry.hold = Reservation.objects.create(
+                user=entry.user,
+                room=room,
+                start_time=entry.start_time,
+                end_time=entry.end_time,
+                status='pending',
+                notes="Waitlist hold",
+            )
+            entry.status = 'offered'
+            entry.hold_expires_at = now + hold_duration()
+            entry.save( update_fields=[ 'hold', 'status', 'hold_expires_at' ] )
+            events.reservation_created( entry.hold, source='waitlist' )
+            events.hold_offered( entry )
+            offers.append( entry )
+    return offers
+
+
+def accept_hold( entry ):
+    """ Confirm an offered hold before it expires, returns True on success. """
+    with transaction.atomic():
+        entry = WaitlistEntry.objects.select_for_update( of=( 'self', ) ).select_related( 'hold' ).get( pk=entry.pk )
+        if 'offered' != entry.status or entry.hold is None or 'pending' != entry.hold.status \
+                or entry.hold_expires_at <= timezone.now():
+            return False
+        previous = events.snapshot( entry.hold )
+        entry.hold.status = 'confirmed'
+        entry.hold.save( update_fields=[ 'status', 'modified_at' ] )
+        entry.status = 'fulfilled'
+        entry.save( update_fields=[ 'status' ] )
+        events.reservation_changed( entry.hold, previous )
+        events.hold_accepted( entry )
+    return True
+
+
+def withdraw( entry ):
+    """ Leave the waitlist, releasing any hold that was offered. """
+    with transaction.atomic():
+        entry = WaitlistEntry.objects.select_for_update( of=( 'self', ) ).select_related( 'hold' ).get( pk=entry.pk )
+        if entry.status not in ( 'waiting', 'offered' ):
+            return
+        _release_hold( entry )
+        entry.status = 'cancelled'
+        entry.save( update_fields=[ 'status' ] )
+
+
+def _release_hold( entry ):
+    hold = entry.hold
+    if hold is not None and 'pending' == hold.status:
+        previous = events.snapshot( hold )
+        hold.status = 'cancelled'
+        hold.save( update_fields=[ 'status', 'modified_at' ] )
+        events.reservation_changed( hold, previous, source='waitlist' )
+        schedule_match( hold.room_id, hold.start_time, hold.end_time )
+
+
+def expire_holds( now=None ):
+    """
+    Cancel holds nobody accepted in time and drop entries whose window has passed.
+    Freed holds go straight back into matching. Returns ( holds expired, entries expired ).
+    """
+    now = now or timezone.now()
+    expired_holds = 0
+    with transaction.atomic():
+        for entry in WaitlistEntry.objects.select_for_update( skip_locked=True, of=( 'self', ) ).select_related( 'hold' ).filter(
+            status='offered', hold_expires_at__lte=now
+        ):
+            _release_hold( entry )
+            entry.status = 'expired'
+            entry.save( update_fields=[ 'status' ] )
+            expired_holds += 1
+
+        stale_entries = WaitlistEntry.objects.filter( status='waiting', start_time__lte=now ).update( status='expired' )
+    return expired_holds, stale_entries